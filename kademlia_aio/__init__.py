@@ -1,16 +1,33 @@
 import asyncio
-from collections import OrderedDict
-from functools import wraps
-from itertools import zip_longest
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from functools import partial, wraps
 import hashlib
 import logging
-import pickle
 import random
 import socket
+import time
+from types import MappingProxyType
+
+from kademlia_aio.cache import ValueCache
+from kademlia_aio.codec import BinaryCodec, CodecError, MessageTooLarge
+from kademlia_aio.maintenance import MaintenanceScheduler
+from kademlia_aio.metrics import RPCMetrics
+from kademlia_aio.republish import Republisher
+from kademlia_aio.snapshot import Snapshotter
+from kademlia_aio.storage import Storage
+from kademlia_aio.timers import RoundTripEstimator, TimerWheel
+from kademlia_aio.trace import MessageTrace
+from kademlia_aio.transfer import IncomingTransfers
 
 
 logger = logging.getLogger(__name__)
 
+EMPTY_BUCKET = MappingProxyType(OrderedDict())
+
+# The bytes of a chunk RPC besides its data, for fitting chunks into datagram_size.
+CHUNK_OVERHEAD = 128
+
 
 def remote(func):
     '''
@@ -33,25 +50,67 @@ def remote(func):
     inner.reply_function = func
     return inner
 
+
+class PeerBusy(socket.timeout):
+    '''Raised by an RPC when the peer refused the request because it was busy.  A subclass of
+       socket.timeout, since callers treat a busy peer much like one that did not reply, but may
+       catch it to tell a loaded peer from a dead one.'''
+
 class DatagramRPCProtocol(asyncio.DatagramProtocol):
     '''Implements an RPC mechanism over UDP.  Create a subcass of DatagramRPCProtocol, and
        decorate some of its methods with @remote to designate them as part of the
-       RPC interface.'''
+       RPC interface.  RPCs added to a subclass after it has been deployed should be
+       listed in its extended_procedures, in the order they were added, so that peers
+       running the earlier version still understand the RPCs they have.'''
+
+    extended_procedures = ()
 
-    def __init__(self, reply_timeout=5):
+    def __init__(self, reply_timeout=5, codec=None, retransmits=0, datagram_size=1400,
+                 max_concurrent_replies=64, max_reply_backlog=256):
         '''Initialized a DatagramRPCProtocol, optionally specifying an acceptable
            reply_timeout (in seconds) while waiting for a response from a remote
-           server.'''
+           server, the codec used to encode datagrams (a BinaryCodec for this
+           protocol's RPCs by default), how many times to retransmit a request
+           before giving up on it, and the datagram_size that batched RPCs should
+           fit their messages into (by default, small enough to avoid fragmentation
+           on most paths).
+
+           The wait for each attempt adapts to the round trip times measured for the
+           peer, and is never longer than reply_timeout.  The traffic of each procedure
+           is counted in metrics.  Datagrams are not logged; start_tracing keeps a
+           sampled trace of them instead.
+
+           Reply functions may be coroutines.  At most max_concurrent_replies of them run
+           at once, with up to max_reply_backlog more requests queued to run after them;
+           further requests are shed, answered at once with a busy reply rather than left
+           to overflow the socket's buffer.'''
         self.outstanding_requests = {}
+        self.transmissions = {}
+        self.timeouts = TimerWheel()
+        self.round_trip_times = RoundTripEstimator()
         self.reply_functions = self.find_reply_functions()
         self.reply_timeout = reply_timeout
+        self.retransmits = retransmits
+        self.datagram_size = datagram_size
+        self.max_concurrent_replies = max_concurrent_replies
+        self.max_reply_backlog = max_reply_backlog
+        self.running_replies = 0
+        self.reply_backlog = deque()
+        self.metrics = RPCMetrics()
+        self.trace = None
+        if codec is None:
+            extensions = [name for name in self.extended_procedures if name in self.reply_functions]
+            codec = BinaryCodec.shared(self.reply_functions, extensions)
+        self.codec = codec
         super(DatagramRPCProtocol, self).__init__()
 
     def find_reply_functions(self):
-        '''Locates the reply functions (decorated by @remote) for all RPC methods,
-           returning a dictionary mapping {RPC method name: reply function}.'''
+        '''Locates the reply functions (decorated by @remote) for all RPC methods, including
+           those inherited from base classes, returning a dictionary mapping {RPC method name:
+           reply function}.'''
         return {func.remote_name: func.reply_function
-                for func in self.__class__.__dict__.values()
+                for cls in reversed(self.__class__.__mro__)
+                for func in cls.__dict__.values()
                 if hasattr(func, 'remote_name')}
 
     def connection_made(self, transport):
@@ -64,188 +123,1151 @@ class DatagramRPCProtocol(asyncio.DatagramProtocol):
         '''The callback from asyncio.DatagramProtocol upon receipt of a datagram
            packet.  The data are the bytes of the packet's payload, and the peer
            is the IP and port of the peer who sent the packet.'''
-        logger.info('data_received: %r, %r', peer, data)
-        direction, message_identifier, *details = pickle.loads(data)
+        try:
+            direction, message_identifier, *details = self.codec.decode(data)
+        except CodecError as e:
+            logger.warning('dropping malformed datagram from %r: %s', peer, e)
+            self.metrics.malformed += 1
+            return
+        try:
+            self.dispatch(peer, data, direction, message_identifier, details)
+        except (CodecError, IndexError, KeyError, TypeError, ValueError) as e:
+            logger.warning('dropping malformed %s from %r: %r', direction, peer, e)
+            self.metrics.malformed += 1
+
+    def dispatch(self, peer, data, direction, message_identifier, details):
+        '''Hands a decoded message to request_received, reply_received or busy_received.
+           A message that decoded, but does not fit the procedure it names (such as a
+           request with the wrong arguments), raises one of the errors that
+           datagram_received drops it for.'''
         if direction == 'request':
             procedure_name, args, kwargs = details
+            self.metrics.request_received(procedure_name, peer, len(data))
             self.request_received(peer, message_identifier, procedure_name, args, kwargs)
         elif direction == 'reply':
             answer, = details
+            transmission = self.transmissions.get(message_identifier)
+            if transmission is not None:
+                _, _, sent_at, _, procedure_name = transmission
+                self.metrics.reply_received(procedure_name, peer, len(data),
+                                            asyncio.get_event_loop().time() - sent_at)
+            else:
+                self.metrics.unmatched_replies += 1
             self.reply_received(peer, message_identifier, answer)
+        elif direction == 'busy':
+            self.busy_received(peer, message_identifier, len(data))
 
     def request_received(self, peer, message_identifier, procedure_name, args, kwargs):
         '''Handles replying to an incoming RPC.  May be overridden to inspect/modify
            the incoming arguments or procedure_name, or to implement authorization
-           checks.'''
-        logger.info('request from %r: %r(*%r, **%r) as message %r',
-                    peer, procedure_name, args, kwargs, message_identifier)
+           checks.  A reply function returning a coroutine (or future) is scheduled,
+           and replied to when it finishes.'''
         reply_function = self.reply_functions[procedure_name]
         answer = reply_function(self, peer, *args, **kwargs)
-        self.reply(peer, message_identifier, answer)
+        if asyncio.iscoroutine(answer) or isinstance(answer, asyncio.Future):
+            self.schedule_reply(peer, message_identifier, procedure_name, answer)
+        else:
+            self.reply(peer, message_identifier, answer, procedure_name)
+
+    def schedule_reply(self, peer, message_identifier, procedure_name, answer):
+        '''Runs a pending answer if fewer than max_concurrent_replies are running, or
+           queues it in the reply_backlog if that has room.  Otherwise the request is
+           shed: the answer is abandoned, and the peer sent a busy reply.'''
+        pending = (peer, message_identifier, procedure_name, answer)
+        if self.running_replies < self.max_concurrent_replies:
+            self.start_reply(*pending)
+        elif len(self.reply_backlog) < self.max_reply_backlog:
+            self.reply_backlog.append(pending)
+        else:
+            if asyncio.iscoroutine(answer):
+                answer.close()
+            else:
+                answer.cancel()
+            self.send_busy(peer, message_identifier, procedure_name)
+
+    def start_reply(self, peer, message_identifier, procedure_name, answer):
+        '''Runs a pending answer as a task, replying with its result once it finishes.'''
+        self.running_replies += 1
+        task = asyncio.ensure_future(answer)
+        task.add_done_callback(partial(self.reply_finished, peer, message_identifier, procedure_name))
+
+    def reply_finished(self, peer, message_identifier, procedure_name, task):
+        '''Sends the reply to a scheduled answer once it finishes, starting the next
+           answer in the reply_backlog.  An answer that failed gets no reply, like a
+           request that was never received.'''
+        self.running_replies -= 1
+        if self.reply_backlog:
+            self.start_reply(*self.reply_backlog.popleft())
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.warning('%s from %r failed: %r', procedure_name, peer, task.exception())
+            return
+        self.reply(peer, message_identifier, task.result(), procedure_name)
+
+    def send_busy(self, peer, message_identifier, procedure_name=None):
+        '''Refuses an RPC call, telling the peer this protocol is too busy to answer it.'''
+        message = self.codec.encode(('busy', message_identifier))
+        self.metrics.busy_sent(procedure_name, peer, len(message))
+        self.transport.sendto(message, peer)
 
     def reply_received(self, peer, message_identifier, answer):
         '''Handles a reply to an RPC.  May be overridden to pre-process a reply, or
            otherwise verify its authenticity.'''
-        logger.info('reply to message %r, answer %r', message_identifier, answer)
         if message_identifier in self.outstanding_requests:
             reply = self.outstanding_requests.pop(message_identifier)
-            reply.set_result(answer)
+            self.timeouts.cancel(message_identifier)
+            sent_to, _, sent_at, attempt, _ = self.transmissions.pop(message_identifier)
+            if attempt == 0:
+                self.round_trip_times.observe(sent_to, asyncio.get_event_loop().time() - sent_at)
+            if not reply.done():
+                reply.set_result(answer)
+
+    def busy_received(self, peer, message_identifier, size):
+        '''Handles a busy reply, failing the RPC with PeerBusy without waiting for it to
+           time out or retransmitting it.'''
+        if message_identifier not in self.outstanding_requests:
+            self.metrics.unmatched_replies += 1
+            return
+        reply = self.outstanding_requests.pop(message_identifier)
+        self.timeouts.cancel(message_identifier)
+        _, _, _, _, procedure_name = self.transmissions.pop(message_identifier)
+        self.metrics.busy_received(procedure_name, peer, size)
+        if not reply.done():
+            reply.set_exception(PeerBusy())
 
     def reply_timed_out(self, message_identifier):
-        '''Scheduled after each outbound request to enforce the wait timeout on RPCs.'''
+        '''Scheduled on the timer wheel after each outbound request to enforce the wait
+           timeout on RPCs, retransmitting the request if any retransmits remain.'''
         if message_identifier in self.outstanding_requests:
-            reply = self.outstanding_requests.pop(message_identifier)
-            reply.set_exception(socket.timeout)
+            reply = self.outstanding_requests[message_identifier]
+            peer, message, sent_at, attempt, procedure_name = self.transmissions[message_identifier]
+            if not reply.done():
+                self.round_trip_times.backoff(peer)
+                if attempt < self.retransmits:
+                    self.transmit(message_identifier, peer, message, attempt + 1, procedure_name)
+                    return
+                self.metrics.timed_out(procedure_name, peer)
+                reply.set_exception(socket.timeout)
+            del self.outstanding_requests[message_identifier]
+            del self.transmissions[message_identifier]
 
     def request(self, peer, procedure_name, *args, **kwargs):
         '''Issues an RPC to a remote peer, returning a future that may either yield
            the reply to the RPC, or a socket.timeout if the peer does not reply.'''
         message_identifier = get_random_identifier()
+        message = self.codec.encode(('request', message_identifier, procedure_name, args, kwargs))
+
         reply = asyncio.Future()
         self.outstanding_requests[message_identifier] = reply
+        self.transmit(message_identifier, peer, message, 0, procedure_name)
 
-        loop = asyncio.get_event_loop()
-        loop.call_later(self.reply_timeout, self.reply_timed_out, message_identifier)
+        return reply
 
-        message = pickle.dumps(('request', message_identifier, procedure_name, args, kwargs))
+    def transmit(self, message_identifier, peer, message, attempt, procedure_name):
+        '''Sends (or resends) an encoded request, and schedules its timeout.  Round trip
+           times are only sampled from requests answered on their first attempt, since a
+           reply to a retransmitted request could belong to any attempt.  The latency of
+           a reply is measured from the latest attempt.'''
+        self.transmissions[message_identifier] = (peer, message, asyncio.get_event_loop().time(), attempt,
+                                                  procedure_name)
+        timeout = self.round_trip_times.timeout(peer, self.reply_timeout)
+        self.timeouts.schedule(message_identifier, timeout, self.reply_timed_out, message_identifier)
+        self.metrics.request_sent(procedure_name, peer, len(message), attempt)
         self.transport.sendto(message, peer)
 
-        return reply
-
-    def reply(self, peer, message_identifier, answer):
-        '''Sends a reply to an earlier RPC call.'''
-        message = pickle.dumps(('reply', message_identifier, answer))
+    def reply(self, peer, message_identifier, answer, procedure_name=None):
+        '''Sends a reply to an earlier RPC call, to the procedure of the given name.'''
+        message = self.codec.encode(('reply', message_identifier, answer))
+        self.metrics.reply_sent(procedure_name, peer, len(message))
         self.transport.sendto(message, peer)
 
+    def start_tracing(self, **kwargs):
+        '''Starts keeping a MessageTrace of the protocol's traffic, returning it.  Keyword
+           arguments configure the trace.'''
+        if self.trace is None:
+            self.trace = MessageTrace(**kwargs)
+            self.metrics.add_hook(self.trace)
+        return self.trace
+
+    def stop_tracing(self):
+        '''Stops tracing, discarding the trace.'''
+        if self.trace is not None:
+            self.metrics.remove_hook(self.trace)
+            self.trace = None
+
+    def gauges(self):
+        '''Returns the current size of the protocol's state: the requests awaiting replies,
+           the timeouts scheduled for them, and the reply functions running and queued.'''
+        return {'outstanding_requests': len(self.outstanding_requests), 'timeouts': len(self.timeouts),
+                'running_replies': self.running_replies, 'reply_backlog': len(self.reply_backlog)}
+
+    def pack(self, build, entries):
+        '''Splits a list of entries into batches, so that the message returned by build for
+           each batch encodes to at most datagram_size bytes.  The size each entry adds is
+           measured by encoding it alone; an entry too large to share a datagram gets a
+           batch to itself.'''
+        base = len(self.codec.encode(build([])))
+        batches, size = [], base
+        for entry in entries:
+            entry_size = len(self.codec.encode(build([entry]))) - base
+            if not batches or size + entry_size > self.datagram_size:
+                batches.append([])
+                size = base
+            batches[-1].append(entry)
+            size += entry_size
+        return batches
+
+    def request_batches(self, procedure_name, entries, *args, **kwargs):
+        '''Splits a list of entries into batches for a procedure taking the given args
+           followed by a list of entries (and the given keyword arguments), each fitting a request
+           into datagram_size bytes.'''
+        message_identifier = get_random_identifier()
+        return self.pack(lambda batch: ('request', message_identifier, procedure_name, args + (batch,), kwargs),
+                         entries)
+
 
 class KademliaNode(DatagramRPCProtocol):
     '''Implements the Kademlia protocol with the four primitive RPCs (ping, store, find_node, find_value),
-       and the three iterative procedures (lookup_node, get, put).'''
+       and the three iterative procedures (lookup_node, get, put).  The batched store_many and
+       find_values RPCs, and the store_chunk and find_chunk RPCs that carry values too large for one
+       datagram, extend the protocol, falling back to the primitives with peers that lack them.'''
+
+    extended_procedures = ('find_values', 'store_many', 'store_chunk', 'find_chunk')
 
-    def __init__(self, alpha=3, k=20, identifier=None):
+    def __init__(self, alpha=3, k=20, identifier=None, stale_timeout=1, routing_table_class=None, storage=None,
+                 cache_ttl=3600, value_cache=None, lookup_reuse=10, clock=time.monotonic, **kwargs):
         '''Initializes a Kademlia node, with the optional configuration parameters alpha and k (see the
-           Kademlia paper for details on these constants).'''
+           Kademlia paper for details on these constants).  During lookups, a peer that has not
+           answered within its expected round trip time (or stale_timeout seconds, for peers never
+           heard from) is considered stale, and the lookup moves on without waiting for it.  The
+           routing_table_class may be RoutingTable (the default) or SplittingRoutingTable.  The storage
+           defaults to a Storage expiring values after 24 hours, as in the Kademlia paper.  Values
+           found by get are cached along the lookup path for up to cache_ttl seconds, and locally in
+           the value_cache, which defaults to a ValueCache.  The peers found by a node lookup are reused
+           for lookup_reuse seconds by lookups of the same or nearby keys.  The default storage,
+           value_cache and incoming transfers keep time by clock (a node on a SimulatedEventLoop
+           should be given the loop's time).  Any other keyword arguments configure the
+           DatagramRPCProtocol.'''
         if identifier is None:
             identifier = get_random_identifier()
         self.identifier = identifier
-        self.routing_table = RoutingTable(self.identifier, k=k)
+        routing_table_class = routing_table_class or RoutingTable
+        self.routing_table = routing_table_class(self.identifier, k=k)
         self.k = k
         self.alpha = alpha
-        self.storage = Storage()
-        super(KademliaNode, self).__init__()
+        self.stale_timeout = stale_timeout
+        self.cache_ttl = cache_ttl
+        self.storage = storage if storage is not None else Storage(default_ttl=86400, clock=clock)
+        self.value_cache = value_cache if value_cache is not None else ValueCache(clock=clock)
+        self.pending_gets = {}
+        self.legacy_peers = OrderedDict()
+        self.legacy_ttl = 3600
+        self.max_legacy_peers = 1024
+        self.extended_peers = OrderedDict()
+        self.incoming = IncomingTransfers(clock=clock)
+        self.serialized_values = OrderedDict()
+        self.chunk_window = 8
+        self.chunk_retries = 2
+        self.lookup_reuse = lookup_reuse
+        self.lookups_in_flight = {}
+        self.recent_lookups = OrderedDict()
+        self.lookup_stats = {'lookups': 0, 'coalesced': 0, 'reused': 0, 'seeded': 0}
+        self.published = {}
+        self.liveness_checks = {}
+        self.maintenance = None
+        self.republisher = None
+        self.snapshotter = None
+        super(KademliaNode, self).__init__(**kwargs)
+
+    def start_maintenance(self, **kwargs):
+        '''Starts refreshing idle buckets in the background, returning the MaintenanceScheduler.
+           Keyword arguments configure the scheduler.'''
+        if self.maintenance is None:
+            self.maintenance = MaintenanceScheduler(self, **kwargs)
+            self.maintenance.start()
+        return self.maintenance
+
+    def stop_maintenance(self):
+        '''Stops any background maintenance.'''
+        if self.maintenance is not None:
+            self.maintenance.stop()
+            self.maintenance = None
+
+    def start_republishing(self, **kwargs):
+        '''Starts republishing and replicating values in the background, returning the Republisher.
+           Keyword arguments configure the republisher.'''
+        if self.republisher is None:
+            self.republisher = Republisher(self, **kwargs)
+            self.republisher.start()
+        return self.republisher
+
+    def stop_republishing(self):
+        '''Stops any background republishing.'''
+        if self.republisher is not None:
+            self.republisher.stop()
+            self.republisher = None
+
+    def start_snapshots(self, path, **kwargs):
+        '''Starts saving snapshots of the routing table to path in the background, returning the
+           Snapshotter.  Keyword arguments configure the snapshotter.'''
+        if self.snapshotter is None:
+            self.snapshotter = Snapshotter(self, path, **kwargs)
+            self.snapshotter.start()
+        return self.snapshotter
+
+    def stop_snapshots(self):
+        '''Stops any background snapshots, saving a final one.'''
+        if self.snapshotter is not None:
+            self.snapshotter.stop()
+            self.snapshotter = None
+
+    def gauges(self):
+        '''Extended with the size of the node's state: the peers in the routing_table, the fill
+           of each non-empty bucket by index, the peers in replacement caches, the entries and
+           bytes held in storage, and the lookups in flight.'''
+        gauges = super(KademliaNode, self).gauges()
+        gauges['peers'] = len(self.routing_table.index)
+        gauges['bucket_fill'] = {index: len(bucket) for index, bucket in enumerate(self.routing_table.buckets)
+                                 if bucket}
+        gauges['replacements'] = sum(len(cache) for cache in self.routing_table.replacement_caches)
+        gauges['storage_entries'] = len(self.storage.entries)
+        gauges['storage_bytes'] = self.storage.bytes
+        gauges['lookups_in_flight'] = len(self.lookups_in_flight)
+        return gauges
 
     def request_received(self, peer, message_identifier, procedure_name, args, kwargs):
-        '''Overridden to place all peers this node receives requests from in the routing_table.'''
-        peer_identifier = args[0]
-        self.routing_table.update_peer(peer_identifier, peer)
+        '''Overridden to place all peers this node receives requests from in the routing_table,
+           once the request has been accepted, and to remember the peers that send extended RPCs
+           in extended_peers.'''
+        peer_identifier = check_identifier(args[0])
         super(KademliaNode, self).request_received(peer, message_identifier, procedure_name, args, kwargs)
+        self.update_peer(peer_identifier, peer)
+        if procedure_name in self.extended_procedures:
+            self.extended_peers.pop(peer, None)
+            self.extended_peers[peer] = True
+            while len(self.extended_peers) > self.max_legacy_peers:
+                self.extended_peers.popitem(last=False)
 
     def reply_received(self, peer, message_identifier, answer):
         '''Overridden to place all peers this node sends replies to in the routing_table.'''
         peer_identifier, answer = answer
-        self.routing_table.update_peer(peer_identifier, peer)
+        check_identifier(peer_identifier)
+        self.update_peer(peer_identifier, peer)
         super(KademliaNode, self).reply_received(peer, message_identifier, answer)
 
+    def update_peer(self, peer_identifier, peer):
+        '''Places a peer this node has heard from in the routing_table.  When the peer's bucket is
+           full, the bucket's least-recently seen peer is pinged in the background, and only evicted
+           (promoting the newest replacement) if it fails to answer.'''
+        least_recently_seen = self.routing_table.update_peer(peer_identifier, peer)
+        if least_recently_seen is not None:
+            self.check_liveness(*least_recently_seen)
+
+    def check_liveness(self, peer_identifier, peer):
+        '''Starts pinging the given peer unless it is already being pinged, coalescing the checks
+           triggered while a bucket stays full.  Returns the task doing the check.'''
+        if peer_identifier not in self.liveness_checks:
+            self.liveness_checks[peer_identifier] = asyncio.ensure_future(self.confirm_peer(peer_identifier, peer))
+        return self.liveness_checks[peer_identifier]
+
+    @asyncio.coroutine
+    def confirm_peer(self, peer_identifier, peer):
+        '''Pings the given peer, forgetting it if it does not reply.  A reply refreshes the peer in
+           the routing_table on its own.  Returns True if the peer is alive.'''
+        try:
+            yield from self.ping(peer, self.identifier)
+            return True
+        except PeerBusy:
+            return True
+        except socket.timeout:
+            logger.info('evicting unresponsive peer %r at %r', peer_identifier, peer)
+            self.routing_table.forget_peer(peer_identifier)
+            return False
+        finally:
+            del self.liveness_checks[peer_identifier]
+
     @remote
     def ping(self, peer, peer_identifier):
         '''The primitive PING RPC.  Returns the node's identifier to the requesting node.'''
-        logger.info('ping(%r, %r)', peer, peer_identifier)
         return (self.identifier, self.identifier)
 
     @remote
-    def store(self, peer, peer_identifier, key, value):
-        '''The primitive STORE RPC.  Stores the given value, returning True if it was successful.'''
-        logger.info('store(%r, %r, %r, %r)', peer, peer_identifier, key, value)
-        self.storage[key] = value
+    def store(self, peer, peer_identifier, key, value, ttl=None):
+        '''The primitive STORE RPC.  Stores the given value, returning True if it was successful.  A
+           ttl shortens the time the value is kept, but never lengthens it past the storage's default.'''
+        self.store_locally(key, value, ttl)
         return (self.identifier, True)
 
+    def store_locally(self, key, value, ttl=None):
+        '''Stores a value a peer sent in this node's storage, never for longer than the storage's
+           default_ttl.  A ttl never cuts short the same value already stored here, so that a
+           replica sent with the lifetime it has left does not expire a fresher copy.'''
+        if ttl is not None and self.storage.default_ttl is not None:
+            ttl = min(ttl, self.storage.default_ttl)
+        if ttl is not None and key in self.storage and self.storage.peek(key) == value:
+            expires = self.storage.expires_at(key)
+            ttl = max(ttl, expires - self.storage.clock()) if expires is not None else None
+        self.storage.set(key, value, ttl=ttl)
+
     @remote
     def find_node(self, peer, peer_identifier, key):
         '''The primitive FIND_NODE RPC.  Returns the k-closest peers to a key that this node is aware of.'''
-        logger.info('find_node(%r, %r, %r)', peer, peer_identifier, key)
         return (self.identifier, self.routing_table.find_closest_peers(key, excluding=peer_identifier))
 
     @remote
     def find_value(self, peer, peer_identifier, key):
-        '''The primitive FIND_VALUE RPC.  Returns either the value of a key, or the k-closest peers to it.'''
-        logger.info('find_value(%r, %r, %r)', peer, peer_identifier, key)
+        '''The primitive FIND_VALUE RPC.  Returns either the value of a key, or the k-closest peers to it.
+           Only peers in extended_peers, which have sent this node an extended RPC, are answered that
+           a large value is chunked; any other peer may predate find_chunk, and is sent the value.'''
         if key in self.storage:
-            return (self.identifier, ('found', self.storage[key]))
+            return (self.identifier, self.value_result(key, chunked=peer in self.extended_peers))
         return (self.identifier, ('notfound', self.routing_table.find_closest_peers(key, excluding=peer_identifier)))
 
+    @remote
+    def store_many(self, peer, peer_identifier, items, ttl=None):
+        '''A batched STORE RPC.  Stores each of a list of (key, value) pairs, returning a list of
+           whether each was stored.  A ttl applies to every pair, as in store.'''
+        for key, value in items:
+            self.store_locally(key, value, ttl)
+        return (self.identifier, [True] * len(items))
+
+    @remote
+    def find_values(self, peer, peer_identifier, keys):
+        '''A batched FIND_VALUE RPC.  Returns a list with ('found', value) or ('notfound', None) for
+           each of the given keys, cut short to fit the reply in a datagram; the keys left
+           unanswered should be asked again.'''
+        results = [self.value_result(key) if key in self.storage else ('notfound', None) for key in keys]
+        message_identifier = get_random_identifier()
+        batches = self.pack(lambda batch: ('reply', message_identifier, (self.identifier, batch)), results)
+        return (self.identifier, batches[0] if batches else [])
+
+    @remote
+    def store_chunk(self, peer, peer_identifier, key, size, offset, data, raw, ttl=None):
+        '''Receives one chunk of a value too large for a single STORE, returning True if it was
+           accepted.  The value is assembled in place, and stored once its last chunk has arrived.
+           A raw value is kept as the bytes that were sent; any other value was sent encoded.'''
+        try:
+            buffer = self.incoming.receive((peer_identifier, key), size, offset, data)
+        except ValueError as e:
+            logger.warning('rejecting chunk of %r from %r: %s', key, peer, e)
+            return (self.identifier, False)
+        if buffer is not None:
+            self.store_locally(key, bytes(buffer) if raw else self.codec.decode(buffer)[2], ttl)
+        return (self.identifier, True)
+
+    @remote
+    def find_chunk(self, peer, peer_identifier, key, offset, length):
+        '''Returns length bytes of the sent form of a large stored value, from offset on, or None if
+           the value is not stored.'''
+        if key not in self.storage:
+            return (self.identifier, None)
+        data, _ = self.serialize_stored(key)
+        return (self.identifier, bytes(data[offset:offset + min(length, self.chunk_size())]))
+
+    def chunk_size(self):
+        '''Returns the most bytes of a large value that one chunk RPC carries.'''
+        return self.datagram_size - CHUNK_OVERHEAD
+
+    def serialize(self, key, value, version=None):
+        '''Returns the form a value for key is sent in when it is too large for one datagram, and
+           whether that is the raw value.  Bytes (and views of them) are sent as they are, anything
+           else encoded with the codec.  The encodings of the most recent large values are kept at
+           hand for as long as their version, the value itself unless another is given, is the same
+           object.'''
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return value, True
+        if version is None:
+            version = value
+        cached = self.serialized_values.get(key)
+        if cached is not None and cached[0] is version:
+            return cached[1], False
+        try:
+            data = self.codec.encode(('reply', 0, value))
+        except MessageTooLarge:
+            data = self.codec.encode_large(('reply', 0, value))
+        if len(data) > self.chunk_size():
+            self.serialized_values[key] = (version, data)
+            while len(self.serialized_values) > 16:
+                self.serialized_values.popitem(last=False)
+        return data, False
+
+    def serialize_stored(self, key):
+        '''Returns the sent form of the value stored for key, as serialize does, versioned by its
+           storage entry, so that the value is only read back from storage when that form is not
+           already at hand.'''
+        entry = self.storage.entries[key]
+        cached = self.serialized_values.get(key)
+        if cached is not None and cached[0] is entry:
+            return cached[1], False
+        return self.serialize(key, self.storage.peek(key), version=entry)
+
+    def value_result(self, key, chunked=True):
+        '''Returns the answer to a request for a stored value: ('found', value), or when the value is
+           too large for one datagram and chunked is true, ('chunked', (size, raw)) for fetching with
+           find_chunk.'''
+        value = self.storage[key]
+        if not chunked:
+            return ('found', value)
+        data, raw = self.serialize(key, value, version=self.storage.entries[key])
+        if len(data) > self.chunk_size():
+            return ('chunked', (len(data), raw))
+        return ('found', value)
+
+    @asyncio.coroutine
+    def store_value(self, peer, key, value, ttl=None):
+        '''Stores a value at a peer, returning True if it was accepted.  Values too large for one
+           datagram are sent in chunks with store_chunk, up to chunk_window at once, each retried up
+           to chunk_retries times; peers that lack it are sent a single (fragmented) store instead.'''
+        kwargs = {'ttl': ttl} if ttl is not None else {}
+        data, raw = self.serialize(key, value)
+        chunk_size = self.chunk_size()
+        if len(data) <= chunk_size or self.is_legacy(peer):
+            return (yield from self.store(peer, self.identifier, key, value, **kwargs))
+
+        view = memoryview(data)
+        window = asyncio.Semaphore(self.chunk_window)
+
+        @asyncio.coroutine
+        def send(offset):
+            yield from window.acquire()
+            try:
+                for attempt in range(self.chunk_retries + 1):
+                    try:
+                        return (yield from self.store_chunk(peer, self.identifier, key, len(data), offset,
+                                                            bytes(view[offset:offset + chunk_size]), raw, **kwargs))
+                    except socket.timeout:
+                        if attempt == self.chunk_retries:
+                            raise
+            finally:
+                window.release()
+
+        results = yield from asyncio.gather(*[send(offset) for offset in range(0, len(data), chunk_size)],
+                                            return_exceptions=True)
+        if all(result is True for result in results):
+            return True
+        if all(isinstance(result, socket.timeout) for result in results) and (yield from self.lacks_batching(peer)):
+            return (yield from self.store(peer, self.identifier, key, value, **kwargs))
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return False
+
+    @asyncio.coroutine
+    def fetch_value(self, peer, key, size, raw):
+        '''Fetches a value too large for one datagram from a peer with find_chunk, up to chunk_window
+           chunks at once, each retried up to chunk_retries times, assembling it in place.  Returns
+           None if the peer no longer has the value, and raises socket.timeout if it stops answering.'''
+        buffer = bytearray(size)
+        chunk_size = self.chunk_size()
+        window = asyncio.Semaphore(self.chunk_window)
+
+        @asyncio.coroutine
+        def fetch(offset):
+            yield from window.acquire()
+            try:
+                for attempt in range(self.chunk_retries + 1):
+                    try:
+                        data = yield from self.find_chunk(peer, self.identifier, key, offset, chunk_size)
+                        break
+                    except socket.timeout:
+                        if attempt == self.chunk_retries:
+                            raise
+            finally:
+                window.release()
+            if data is None or len(data) != min(chunk_size, size - offset):
+                return False
+            buffer[offset:offset + len(data)] = data
+            return True
+
+        fetched = yield from asyncio.gather(*[fetch(offset) for offset in range(0, size, chunk_size)])
+        if not all(fetched):
+            return None
+        return bytes(buffer) if raw else self.codec.decode(buffer)[2]
+
+    @asyncio.coroutine
+    def lookup_node(self, hashed_key, find_value=False, stats=None):
+        '''The iterative node lookup procedure to find either the nearest peers to or the value of a key.
+           Concurrent lookups of the same key share a single iterative_lookup, and the result of a
+           node lookup is reused for lookup_reuse seconds.  If a stats dictionary is given, the number
+           of RPCs sent is added to its 'rpcs' entry (only for the caller that started the lookup), the
+           number of hops the lookup took (the longest chain of referrals from the routing table to a
+           peer that replied) is set as its 'hops' entry, and when a value is found, the nearest peer
+           that replied without it is set as its 'nearest_without_value' entry, with the number of
+           peers the lookup asked that lie between that one and the peer holding the value as its
+           'closer_peers' entry.'''
+        loop = asyncio.get_event_loop()
+        if not find_value:
+            recent = self.recent_lookups.get(hashed_key)
+            if recent is not None and recent[0] > loop.time() - self.lookup_reuse:
+                self.lookup_stats['reused'] += 1
+                return list(recent[1])
+
+        flight_key = (hashed_key, find_value)
+        flight = self.lookups_in_flight.get(flight_key)
+        if flight is None:
+            shared_stats = stats if stats is not None else {}
+            task = asyncio.ensure_future(self.iterative_lookup(hashed_key, find_value, shared_stats))
+            flight = self.lookups_in_flight[flight_key] = [task, shared_stats, 0]
+            task.add_done_callback(lambda _: self.lookups_in_flight.pop(flight_key, None))
+            self.lookup_stats['lookups'] += 1
+        else:
+            self.lookup_stats['coalesced'] += 1
+        task, shared_stats, _ = flight
+
+        flight[2] += 1
+        try:
+            result = yield from asyncio.shield(task)
+        finally:
+            flight[2] -= 1
+            if not flight[2]:
+                task.cancel()
+        if stats is not None and stats is not shared_stats:
+            stats.update((name, value) for name, value in shared_stats.items() if name != 'rpcs')
+        return result
+
     @asyncio.coroutine
-    def lookup_node(self, hashed_key, find_value=False):
-        '''The iterative node lookup procedure to find either the nearest peers to or the value of a key.'''
+    def iterative_lookup(self, hashed_key, find_value, stats):
+        '''Carries out a lookup_node.  Up to alpha RPCs are kept in flight at once, and the lookup
+           finishes when the k closest peers seen so far have all replied.  Peers that are slower than
+           expected are set aside as stale (though not forgotten) so the lookup can carry on without
+           them.  The search starts from the routing table, along with the peers found by any recent
+           node lookup whose result surrounds this key.  The lookup's costs are recorded in stats,
+           which is always a dictionary.'''
         distance = lambda peer: peer[0] ^ hashed_key
-        contacted, dead = set(), set()
+        contacted, responded, stale, dead = set(), set(), set(), set()
         peers = {(peer_identifier, peer)
                  for peer_identifier, peer in
                  self.routing_table.find_closest_peers(hashed_key)}
         if not peers:
             raise KeyError(hashed_key, 'No peers available.')
 
-        while True:
-            uncontacted = peers - contacted
-            if not uncontacted:
-                break
+        loop = asyncio.get_event_loop()
+        seeds = self.recent_contacts(hashed_key, loop.time())
+        if seeds:
+            self.lookup_stats['seeded'] += 1
+            peers.update(seeds)
+        hops = dict.fromkeys(peers, 1)
+        self.routing_table.touch_bucket(hashed_key, loop.time())
+        in_flight, stale_at = {}, {}
+        try:
+            while True:
+                now = loop.time()
+                for future, (peer_identifier, peer) in in_flight.items():
+                    if stale_at[future] <= now:
+                        stale.add((peer_identifier, peer))
 
-            closest = sorted(uncontacted, key=distance)[:self.alpha]
-            for peer_identifier, peer in closest:
-                contacted.add((peer_identifier, peer))
-                try:
+                closest = sorted(peers - dead - stale, key=distance)[:self.k]
+                uncontacted = [p for p in closest if p not in contacted]
+                if not uncontacted and not any(p in closest for p in in_flight.values()):
+                    break
+
+                active = len([p for p in in_flight.values() if p not in stale])
+                for peer_identifier, peer in uncontacted[:self.alpha - active]:
+                    contacted.add((peer_identifier, peer))
                     if find_value:
-                        result, contacts = yield from self.find_value(peer, self.identifier, hashed_key)
-                        if result == 'found':
-                            return contacts
+                        rpc = self.find_value(peer, self.identifier, hashed_key)
                     else:
-                        contacts = yield from self.find_node(peer, self.identifier, hashed_key)
-                except socket.timeout:
-                    self.routing_table.forget_peer(peer_identifier)
-                    dead.add((peer_identifier, peer))
-                    continue
+                        rpc = self.find_node(peer, self.identifier, hashed_key)
+                    future = asyncio.ensure_future(rpc)
+                    in_flight[future] = (peer_identifier, peer)
+                    stale_at[future] = now + self.round_trip_times.expected(peer, self.stale_timeout)
 
-                for new_peer_identifier, new_peer in contacts:
-                    if new_peer_identifier == self.identifier:
+                waiting = [stale_at[f] for f, p in in_flight.items() if p not in stale]
+                timeout = max(0, min(waiting) - now) if waiting else None
+                done, _ = yield from asyncio.wait(in_flight, timeout=timeout,
+                                                  return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    peer_identifier, peer = in_flight.pop(future)
+                    del stale_at[future]
+                    stale.discard((peer_identifier, peer))
+                    try:
+                        if find_value:
+                            result, contacts = future.result()
+                            if result == 'chunked':
+                                contacts = yield from self.fetch_value(peer, hashed_key, *contacts)
+                                result, contacts = ('found', contacts) if contacts is not None else ('notfound', [])
+                            if result == 'found':
+                                stats['hops'] = max([hops[p] for p in responded] + [hops[(peer_identifier, peer)]])
+                                if responded:
+                                    nearest = min(responded, key=distance)
+                                    stats['nearest_without_value'] = nearest
+                                    holder = distance((peer_identifier, peer))
+                                    stats['closer_peers'] = len([p for p in contacted
+                                                                 if holder < distance(p) < distance(nearest)])
+                                return contacts
+                        else:
+                            contacts = future.result()
+                    except socket.timeout as e:
+                        if not isinstance(e, PeerBusy):
+                            self.routing_table.forget_peer(peer_identifier)
+                        dead.add((peer_identifier, peer))
                         continue
-                    peers.add((new_peer_identifier, new_peer))
+
+                    responded.add((peer_identifier, peer))
+                    for new_peer_identifier, new_peer in contacts:
+                        if new_peer_identifier == self.identifier:
+                            continue
+                        peers.add((new_peer_identifier, new_peer))
+                        hops.setdefault((new_peer_identifier, new_peer), hops[(peer_identifier, peer)] + 1)
+        finally:
+            for future in in_flight:
+                future.cancel()
+            stats['rpcs'] = stats.get('rpcs', 0) + len(contacted)
 
         if find_value:
             raise KeyError(hashed_key, 'Not found among any available peers.')
-        else:
-            return sorted(peers - dead, key=distance)[:self.k]
+        closest = sorted(responded, key=distance)[:self.k]
+        stats['hops'] = max([hops[p] for p in responded] or [0])
+        self.remember_lookup(hashed_key, closest, loop.time())
+        return closest
+
+    def remember_lookup(self, hashed_key, contacts, now, max_lookups=64):
+        '''Keeps the result of a node lookup at hand for lookup_reuse seconds.'''
+        self.recent_lookups.pop(hashed_key, None)
+        self.recent_lookups[hashed_key] = (now, contacts)
+        while self.recent_lookups:
+            oldest, (finished, _) = next(iter(self.recent_lookups.items()))
+            if finished > now - self.lookup_reuse and len(self.recent_lookups) <= max_lookups:
+                break
+            del self.recent_lookups[oldest]
+
+    def recent_contacts(self, hashed_key, now):
+        '''Returns the peers found by the recent node lookup nearest the given key, if the key falls
+           within the span of that lookup's result.'''
+        best = None
+        for recent_key, (finished, contacts) in self.recent_lookups.items():
+            if finished <= now - self.lookup_reuse or not contacts:
+                continue
+            span = max(peer_identifier ^ recent_key for peer_identifier, _ in contacts)
+            if recent_key ^ hashed_key < span and (best is None or recent_key ^ hashed_key < best[0]):
+                best = (recent_key ^ hashed_key, contacts)
+        return best[1] if best is not None else []
 
     @asyncio.coroutine
-    def put(self, raw_key, value):
+    def bootstrap(self, seeds, timeout=30):
+        '''Joins the network through the given seed peers, (ip, port) tuples.  Every seed is pinged at
+           once, then a lookup of this node's own identifier fills the nearby buckets, and finally every
+           farther bucket is refreshed, alpha buckets at a time.  The node is ready when this returns, at most
+           timeout seconds later (refreshes still running then are abandoned), with a summary of the
+           join.  Raises a KeyError if no seed answers.'''
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        deadline = started + timeout
+        stats = {}
+
+        seeds = list(seeds)
+        pings = yield from asyncio.gather(*[self.ping(seed, self.identifier) for seed in seeds],
+                                          return_exceptions=True)
+        answered = len([p for p in pings if not isinstance(p, Exception)])
+        if not answered:
+            raise KeyError(self.identifier, 'No seeds answered.')
+
+        try:
+            yield from asyncio.wait_for(self.lookup_node(self.identifier, stats=stats),
+                                        max(0, deadline - loop.time()))
+        except (KeyError, asyncio.TimeoutError):
+            pass
+
+        @asyncio.coroutine
+        def refresh(bucket_index):
+            yield from concurrency.acquire()
+            try:
+                lowest, highest = self.routing_table.bucket_range(bucket_index)
+                yield from self.lookup_node(random.randrange(lowest, highest), stats=stats)
+            except KeyError:
+                pass
+            finally:
+                concurrency.release()
+
+        concurrency = asyncio.Semaphore(self.alpha)
+        refreshes = [asyncio.ensure_future(refresh(bucket_index))
+                     for bucket_index in self.routing_table.buckets_to_refresh(started)]
+        if refreshes:
+            done, pending = yield from asyncio.wait(refreshes, timeout=max(0, deadline - loop.time()))
+            for refresh in pending:
+                refresh.cancel()
+            for refresh in done:
+                refresh.result()
+
+        summary = {
+            'seeds': answered,
+            'refreshes': len(refreshes),
+            'peers': len(self.routing_table.index),
+            'rpcs': stats.get('rpcs', 0) + len(seeds),
+            'seconds': loop.time() - started,
+        }
+        logger.info('bootstrapped: %r', summary)
+        return summary
+
+    @asyncio.coroutine
+    def warm_start(self, contacts, replacements=()):
+        '''Rejoins the network from the contacts of an earlier run, such as those of a snapshot
+           from load_snapshot.  The contacts (then the replacements) are placed in the routing_table
+           at once, so lookups can use them right away, then every peer placed in a bucket is pinged
+           in parallel, and those that fail to answer are evicted.  Returns a summary of the
+           revalidation.'''
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        for peer_identifier, peer in list(contacts) + list(replacements):
+            self.routing_table.update_peer(peer_identifier, peer)
+
+        checks = [self.check_liveness(*contact) for contact in self.routing_table.contacts()[0]]
+        alive = yield from asyncio.gather(*checks)
+        summary = {
+            'contacts': len(checks),
+            'alive': len([a for a in alive if a]),
+            'peers': len(self.routing_table.index),
+            'seconds': loop.time() - started,
+        }
+        logger.info('warm started: %r', summary)
+        return summary
+
+    @asyncio.coroutine
+    def put(self, raw_key, value, ttl=None):
         '''Given a plain key (usually a unicode) and a value, store it on the Kademlia network and
-           return the number of nodes who successfully accepted the value.'''
+           return the number of nodes who successfully accepted the value.  A ttl limits how many
+           seconds the value is kept.  While republishing is running, the value is remembered with
+           publish, to be republished until it expires or is unpublished.'''
         hashed_key = get_identifier(raw_key)
+        self.publish(hashed_key, value, ttl)
+        self.value_cache.found(hashed_key, value)
         peers = yield from self.lookup_node(hashed_key, find_value=False)
-        store_tasks = [self.store(peer, self.identifier, hashed_key, value) for _, peer in peers]
+        store_tasks = [self.store_value(peer, hashed_key, value, ttl) for _, peer in peers]
         results = yield from asyncio.gather(*store_tasks, return_exceptions=True)
         return len([r for r in results if r == True])
 
+    def publish(self, hashed_key, value, ttl=None):
+        '''Remembers a value this node put in published, as (value, published_at, expires_at), for
+           the republisher; values put while republishing is stopped are not remembered.'''
+        if self.republisher is None:
+            return
+        now = self.storage.clock()
+        self.published[hashed_key] = (value, now, now + ttl if ttl is not None else None)
+
+    def unpublish(self, raw_key):
+        '''Stops republishing the value of a plain key, returning True if it was being republished.
+           Copies already stored at peers are left to expire.'''
+        return self.published.pop(get_identifier(raw_key), None) is not None
+
     @asyncio.coroutine
     def get(self, raw_key):
-        '''Given a plain key (usually a unicode), find the value from the Kademlia network.'''
+        '''Given a plain key (usually a unicode), find the value from the Kademlia network.  Values
+           and misses are answered from the value_cache while it holds them, and concurrent gets of
+           the same key share a single lookup.  Raises a KeyError if the value cannot be found.'''
         hashed_key = get_identifier(raw_key)
         if hashed_key in self.storage:
             return self.storage[hashed_key]
-        answer = yield from self.lookup_node(hashed_key, find_value=True)
+        cached = self.value_cache.lookup(hashed_key)
+        if cached is not None:
+            found, value = cached
+            if not found:
+                raise KeyError(hashed_key, 'Recently not found among any available peers.')
+            return value
+        if hashed_key not in self.pending_gets:
+            self.pending_gets[hashed_key] = asyncio.ensure_future(self.lookup_value(hashed_key))
+        answer = yield from asyncio.shield(self.pending_gets[hashed_key])
         return answer
 
+    @asyncio.coroutine
+    def lookup_value(self, hashed_key):
+        '''Looks up the value of a key for get, and caches the result.  A found value is also
+           cached in the background at the nearest peer the lookup asked that did not have it, for a
+           cache_ttl halved for every peer asked between that one and the peer that had the value, so
+           that popular keys spread outward from the peers responsible for them.'''
+        stats = {}
+        try:
+            answer = yield from self.lookup_node(hashed_key, find_value=True, stats=stats)
+        except KeyError:
+            self.value_cache.not_found(hashed_key)
+            raise
+        finally:
+            self.pending_gets.pop(hashed_key, None)
+        self.value_cache.found(hashed_key, answer)
+        if 'nearest_without_value' in stats:
+            ttl = self.cache_ttl / 2 ** stats['closer_peers']
+            if ttl >= 1:
+                _, peer = stats['nearest_without_value']
+                asyncio.ensure_future(self.cache_value(peer, hashed_key, answer, ttl))
+        return answer
+
+    @asyncio.coroutine
+    def cache_value(self, peer, hashed_key, value, ttl):
+        '''Stores a value found by get at a peer along the lookup path, for ttl seconds.'''
+        try:
+            yield from self.store_value(peer, hashed_key, value, ttl=ttl)
+        except (socket.timeout, CodecError):
+            logger.info('could not cache %r at %r', hashed_key, peer)
+
+    @asyncio.coroutine
+    def put_many(self, items, concurrency=16, ttl=None):
+        '''Given a dictionary (or iterable of pairs) of plain keys and values, stores them all on the
+           Kademlia network, and returns a dictionary of each key to the number of nodes who
+           successfully accepted its value.  Keys in the same region of the identifier space share
+           one lookup, and each peer is sent all of its values with store_at.  Up to concurrency
+           lookups, and as many peers, are worked on at once.  The values are kept for ttl seconds,
+           and remembered for republishing, as in put.'''
+        hashed = {get_identifier(raw_key): (raw_key, value) for raw_key, value in dict(items).items()}
+        for hashed_key, (_, value) in hashed.items():
+            self.publish(hashed_key, value, ttl)
+            self.value_cache.found(hashed_key, value)
+
+        located = yield from self.locate_many(hashed, concurrency=concurrency)
+        batches = {}
+        for hashed_key, peers in located.items():
+            for _, peer in peers:
+                batches.setdefault(peer, []).append((hashed_key, hashed[hashed_key][1]))
+
+        accepted = {raw_key: 0 for raw_key, _ in hashed.values()}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        @asyncio.coroutine
+        def send(peer, batch):
+            yield from semaphore.acquire()
+            try:
+                stored = yield from self.store_at(peer, batch, ttl)
+            finally:
+                semaphore.release()
+            for (hashed_key, _), success in zip(batch, stored):
+                if success:
+                    accepted[hashed[hashed_key][0]] += 1
+
+        yield from asyncio.gather(*[send(peer, batch) for peer, batch in batches.items()])
+        return accepted
+
+    @asyncio.coroutine
+    def get_many(self, raw_keys, concurrency=16):
+        '''Given an iterable of plain keys, finds their values on the Kademlia network, and returns a
+           dictionary of each key that was found to its value.  Keys in the same region of the
+           identifier space share one lookup, then each key is asked of its alpha closest peers with
+           find_at.  Keys none of those peers hold fall back to get.  Up to concurrency lookups, and
+           as many peers, are worked on at once.'''
+        hashed = {get_identifier(raw_key): raw_key for raw_key in raw_keys}
+        values, remaining = {}, []
+        for hashed_key, raw_key in hashed.items():
+            if hashed_key in self.storage:
+                values[raw_key] = self.storage[hashed_key]
+                continue
+            cached = self.value_cache.lookup(hashed_key)
+            if cached is None:
+                remaining.append(hashed_key)
+            elif cached[0]:
+                values[raw_key] = cached[1]
+
+        located = yield from self.locate_many(remaining, concurrency=concurrency)
+        batches = {}
+        for hashed_key, peers in located.items():
+            for _, peer in peers[:self.alpha]:
+                batches.setdefault(peer, []).append(hashed_key)
+
+        found = {}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        @asyncio.coroutine
+        def ask(peer, keys):
+            yield from semaphore.acquire()
+            try:
+                values = yield from self.find_at(peer, keys)
+            finally:
+                semaphore.release()
+            for hashed_key, value in values.items():
+                found.setdefault(hashed_key, value)
+
+        @asyncio.coroutine
+        def fall_back(hashed_key):
+            yield from semaphore.acquire()
+            try:
+                found[hashed_key] = yield from self.get(hashed[hashed_key])
+            except KeyError:
+                pass
+            finally:
+                semaphore.release()
+
+        yield from asyncio.gather(*[ask(peer, keys) for peer, keys in batches.items()])
+        for hashed_key, value in found.items():
+            self.value_cache.found(hashed_key, value)
+        yield from asyncio.gather(*[fall_back(hashed_key) for hashed_key in remaining if hashed_key not in found])
+        values.update((hashed[hashed_key], value) for hashed_key, value in found.items())
+        return values
+
+    @asyncio.coroutine
+    def store_at(self, peer, items, ttl=None):
+        '''Stores a list of (key, value) pairs at a peer, for ttl seconds if one is given, with as few
+           store_many requests as will fit in datagrams, and returns a list of whether each pair was
+           stored.  Values too large for one
+           datagram are sent with store_value.  A peer that lets the first store_many time out twice
+           but answers a ping lacks the batched RPCs, so it is remembered in legacy_peers and sent
+           single-key stores instead.'''
+        stored = [False] * len(items)
+        chunk_size = self.chunk_size()
+        small = [i for i, (key, value) in enumerate(items) if len(self.serialize(key, value)[0]) <= chunk_size]
+        singles = sorted(set(range(len(items))) - set(small))
+        kwargs = {'ttl': ttl} if ttl is not None else {}
+        if self.is_legacy(peer):
+            singles = list(range(len(items)))
+        else:
+            position = 0
+            batches = self.request_batches('store_many', [items[i] for i in small], self.identifier, **kwargs)
+            for batch in batches:
+                indices = small[position:position + len(batch)]
+                position += len(batch)
+                try:
+                    answer = yield from self.store_many(peer, self.identifier, batch, **kwargs)
+                except socket.timeout:
+                    answer = None
+                    if position == len(batch):
+                        answer = yield from self.retry_batch(self.store_many, peer, batch, **kwargs)
+                        if answer is None and (yield from self.lacks_batching(peer)):
+                            singles.extend(small)
+                            break
+                    if answer is None:
+                        answer = [False] * len(batch)
+                for i, success in zip(indices, answer):
+                    stored[i] = success is True
+        results = yield from asyncio.gather(*[self.store_value(peer, *items[i], **kwargs) for i in singles],
+                                            return_exceptions=True)
+        for i, result in zip(singles, results):
+            stored[i] = result is True
+        return stored
+
+    @asyncio.coroutine
+    def find_at(self, peer, keys):
+        '''Asks a peer for the values of a list of keys with as few find_values requests as will fit in
+           datagrams, and returns a dictionary of the keys it holds to their values.  Peers lacking
+           the batched RPCs are asked with single-key find_value requests instead, as in store_at.'''
+        found, answered = {}, False
+        if not self.is_legacy(peer):
+            batches = self.request_batches('find_values', keys, self.identifier)
+            while batches:
+                batch = batches.pop(0)
+                try:
+                    results = yield from self.find_values(peer, self.identifier, batch)
+                except socket.timeout:
+                    results = None
+                    if not answered:
+                        results = yield from self.retry_batch(self.find_values, peer, batch)
+                        if results is None and (yield from self.lacks_batching(peer)):
+                            break
+                    if results is None:
+                        return found
+                if not results:
+                    return found
+                answered = True
+                for key, (status, value) in zip(batch, results):
+                    if status == 'found':
+                        found[key] = value
+                    elif status == 'chunked':
+                        try:
+                            value = yield from self.fetch_value(peer, key, *value)
+                        except socket.timeout:
+                            return found
+                        if value is not None:
+                            found[key] = value
+                if len(results) < len(batch):
+                    batches.insert(0, batch[len(results):])
+            else:
+                return found
+        results = yield from asyncio.gather(*[self.find_value(peer, self.identifier, key) for key in keys],
+                                            return_exceptions=True)
+        for key, result in zip(keys, results):
+            if not isinstance(result, Exception) and result[0] == 'found':
+                found[key] = result[1]
+        return found
+
+    @asyncio.coroutine
+    def retry_batch(self, rpc, peer, batch, **kwargs):
+        '''Sends a batched RPC that timed out to a peer once more, returning its answer, or None if
+           it times out again.'''
+        try:
+            return (yield from rpc(peer, self.identifier, batch, **kwargs))
+        except socket.timeout:
+            return None
+
+    @asyncio.coroutine
+    def lacks_batching(self, peer):
+        '''Checks, after a batched RPC to a peer has timed out twice, whether the peer is alive to
+           answer a ping, in which case it is added to legacy_peers.'''
+        try:
+            yield from self.ping(peer, self.identifier)
+        except socket.timeout:
+            return False
+        logger.info('%r does not answer batched RPCs, falling back to single-key RPCs', peer)
+        self.legacy_peers.pop(peer, None)
+        self.legacy_peers[peer] = asyncio.get_event_loop().time()
+        while len(self.legacy_peers) > self.max_legacy_peers:
+            self.legacy_peers.popitem(last=False)
+        return True
+
+    def is_legacy(self, peer):
+        '''Returns True if the peer was found to lack the batched RPCs within the last legacy_ttl
+           seconds.  Peers are checked again after that, in case they have been upgraded (or were
+           only unlucky with lost datagrams).'''
+        marked_at = self.legacy_peers.get(peer)
+        if marked_at is None:
+            return False
+        if marked_at <= asyncio.get_event_loop().time() - self.legacy_ttl:
+            del self.legacy_peers[peer]
+            return False
+        return True
+
+    @asyncio.coroutine
+    def locate_many(self, hashed_keys, prefix_bits=None, concurrency=16):
+        '''Finds the k closest peers to each of the given keys.  Keys sharing their first prefix_bits
+           bits share one lookup, for their middle key, and each key's closest peers are picked from
+           its result and the routing table.  Unless given, prefix_bits is estimated from a first
+           lookup, as the bits its k closest peers share with its key.  Up to concurrency lookups are
+           in flight at once.  Returns a dictionary of each key to its closest peers, leaving out keys
+           whose lookup failed.'''
+        hashed_keys = sorted(hashed_keys)
+        if not hashed_keys:
+            return {}
+        if prefix_bits is None:
+            key = hashed_keys[len(hashed_keys) // 2]
+            try:
+                peers = yield from self.lookup_node(key)
+            except KeyError:
+                return {}
+            span = max([peer_identifier ^ key for peer_identifier, _ in peers] or [0])
+            prefix_bits = max(0, 160 - span.bit_length())
+
+        groups = {}
+        for hashed_key in hashed_keys:
+            groups.setdefault(hashed_key >> (160 - prefix_bits), []).append(hashed_key)
+        located = {}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        @asyncio.coroutine
+        def locate(keys):
+            yield from semaphore.acquire()
+            try:
+                peers = yield from self.lookup_node(keys[len(keys) // 2])
+            except KeyError:
+                return
+            finally:
+                semaphore.release()
+            for hashed_key in keys:
+                candidates = set(peers) | set(self.routing_table.find_closest_peers(hashed_key))
+                located[hashed_key] = sorted(candidates, key=lambda peer: peer[0] ^ hashed_key)[:self.k]
+
+        yield from asyncio.gather(*[locate(keys) for keys in groups.values()])
+        return located
+
 
 class RoutingTable(object):
     '''Implements the routing table described in the Kademlia paper.  Peers are organized
        by their XOR distance from the given node, and the most recently contacted peers
-       are kept easily at hand.'''
+       are kept easily at hand.  The identifiers of all peers in the buckets are also kept
+       in a sorted index, to answer closest-peer queries exactly.'''
 
     def __init__(self, node_identifier, k=20):
         '''Initializes a RoutingTable with the node_identifier of a node, and the desired
            k value (defaults to 20, as indicated in the Kademlia paper).'''
         self.node_identifier = node_identifier
         self.k = k
-        self.buckets = [OrderedDict() for _ in range(160)]
-        self.replacement_caches = [OrderedDict() for _ in range(160)]
+        self.buckets = Buckets(160)
+        self.replacement_caches = Buckets(160)
+        self.index = []
+        self.lookup_times = {}
         super(RoutingTable, self).__init__()
 
     def distance(self, peer_identifier):
@@ -258,8 +1280,35 @@ class RoutingTable(object):
             raise ValueError('peer_identifier should be a number between 0 and 2*160-1.')
         return 160 - self.distance(peer_identifier).bit_length()
 
+    def bucket_range(self, bucket_index):
+        '''Returns the (lowest, highest + 1) identifiers covered by the given bucket.'''
+        bit = 159 - bucket_index
+        lowest = (self.node_identifier ^ (1 << bit)) >> bit << bit
+        return lowest, lowest + (1 << bit)
+
+    def touch_bucket(self, key, now):
+        '''Records that a lookup for the given key was performed at time now, which keeps the
+           bucket covering the key from needing a refresh.'''
+        bucket_index = self.bucket_index(key)
+        if bucket_index < len(self.buckets):
+            self.lookup_times[self.bucket_range(bucket_index)[0]] = now
+
+    def refreshable_buckets(self):
+        '''Returns the indices of the buckets worth refreshing: those from the farthest bucket
+           down to the nearest one holding any peers, since nearer buckets are likely empty.'''
+        occupied = [i for i, bucket in self.buckets.allocated.items() if bucket]
+        return range(max(occupied) + 1) if occupied else range(0)
+
+    def buckets_to_refresh(self, before):
+        '''Returns the indices of the refreshable buckets with no lookup since the time before.'''
+        return [i for i in self.refreshable_buckets()
+                if self.lookup_times.get(self.bucket_range(i)[0], 0) < before]
+
     def update_peer(self, peer_identifier, peer):
-        '''Adds or updates a peer that this node has recently communicated with.'''
+        '''Adds or updates a peer that this node has recently communicated with.  If the
+           peer's bucket is full, the peer goes to the bucket's replacement cache, and the
+           bucket's least-recently seen (peer_identifier, peer) is returned so that the
+           caller may check whether it is still alive.'''
         if peer_identifier == self.node_identifier:
             return
 
@@ -270,11 +1319,13 @@ class RoutingTable(object):
             bucket[peer_identifier] = peer
         elif len(bucket) < self.k:
             bucket[peer_identifier] = peer
+            insort(self.index, peer_identifier)
         else:
             replacement_cache = self.replacement_caches[bucket_index]
             if peer_identifier in replacement_cache:
                 del replacement_cache[peer_identifier]
             replacement_cache[peer_identifier] = peer
+            return next(iter(bucket.items()))
 
     def forget_peer(self, peer_identifier):
         '''Removes a peer from the Routing Table, possibly rotating in a standby peer this
@@ -283,40 +1334,234 @@ class RoutingTable(object):
             return
 
         bucket_index = self.bucket_index(peer_identifier)
-        bucket = self.buckets[bucket_index]
-        replacement_cache = self.replacement_caches[bucket_index]
+        bucket = self.buckets.get(bucket_index)
+        replacement_cache = self.replacement_caches.get(bucket_index)
         if peer_identifier in bucket:
             del bucket[peer_identifier]
+            del self.index[bisect_left(self.index, peer_identifier)]
             if len(replacement_cache):
                 replacement_identifier, replacement_peer = replacement_cache.popitem()
                 bucket[replacement_identifier] = replacement_peer
+                insort(self.index, replacement_identifier)
+                self.replacement_caches.release(bucket_index)
+            self.buckets.release(bucket_index)
 
     def find_closest_peers(self, key, excluding=None, k=None):
         '''Returns the k-closest peers this node is aware of, excluding the optional
            identifier given as the excluding keyword argument.  If k peers aren't known,
-           will return all nodes this node is aware of.'''
-        peers = []
+           will return all nodes this node is aware of.  Peers are ordered by their XOR
+           distance from the key, closest first.'''
         k = k or self.k
-        farther = range(self.bucket_index(key), -1, -1)
-        closer = range(self.bucket_index(key) + 1, 160, 1)
-        for f, c in zip_longest(farther, closer):
-            for i in (f, c):
-                if i is None:
-                    continue
-                bucket = self.buckets[i]
-                for peer_identifier in reversed(bucket):
-                    if peer_identifier == excluding:
-                        continue
-                    peers.append((peer_identifier, bucket[peer_identifier]))
-                    if len(peers) == k:
-                        return peers
-        return peers
+        if excluding is not None and excluding != self.node_identifier and self.has_peer(excluding):
+            identifiers = find_closest_identifiers(self.index, key, k + 1)
+            identifiers = [i for i in identifiers if i != excluding][:k]
+        else:
+            identifiers = find_closest_identifiers(self.index, key, k)
+        return [(i, self.buckets[self.bucket_index(i)][i]) for i in identifiers]
+
+    def has_peer(self, peer_identifier):
+        '''Returns True if the given identifier is in one of the buckets.'''
+        return peer_identifier in self.buckets.get(self.bucket_index(peer_identifier))
+
+    def contacts(self):
+        '''Returns a list of the (peer_identifier, peer) contacts in the buckets, and a list of
+           those in the replacement caches, each bucket's from least- to most-recently seen.'''
+        return ([contact for bucket in self.buckets for contact in bucket.items()],
+                [contact for cache in self.replacement_caches for contact in cache.items()])
+
 
+class SplittingRoutingTable(RoutingTable):
+    '''Implements the dynamic routing table from the full Kademlia paper.  It starts with a single
+       k-bucket covering the whole identifier space, and splits a full bucket in two when its range
+       covers the node's own identifier.  With relaxed splitting, a full bucket is also split when
+       the newcomer would be among the k peers closest to the node, so the node keeps every contact
+       in the smallest subtree around itself holding at least k peers.  With b > 1, buckets whose
+       depth is not a multiple of b are also split, per the paper's accelerated lookups.
 
-class Storage(dict):
-    '''The storage associated with a node.'''
-    pass
+       Buckets are numbered in order of the identifier ranges they cover; bucket_range returns
+       the range of each.'''
 
+    def __init__(self, node_identifier, k=20, relaxed=True, b=1):
+        '''Initializes a SplittingRoutingTable, with the same arguments as RoutingTable, plus
+           whether to split relaxed buckets and the paper's b parameter.'''
+        super(SplittingRoutingTable, self).__init__(node_identifier, k=k)
+        self.relaxed = relaxed
+        self.b = b
+        self.buckets = [OrderedDict()]
+        self.replacement_caches = [OrderedDict()]
+        self.bucket_bounds = [0]
+
+    def bucket_index(self, peer_identifier):
+        '''Returns the index of the k-bucket covering the provided identifier.'''
+        if not (0 <= peer_identifier < 2**160):
+            raise ValueError('peer_identifier should be a number between 0 and 2*160-1.')
+        return bisect_left(self.bucket_bounds, peer_identifier + 1) - 1
+
+    def bucket_range(self, bucket_index):
+        '''Returns the (lowest, highest + 1) identifiers covered by the given bucket.'''
+        if bucket_index + 1 < len(self.bucket_bounds):
+            return self.bucket_bounds[bucket_index], self.bucket_bounds[bucket_index + 1]
+        return self.bucket_bounds[bucket_index], 2**160
+
+    def update_peer(self, peer_identifier, peer):
+        '''Adds or updates a peer that this node has recently communicated with, splitting
+           the bucket it belongs in if that bucket is full and may be split.  Returns the
+           same as RoutingTable.update_peer.'''
+        if peer_identifier == self.node_identifier:
+            return
+
+        while True:
+            bucket_index = self.bucket_index(peer_identifier)
+            bucket = self.buckets[bucket_index]
+            if peer_identifier in bucket:
+                del bucket[peer_identifier]
+                bucket[peer_identifier] = peer
+                return
+            if len(bucket) < self.k:
+                bucket[peer_identifier] = peer
+                insort(self.index, peer_identifier)
+                return
+            if not self.should_split(bucket_index, peer_identifier):
+                break
+            self.split(bucket_index)
+
+        replacement_cache = self.replacement_caches[bucket_index]
+        if peer_identifier in replacement_cache:
+            del replacement_cache[peer_identifier]
+        replacement_cache[peer_identifier] = peer
+        return next(iter(bucket.items()))
+
+    def should_split(self, bucket_index, peer_identifier):
+        '''Determines whether the given full bucket should be split to make room for a peer.'''
+        lowest, highest = self.bucket_range(bucket_index)
+        if highest - lowest < 2:
+            return False
+        if lowest <= self.node_identifier < highest:
+            return True
+        depth = 160 - (highest - lowest).bit_length() + 1
+        if depth % self.b != 0:
+            return True
+        if self.relaxed:
+            closest = find_closest_identifiers(self.index, self.node_identifier, self.k)
+            if len(closest) < self.k or self.distance(peer_identifier) < self.distance(closest[-1]):
+                return True
+        return False
+
+    def split(self, bucket_index):
+        '''Splits the given bucket into two halves, topping up each half from its share of
+           the replacement cache.'''
+        lowest, highest = self.bucket_range(bucket_index)
+        middle = lowest + (highest - lowest) // 2
+        halves = []
+        for entries in (self.buckets[bucket_index], self.replacement_caches[bucket_index]):
+            lower, upper = OrderedDict(), OrderedDict()
+            for peer_identifier, peer in entries.items():
+                (lower if peer_identifier < middle else upper)[peer_identifier] = peer
+            halves.append((lower, upper))
+        (lower_bucket, upper_bucket), (lower_cache, upper_cache) = halves
+
+        for bucket, cache in ((lower_bucket, lower_cache), (upper_bucket, upper_cache)):
+            while cache and len(bucket) < self.k:
+                peer_identifier, peer = cache.popitem()
+                bucket[peer_identifier] = peer
+                insort(self.index, peer_identifier)
+
+        self.buckets[bucket_index:bucket_index + 1] = [lower_bucket, upper_bucket]
+        self.replacement_caches[bucket_index:bucket_index + 1] = [lower_cache, upper_cache]
+        self.bucket_bounds.insert(bucket_index + 1, middle)
+        if lowest in self.lookup_times:
+            self.lookup_times[middle] = self.lookup_times[lowest]
+
+    def forget_peer(self, peer_identifier):
+        '''Removes a peer from the Routing Table, possibly rotating in a standby peer this
+           node has recently communicated with.'''
+        if peer_identifier == self.node_identifier:
+            return
+
+        bucket_index = self.bucket_index(peer_identifier)
+        bucket = self.buckets[bucket_index]
+        replacement_cache = self.replacement_caches[bucket_index]
+        if peer_identifier in bucket:
+            del bucket[peer_identifier]
+            del self.index[bisect_left(self.index, peer_identifier)]
+            if len(replacement_cache):
+                replacement_identifier, replacement_peer = replacement_cache.popitem()
+                bucket[replacement_identifier] = replacement_peer
+                insort(self.index, replacement_identifier)
+
+    def has_peer(self, peer_identifier):
+        '''Returns True if the given identifier is in one of the buckets.'''
+        return peer_identifier in self.buckets[self.bucket_index(peer_identifier)]
+
+    def refreshable_buckets(self):
+        '''Returns the indices of the buckets worth refreshing, which is all of them.'''
+        return range(len(self.buckets))
+
+
+class Buckets(object):
+    '''A fixed-length sequence of OrderedDicts (k-buckets or replacement caches), only
+       allocating each one when it is first indexed.  Most of a node's 160 buckets stay
+       empty, so this keeps idle routing tables small.  Reading through get() or iterating
+       never allocates; unallocated buckets are presented as a shared, read-only empty
+       mapping.'''
+
+    __slots__ = ('length', 'allocated')
+
+    def __init__(self, length):
+        self.length = length
+        self.allocated = {}
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        '''Returns the bucket at index, allocating it if need be.'''
+        if not -self.length <= index < self.length:
+            raise IndexError('bucket index out of range')
+        index %= self.length
+        bucket = self.allocated.get(index)
+        if bucket is None:
+            bucket = self.allocated[index] = OrderedDict()
+        return bucket
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self.allocated.get(index, EMPTY_BUCKET)
+
+    def get(self, index):
+        '''Returns the bucket at index without allocating it.'''
+        return self.allocated.get(index, EMPTY_BUCKET)
+
+    def release(self, index):
+        '''Frees the bucket at index if it has become empty.'''
+        if index in self.allocated and not self.allocated[index]:
+            del self.allocated[index]
+
+
+def find_closest_identifiers(identifiers, key, count):
+    '''Given a sorted list of distinct identifiers, returns the count identifiers with the
+       smallest XOR distance to key, closest first.  Identifiers sharing a prefix are
+       contiguous in sorted order, so this descends the implicit binary trie, only stopping
+       at bits where the remaining range actually branches; it runs in O(count log count)
+       plus O(log n) bisections per branch.'''
+    closest = []
+    lo, hi = 0, len(identifiers)
+    while lo < hi and count > 0:
+        if hi - lo <= count:
+            closest.extend(sorted(identifiers[lo:hi], key=lambda i: i ^ key))
+            break
+        bit = (identifiers[lo] ^ identifiers[hi - 1]).bit_length() - 1
+        split = bisect_left(identifiers, identifiers[hi - 1] >> bit << bit, lo, hi)
+        if key >> bit & 1:
+            (near_lo, near_hi), (lo, hi) = (split, hi), (lo, split)
+        else:
+            (near_lo, near_hi), (lo, hi) = (lo, split), (split, hi)
+        if near_hi - near_lo >= count:
+            lo, hi = near_lo, near_hi
+        else:
+            closest.extend(sorted(identifiers[near_lo:near_hi], key=lambda i: i ^ key))
+            count -= near_hi - near_lo
+    return closest
 
 def get_identifier(key):
     '''Given a unicode or bytes value, returns the 160-bit SHA1 hash as an integer.'''
@@ -329,3 +1574,9 @@ def get_random_identifier():
     '''Produces a new 160-bit identifer from a random distribution.'''
     identifier = random.getrandbits(160)
     return get_identifier(identifier.to_bytes(20, byteorder='big', signed=False))
+
+def check_identifier(identifier):
+    '''Returns identifier if it is a 160-bit integer, raising CodecError otherwise.'''
+    if type(identifier) is not int or not 0 <= identifier < 2**160:
+        raise CodecError('Invalid identifier {!r}.'.format(identifier))
+    return identifier
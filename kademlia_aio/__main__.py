@@ -1,10 +1,22 @@
+import argparse
 import asyncio
-import sys
 
-from kademlia_aio.services import logging_to_console, setup_event_loop, start_node
+from kademlia_aio.services import logging_to_console, parse_address, setup_event_loop, start_node, stop_node
+
+parser = argparse.ArgumentParser(prog='python -m kademlia_aio', description='Runs a Kademlia node.')
+parser.add_argument('local_address')
+parser.add_argument('port')
+parser.add_argument('seeds', nargs='*', metavar='seed', help='an address:port to join the network through')
+parser.add_argument('--data-directory', help="where to keep the node's values and routing table across restarts")
+arguments = parser.parse_args()
 
 logging_to_console()
 setup_event_loop()
-start_node(*sys.argv[1:3])
+node = start_node(arguments.local_address, arguments.port, data_directory=arguments.data_directory)
+
+seeds = [parse_address(seed) for seed in arguments.seeds]
+if seeds:
+    asyncio.get_event_loop().run_until_complete(node.bootstrap(seeds))
 
 asyncio.get_event_loop().run_forever()
+stop_node(node)
@@ -0,0 +1,235 @@
+'''
+Benchmarks for kademlia_aio.  To run them all, run `python -m kademlia_aio.benchmark`, or name
+the ones to run, e.g. `python -m kademlia_aio.benchmark codec`.  With --json, the results are
+written to standard out as a single JSON object, keyed by benchmark name, for comparing runs.
+'''
+import asyncio
+from bisect import bisect
+from itertools import accumulate
+import json
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+
+from kademlia_aio import KademliaNode, RoutingTable, get_identifier, get_random_identifier
+from kademlia_aio.codec import BinaryCodec, PickleCodec
+from kademlia_aio.simulation import SimulatedEventLoop, SimulatedNetwork
+
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    '''Registers a benchmark function, which returns a dictionary of results.'''
+    BENCHMARKS[func.__name__] = func
+    return func
+
+def per_call(func, number):
+    '''Returns the mean wall-clock seconds per call of func over number calls.'''
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+@benchmark
+def codec(number=10000, k=20):
+    '''Compares BinaryCodec with PickleCodec on a find_node request and a k-contact reply.'''
+    procedure_names = ['find_node', 'find_value', 'ping', 'store']
+    contacts = [(get_random_identifier(), ('10.0.{}.{}'.format(i // 256, i % 256), 9000 + i))
+                for i in range(k)]
+    request = ('request', get_random_identifier(), 'find_node',
+               (get_random_identifier(), get_random_identifier()), {})
+    reply = ('reply', get_random_identifier(), (get_random_identifier(), contacts))
+
+    results = {}
+    for name, codec in (('pickle', PickleCodec()), ('binary', BinaryCodec(procedure_names))):
+        for kind, message in (('request', request), ('reply', reply)):
+            data = codec.encode(message)
+            results['{}_{}_bytes'.format(name, kind)] = len(data)
+            results['{}_{}_encode_us'.format(name, kind)] = per_call(lambda: codec.encode(message), number) * 1e6
+            results['{}_{}_decode_us'.format(name, kind)] = per_call(lambda: codec.decode(data), number) * 1e6
+    return results
+
+
+@benchmark
+def find_closest_peers(number=1000, k=20, sizes=(10000, 100000)):
+    '''Times RoutingTable.find_closest_peers against a full sort of every known contact.
+       Buckets are made large enough that every contact is kept.'''
+    results = {}
+    for size in sizes:
+        table = RoutingTable(get_random_identifier(), k=size)
+        for i in range(size):
+            table.update_peer(get_random_identifier(), ('10.0.0.1', i))
+        contacts = [(peer_identifier, peer) for bucket in table.buckets for peer_identifier, peer in bucket.items()]
+        keys = [get_random_identifier() for _ in range(number)]
+        indexed = per_call(lambda: [table.find_closest_peers(key, k=k) for key in keys], 1) / number
+        results['indexed_{}_us'.format(size)] = indexed * 1e6
+        linear_keys = keys[:max(1, number // 100)]
+        linear = per_call(lambda: [sorted(contacts, key=lambda c: c[0] ^ key)[:k] for key in linear_keys], 1)
+        results['linear_{}_us'.format(size)] = linear / len(linear_keys) * 1e6
+    return results
+
+
+@benchmark
+def memory(nodes=1000, contacts=(0, 100)):
+    '''Measures the memory allocated per KademliaNode, both idle and after learning a number
+       of random contacts.'''
+    results = {}
+    KademliaNode()
+    for count in contacts:
+        peers = [(get_random_identifier(), ('10.0.{}.{}'.format(i // 256, i % 256), 9000)) for i in range(count)]
+        tracemalloc.start()
+        try:
+            population = [KademliaNode() for _ in range(nodes)]
+            for node in population:
+                for peer_identifier, peer in peers:
+                    node.routing_table.update_peer(peer_identifier, peer)
+            allocated, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        results['node_{}_contacts_bytes'.format(count)] = allocated // nodes
+        del population
+    return results
+
+
+class MeasuredNode(KademliaNode):
+    '''A KademliaNode that counts the RPCs it sends, and the hops of its lookups, into the
+       given measurements dictionary, which may be shared by the nodes of one run.'''
+
+    def __init__(self, measurements, **kwargs):
+        self.measurements = measurements
+        super(MeasuredNode, self).__init__(**kwargs)
+
+    def request(self, peer, procedure_name, *args, **kwargs):
+        self.measurements['rpcs'] += 1
+        return super(MeasuredNode, self).request(peer, procedure_name, *args, **kwargs)
+
+    @asyncio.coroutine
+    def lookup_node(self, hashed_key, find_value=False, stats=None):
+        stats = stats if stats is not None else {}
+        try:
+            return (yield from super(MeasuredNode, self).lookup_node(hashed_key, find_value, stats))
+        finally:
+            if 'hops' in stats:
+                self.measurements['hops'].append(stats['hops'])
+
+
+def zipf(count, s, rng):
+    '''Returns a function choosing indices below count, the index i with probability in
+       proportion to 1 / (i + 1)**s.'''
+    weights = list(accumulate(1 / (i + 1) ** s for i in range(count)))
+    return lambda: min(bisect(weights, rng.random() * weights[-1]), count - 1)
+
+def percentile(values, fraction):
+    '''Returns the value at the given fraction of the sorted values.'''
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+@benchmark
+def lookups(nodes=500, operations=1000, keys=1000, zipf_s=1.0, churn=0.1, k=20, alpha=3,
+            latency=0.05, jitter=0.02, loss=0.01, seed=1):
+    '''Runs put, get and lookup_node operations on a simulated network of nodes, reporting
+       for each kind the median and 99th percentile latency (in simulated milliseconds), the
+       mean hops per lookup, RPCs, bytes on the wire and CPU microseconds per operation, and
+       the fraction that failed.  Every key is put first; then get and lookup_node operations
+       alternate, choosing keys with Zipfian popularity, while a churn fraction of the nodes
+       is replaced with new ones, spread over the run.'''
+    random.seed(seed)
+    rng = random.Random(seed)
+    original_loop = asyncio.get_event_loop()
+    loop = SimulatedEventLoop()
+    asyncio.set_event_loop(loop)
+    network = SimulatedNetwork(latency=latency, jitter=jitter, loss=loss, seed=seed)
+    measurements = {'rpcs': 0, 'hops': []}
+    addresses = iter(range(2**24))
+
+    def add_node():
+        factory = lambda: MeasuredNode(measurements, k=k, alpha=alpha, clock=loop.time)
+        return network.create_endpoint(factory, network.address(next(addresses)))[1]
+
+    @asyncio.coroutine
+    def join(population, seeds):
+        for i in range(0, len(population), 100):
+            yield from asyncio.gather(*[node.bootstrap(seeds) for node in population[i:i + 100]],
+                                      return_exceptions=True)
+
+    @asyncio.coroutine
+    def measure(kind, operation):
+        rpcs, hops, sent = measurements['rpcs'], len(measurements['hops']), network.stats['bytes']
+        cpu, started = time.process_time(), loop.time()
+        try:
+            yield from operation
+        except (KeyError, OSError):
+            samples[kind]['failures'] += 1
+        sample = samples[kind]
+        sample['latencies'].append(loop.time() - started)
+        sample['cpu'] += time.process_time() - cpu
+        sample['rpcs'] += measurements['rpcs'] - rpcs
+        sample['hops'].extend(measurements['hops'][hops:])
+        sample['bytes'] += network.stats['bytes'] - sent
+
+    @asyncio.coroutine
+    def workload():
+        population = [add_node() for _ in range(nodes)]
+        seeds = [node.transport.address for node in population[:5]]
+        yield from join(population, seeds)
+
+        raw_keys = ['key-{}'.format(i) for i in range(keys)]
+        for raw_key in raw_keys:
+            yield from measure('put', rng.choice(population).put(raw_key, raw_key))
+
+        popular = zipf(keys, zipf_s, rng)
+        churn_every = max(1, int(operations / (nodes * churn))) if churn else None
+        for i in range(operations):
+            if churn_every and i % churn_every == 0:
+                departing = population.pop(rng.randrange(5, len(population)))
+                departing.transport.close()
+                population.append(add_node())
+                yield from join(population[-1:], seeds)
+            node = rng.choice(population)
+            raw_key = raw_keys[popular()]
+            if i % 2:
+                yield from measure('lookup_node', node.lookup_node(get_identifier(raw_key)))
+            else:
+                yield from measure('get', node.get(raw_key))
+        yield from asyncio.sleep(60)
+
+    samples = {kind: {'latencies': [], 'hops': [], 'rpcs': 0, 'bytes': 0, 'cpu': 0.0, 'failures': 0}
+               for kind in ('put', 'get', 'lookup_node')}
+    try:
+        loop.run_until_complete(workload())
+    finally:
+        loop.close()
+        asyncio.set_event_loop(original_loop)
+
+    results = {'nodes': nodes, 'operations': operations, 'keys': keys}
+    for kind, sample in samples.items():
+        count = len(sample['latencies']) or 1
+        results[kind + '_p50_ms'] = percentile(sample['latencies'], 0.5) * 1e3
+        results[kind + '_p99_ms'] = percentile(sample['latencies'], 0.99) * 1e3
+        results[kind + '_hops'] = sum(sample['hops']) / (len(sample['hops']) or 1)
+        results[kind + '_rpcs'] = sample['rpcs'] / count
+        results[kind + '_bytes'] = sample['bytes'] / count
+        results[kind + '_cpu_us'] = sample['cpu'] / count * 1e6
+        results[kind + '_failures'] = sample['failures'] / count
+    return results
+
+
+def main(arguments):
+    json_output = '--json' in arguments
+    names = [argument for argument in arguments if argument != '--json']
+    results = {name: BENCHMARKS[name]() for name in names or sorted(BENCHMARKS)}
+    if json_output:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+    for name, benchmark_results in sorted(results.items()):
+        print(name)
+        for key, value in sorted(benchmark_results.items()):
+            if isinstance(value, float):
+                value = '{:.2f}'.format(value)
+            print('    {}: {}'.format(key, value))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
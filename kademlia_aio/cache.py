@@ -0,0 +1,63 @@
+'''
+A client-side cache of the values a KademliaNode has recently looked up.
+'''
+from collections import OrderedDict
+import time
+
+
+class ValueCache(object):
+    '''A bounded cache of recent get results, kept apart from the node's Storage so that it is
+       never served to peers or republished.  Found values are kept for ttl seconds, and keys
+       that could not be found for negative_ttl seconds; past max_entries, the least-recently
+       used results are evicted.'''
+
+    def __init__(self, max_entries=1024, ttl=60, negative_ttl=5, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0}
+        super(ValueCache, self).__init__()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.lookup(key, count=False) is not None
+
+    def lookup(self, key, count=True):
+        '''Returns a (found, value) tuple for a cached result, or None if there is none.'''
+        entry = self.entries.get(key)
+        if entry is not None:
+            found, value, expires = entry
+            if expires > self.clock():
+                self.entries.move_to_end(key)
+                if count:
+                    self.stats['hits' if found else 'negative_hits'] += 1
+                return found, value
+            del self.entries[key]
+        if count:
+            self.stats['misses'] += 1
+        return None
+
+    def found(self, key, value):
+        '''Caches a value found for the given key.'''
+        self.remember(key, True, value, self.ttl)
+
+    def not_found(self, key):
+        '''Caches the fact that the given key could not be found.'''
+        self.remember(key, False, None, self.negative_ttl)
+
+    def remember(self, key, found, value, ttl):
+        if not ttl or not self.max_entries:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (found, value, self.clock() + ttl)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def discard(self, key):
+        '''Forgets any result cached for the given key.'''
+        self.entries.pop(key, None)
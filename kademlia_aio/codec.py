@@ -0,0 +1,442 @@
+'''
+Wire codecs for DatagramRPCProtocol.  A codec turns the protocol's message tuples,
+
+    ('request', message_identifier, procedure_name, args, kwargs)
+    ('reply', message_identifier, answer)
+    ('busy', message_identifier)
+
+into datagram payloads and back again.  BinaryCodec is the default; PickleCodec is
+kept for comparison and must never be used on an untrusted network.
+'''
+import pickle
+import socket
+import struct
+import threading
+
+
+MAX_DATAGRAM_SIZE = 65507
+
+REQUEST, REPLY, BUSY = 0x01, 0x02, 0x03
+
+(TAG_NONE, TAG_FALSE, TAG_TRUE, TAG_INT, TAG_IDENTIFIER, TAG_BIGINT, TAG_FLOAT,
+ TAG_BYTES, TAG_STR, TAG_TUPLE, TAG_LIST, TAG_DICT, TAG_CONTACT4, TAG_CONTACT6) = range(14)
+
+HEADER = struct.Struct('!B20s')
+OPCODE = struct.Struct('!B')
+INT = struct.Struct('!Bq')
+IDENTIFIER = struct.Struct('!B20s')
+FLOAT = struct.Struct('!Bd')
+LENGTH = struct.Struct('!BI')
+COUNT = struct.Struct('!BH')
+CONTACT4 = struct.Struct('!B20s4sH')
+CONTACT6 = struct.Struct('!B20s16sH')
+
+UNPACK_LENGTH = struct.Struct('!I')
+UNPACK_COUNT = struct.Struct('!H')
+UNPACK_INT = struct.Struct('!q')
+UNPACK_FLOAT = struct.Struct('!d')
+UNPACK_CONTACT4 = struct.Struct('!20s4sH')
+UNPACK_CONTACT6 = struct.Struct('!20s16sH')
+
+MAX_DEPTH = 32
+MAX_COUNT = 2**16 - 1
+MAX_LENGTH = 2**32 - 1
+
+scratch = threading.local()
+shared_codecs = {}
+HOST_CACHE_SIZE = 4096
+IDENTIFIER_LIMIT = 2**160
+
+
+class CodecError(ValueError):
+    '''Raised when a message cannot be encoded, or a datagram cannot be decoded.'''
+    pass
+
+
+class MessageTooLarge(CodecError):
+    '''Raised when a message does not fit in the buffer it is being encoded into.'''
+    pass
+
+
+class PickleCodec(object):
+    '''Encodes messages with pickle.  Only suitable between trusted peers.'''
+
+    def encode(self, message):
+        '''Returns the payload bytes for the given message tuple.'''
+        return pickle.dumps(message)
+
+    def encode_large(self, message):
+        '''Returns the payload bytes for a message of any size.'''
+        return pickle.dumps(message)
+
+    def decode(self, data):
+        '''Returns the message tuple held in the given payload.'''
+        return pickle.loads(data)
+
+
+class BinaryCodec(object):
+    '''A compact, pickle-free binary encoding.  Each datagram is a one-byte direction, a
+       20-byte message identifier, then (for requests) a one-byte procedure opcode
+       followed by the arguments and keyword arguments, or (for replies) the answer.  A
+       busy reply, refusing a request, is the direction and identifier alone.
+
+       Values are tagged with a single byte.  160-bit integers are written as fixed-width
+       20-byte identifiers, strings and bytes are length-prefixed, and routing contacts of
+       the form (identifier, (ip, port)) are packed into 27 bytes for IPv4 or 39 bytes
+       for IPv6, so a find_node reply for k=20 is about 600 bytes.'''
+
+    def __init__(self, procedure_names=(), extensions=()):
+        '''Initializes a BinaryCodec, given the names of the procedures it may carry.  Both
+           ends of a conversation must agree on the names, since opcodes are assigned
+           in sorted order, followed by any extensions in the order given.  Procedures
+           added to a protocol later should be extensions, so that the opcodes of the
+           existing procedures stay the same for peers that lack the new ones.'''
+        self.procedure_names = sorted(set(procedure_names) - set(extensions)) + list(extensions)
+        self.opcodes = {name: opcode for opcode, name in enumerate(self.procedure_names)}
+        if len(self.procedure_names) > 256:
+            raise CodecError('BinaryCodec supports at most 256 procedures.')
+        self.packed_hosts, self.unpacked_hosts = {}, {}
+        self.encoders = {
+            type(None): self.encode_none,
+            bool: self.encode_bool,
+            int: self.encode_int,
+            float: self.encode_float,
+            bytes: self.encode_bytes,
+            bytearray: self.encode_bytes,
+            memoryview: self.encode_bytes,
+            str: self.encode_str,
+            tuple: self.encode_tuple,
+            list: self.encode_list,
+            dict: self.encode_dict,
+        }
+        self.decoders = [
+            self.decode_none, self.decode_false, self.decode_true, self.decode_int,
+            self.decode_identifier, self.decode_bigint, self.decode_float,
+            self.decode_bytes, self.decode_str, self.decode_tuple, self.decode_list,
+            self.decode_dict, self.decode_contact4, self.decode_contact6
+        ]
+
+    @classmethod
+    def shared(cls, procedure_names, extensions=()):
+        '''Returns a BinaryCodec for the given procedure names and extensions, shared with
+           every other caller asking for the same ones.'''
+        key = (tuple(sorted(set(procedure_names) - set(extensions))), tuple(extensions))
+        codec = shared_codecs.get(key)
+        if codec is None:
+            codec = shared_codecs[key] = cls(*key)
+        return codec
+
+    def encode(self, message):
+        '''Returns the payload bytes for the given message tuple, built in a preallocated
+           buffer shared by every codec on the current thread.'''
+        buffer = getattr(scratch, 'buffer', None)
+        if buffer is None:
+            buffer = scratch.buffer = bytearray(MAX_DATAGRAM_SIZE)
+        end = self.encode_into(message, buffer)
+        with memoryview(buffer) as view:
+            return bytes(view[:end])
+
+    def encode_large(self, message, limit=2**30):
+        '''Returns the payload for a message too large for a datagram, such as a value to be
+           sent in chunks, as a bytearray.  The buffer is doubled until the message fits, or
+           grows past limit bytes.  Messages that cannot be encoded at all fail at once.'''
+        size = MAX_DATAGRAM_SIZE
+        while True:
+            buffer = bytearray(size)
+            try:
+                end = self.encode_into(message, buffer)
+            except MessageTooLarge:
+                if size >= limit:
+                    raise
+                size *= 2
+                continue
+            del buffer[end:]
+            return buffer
+
+    def pack_value(self, value):
+        '''Returns the encoding of a single value, outside of any message, as a bytearray.'''
+        data = self.encode_large(('reply', 0, value))
+        del data[:HEADER.size]
+        return data
+
+    def unpack_value(self, data):
+        '''Returns the value encoded by pack_value, raising CodecError if it is malformed.'''
+        with memoryview(data) as view:
+            try:
+                value, offset = self.decode_value(view, 0, 0)
+            except (struct.error, IndexError, UnicodeDecodeError) as e:
+                raise CodecError('Malformed value: {}'.format(e))
+            if offset != len(view):
+                raise CodecError('Trailing bytes after value.')
+            return value
+
+    def encode_into(self, message, buffer, offset=0):
+        '''Encodes the message tuple into a preallocated, writable buffer starting at
+           offset, returning the offset just past the end of the message.'''
+        direction, message_identifier, *details = message
+        try:
+            if direction == 'request':
+                procedure_name, args, kwargs = details
+                HEADER.pack_into(buffer, offset, REQUEST, message_identifier.to_bytes(20, 'big'))
+                OPCODE.pack_into(buffer, offset + HEADER.size, self.opcodes[procedure_name])
+                offset = self.encode_value(tuple(args), buffer, offset + HEADER.size + OPCODE.size, 0)
+                return self.encode_value(kwargs, buffer, offset, 0)
+            elif direction == 'reply':
+                answer, = details
+                HEADER.pack_into(buffer, offset, REPLY, message_identifier.to_bytes(20, 'big'))
+                return self.encode_value(answer, buffer, offset + HEADER.size, 0)
+            elif direction == 'busy':
+                HEADER.pack_into(buffer, offset, BUSY, message_identifier.to_bytes(20, 'big'))
+                return offset + HEADER.size
+        except CodecError:
+            raise
+        except KeyError as e:
+            raise CodecError('Unknown procedure {!r}.'.format(e.args[0]))
+        except (ValueError, OverflowError) as e:
+            raise CodecError('Cannot encode message: {}'.format(e))
+        except (struct.error, IndexError) as e:
+            raise MessageTooLarge('Message does not fit in the buffer: {}'.format(e))
+        raise CodecError('Unknown message direction {!r}.'.format(direction))
+
+    def encode_value(self, value, buffer, offset, depth):
+        if depth > MAX_DEPTH:
+            raise CodecError('Value is nested too deeply.')
+        encoder = self.encoders.get(type(value))
+        if encoder is None:
+            for kind in (bool, int, float, bytes, str, tuple, list, dict):
+                if isinstance(value, kind):
+                    encoder = self.encoders[kind]
+                    break
+            else:
+                raise CodecError('Cannot encode values of type {}.'.format(type(value).__name__))
+        return encoder(value, buffer, offset, depth)
+
+    def encode_none(self, value, buffer, offset, depth):
+        OPCODE.pack_into(buffer, offset, TAG_NONE)
+        return offset + 1
+
+    def encode_bool(self, value, buffer, offset, depth):
+        OPCODE.pack_into(buffer, offset, TAG_TRUE if value else TAG_FALSE)
+        return offset + 1
+
+    def encode_int(self, value, buffer, offset, depth):
+        if -2**63 <= value < 2**63:
+            INT.pack_into(buffer, offset, TAG_INT, value)
+            return offset + INT.size
+        if 0 <= value < IDENTIFIER_LIMIT:
+            IDENTIFIER.pack_into(buffer, offset, TAG_IDENTIFIER, value.to_bytes(20, 'big'))
+            return offset + IDENTIFIER.size
+        data = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+        return self.encode_length_prefixed(TAG_BIGINT, data, buffer, offset)
+
+    def encode_float(self, value, buffer, offset, depth):
+        FLOAT.pack_into(buffer, offset, TAG_FLOAT, value)
+        return offset + FLOAT.size
+
+    def encode_bytes(self, value, buffer, offset, depth):
+        return self.encode_length_prefixed(TAG_BYTES, value, buffer, offset)
+
+    def encode_str(self, value, buffer, offset, depth):
+        return self.encode_length_prefixed(TAG_STR, value.encode('utf-8'), buffer, offset)
+
+    def encode_length_prefixed(self, tag, data, buffer, offset):
+        if len(data) > MAX_LENGTH:
+            raise CodecError('Cannot encode values longer than {} bytes.'.format(MAX_LENGTH))
+        LENGTH.pack_into(buffer, offset, tag, len(data))
+        start = offset + LENGTH.size
+        end = start + len(data)
+        if end > len(buffer):
+            raise MessageTooLarge('Message does not fit in the buffer.')
+        buffer[start:end] = data
+        return end
+
+    def encode_tuple(self, value, buffer, offset, depth):
+        if len(value) == 2:
+            end = self.encode_contact(value, buffer, offset)
+            if end is not None:
+                return end
+        return self.encode_sequence(TAG_TUPLE, value, buffer, offset, depth)
+
+    def encode_list(self, value, buffer, offset, depth):
+        return self.encode_sequence(TAG_LIST, value, buffer, offset, depth)
+
+    def encode_sequence(self, tag, value, buffer, offset, depth):
+        if len(value) > MAX_COUNT:
+            raise CodecError('Cannot encode sequences of more than {} items.'.format(MAX_COUNT))
+        COUNT.pack_into(buffer, offset, tag, len(value))
+        offset += COUNT.size
+        for item in value:
+            offset = self.encode_value(item, buffer, offset, depth + 1)
+        return offset
+
+    def encode_dict(self, value, buffer, offset, depth):
+        if len(value) > MAX_COUNT:
+            raise CodecError('Cannot encode dictionaries of more than {} items.'.format(MAX_COUNT))
+        COUNT.pack_into(buffer, offset, TAG_DICT, len(value))
+        offset += COUNT.size
+        for key, item in value.items():
+            offset = self.encode_value(key, buffer, offset, depth + 1)
+            offset = self.encode_value(item, buffer, offset, depth + 1)
+        return offset
+
+    def encode_contact(self, value, buffer, offset):
+        '''Packs a (identifier, (ip, port)) contact, returning None if the value is not one.'''
+        identifier, address = value
+        if type(identifier) is not int or not 0 <= identifier < IDENTIFIER_LIMIT:
+            return None
+        if type(address) is not tuple or len(address) != 2:
+            return None
+        host, port = address
+        if type(host) is not str or type(port) is not int or not 0 <= port < 2**16:
+            return None
+        packing = self.packed_hosts.get(host)
+        if packing is None:
+            packing = self.pack_host(host)
+        if not packing:
+            return None
+        contact, tag, packed = packing
+        contact.pack_into(buffer, offset, tag, identifier.to_bytes(20, 'big'), packed, port)
+        return offset + contact.size
+
+    def pack_host(self, host):
+        '''Works out (and caches) how to pack the given host string, or False if it is not
+           an IP address that survives the round trip.'''
+        packing = False
+        for family, contact, tag in ((socket.AF_INET, CONTACT4, TAG_CONTACT4),
+                                     (socket.AF_INET6, CONTACT6, TAG_CONTACT6)):
+            try:
+                packed = socket.inet_pton(family, host)
+            except (OSError, ValueError):
+                continue
+            if socket.inet_ntop(family, packed) == host:
+                packing = (contact, tag, packed)
+            break
+        if len(self.packed_hosts) >= HOST_CACHE_SIZE:
+            self.packed_hosts.clear()
+        self.packed_hosts[host] = packing
+        return packing
+
+    def decode(self, data):
+        '''Returns the message tuple held in the given payload, raising CodecError if the
+           payload is malformed.'''
+        with memoryview(data) as view:
+            try:
+                direction, message_identifier = HEADER.unpack_from(view, 0)
+                message_identifier = int.from_bytes(message_identifier, 'big')
+                if direction == REQUEST:
+                    opcode, = OPCODE.unpack_from(view, HEADER.size)
+                    procedure_name = self.procedure_names[opcode]
+                    args, offset = self.decode_value(view, HEADER.size + OPCODE.size, 0)
+                    kwargs, offset = self.decode_value(view, offset, 0)
+                    if type(args) is not tuple or type(kwargs) is not dict:
+                        raise CodecError('Malformed request arguments.')
+                    message = ('request', message_identifier, procedure_name, args, kwargs)
+                elif direction == REPLY:
+                    answer, offset = self.decode_value(view, HEADER.size, 0)
+                    message = ('reply', message_identifier, answer)
+                elif direction == BUSY:
+                    offset = HEADER.size
+                    message = ('busy', message_identifier)
+                else:
+                    raise CodecError('Unknown message direction {!r}.'.format(direction))
+            except (struct.error, IndexError, UnicodeDecodeError) as e:
+                raise CodecError('Malformed datagram: {}'.format(e))
+            if offset != len(view):
+                raise CodecError('Trailing bytes after message.')
+            return message
+
+    def decode_value(self, view, offset, depth):
+        if depth > MAX_DEPTH:
+            raise CodecError('Value is nested too deeply.')
+        tag = view[offset]
+        if tag >= len(self.decoders):
+            raise CodecError('Unknown value tag {!r}.'.format(tag))
+        return self.decoders[tag](view, offset + 1, depth)
+
+    def decode_none(self, view, offset, depth):
+        return None, offset
+
+    def decode_false(self, view, offset, depth):
+        return False, offset
+
+    def decode_true(self, view, offset, depth):
+        return True, offset
+
+    def decode_int(self, view, offset, depth):
+        return UNPACK_INT.unpack_from(view, offset)[0], offset + UNPACK_INT.size
+
+    def decode_identifier(self, view, offset, depth):
+        end = offset + 20
+        if end > len(view):
+            raise CodecError('Truncated identifier.')
+        return int.from_bytes(view[offset:end], 'big'), end
+
+    def decode_bigint(self, view, offset, depth):
+        data, end = self.decode_length_prefixed(view, offset)
+        return int.from_bytes(data, 'big', signed=True), end
+
+    def decode_float(self, view, offset, depth):
+        return UNPACK_FLOAT.unpack_from(view, offset)[0], offset + UNPACK_FLOAT.size
+
+    def decode_bytes(self, view, offset, depth):
+        data, end = self.decode_length_prefixed(view, offset)
+        return bytes(data), end
+
+    def decode_str(self, view, offset, depth):
+        data, end = self.decode_length_prefixed(view, offset)
+        return str(data, 'utf-8'), end
+
+    def decode_length_prefixed(self, view, offset):
+        length, = UNPACK_LENGTH.unpack_from(view, offset)
+        start = offset + UNPACK_LENGTH.size
+        end = start + length
+        if end > len(view):
+            raise CodecError('Truncated value.')
+        return view[start:end], end
+
+    def decode_tuple(self, view, offset, depth):
+        items, offset = self.decode_sequence(view, offset, depth)
+        return tuple(items), offset
+
+    def decode_list(self, view, offset, depth):
+        return self.decode_sequence(view, offset, depth)
+
+    def decode_sequence(self, view, offset, depth):
+        count, = UNPACK_COUNT.unpack_from(view, offset)
+        offset += UNPACK_COUNT.size
+        items = []
+        for _ in range(count):
+            item, offset = self.decode_value(view, offset, depth + 1)
+            items.append(item)
+        return items, offset
+
+    def decode_dict(self, view, offset, depth):
+        count, = UNPACK_COUNT.unpack_from(view, offset)
+        offset += UNPACK_COUNT.size
+        items = {}
+        for _ in range(count):
+            key, offset = self.decode_value(view, offset, depth + 1)
+            try:
+                hash(key)
+            except TypeError:
+                raise CodecError('Unhashable dictionary key.')
+            items[key], offset = self.decode_value(view, offset, depth + 1)
+        return items, offset
+
+    def decode_contact4(self, view, offset, depth):
+        identifier, packed, port = UNPACK_CONTACT4.unpack_from(view, offset)
+        contact = (int.from_bytes(identifier, 'big'), (self.unpack_host(socket.AF_INET, packed), port))
+        return contact, offset + UNPACK_CONTACT4.size
+
+    def decode_contact6(self, view, offset, depth):
+        identifier, packed, port = UNPACK_CONTACT6.unpack_from(view, offset)
+        contact = (int.from_bytes(identifier, 'big'), (self.unpack_host(socket.AF_INET6, packed), port))
+        return contact, offset + UNPACK_CONTACT6.size
+
+    def unpack_host(self, family, packed):
+        host = self.unpacked_hosts.get(packed)
+        if host is None:
+            if len(self.unpacked_hosts) >= HOST_CACHE_SIZE:
+                self.unpacked_hosts.clear()
+            host = self.unpacked_hosts[packed] = socket.inet_ntop(family, packed)
+        return host
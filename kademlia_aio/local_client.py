@@ -21,9 +21,8 @@ ports = range(9000, 9010)
 loop = asyncio.get_event_loop()
 node = start_node('127.0.0.1', 10000)
 
-def ping_all_local():
-    for port in ports:
-        loop.run_until_complete(node.ping(('127.0.0.1', port), node.identifier))
+def bootstrap_local():
+    return loop.run_until_complete(node.bootstrap(('127.0.0.1', port) for port in ports))
 
 def ping_one_local():
     loop.run_until_complete(node.ping(('127.0.0.1', random.choice(ports)), node.identifier))
@@ -13,16 +13,11 @@ logging_to_console()
 setup_event_loop()
 
 ports = range(9000, 9040)
+seeds = [('127.0.0.1', port) for port in ports if port % 3 == 0]
 
 loop = asyncio.get_event_loop()
 nodes = [start_node('127.0.0.1', i) for i in ports]
-for index, node in enumerate(nodes):
-    for port in ports:
-        if port == 9000 + index:
-            continue
-        if port % 3 != 0:
-            continue
-        loop.run_until_complete(node.ping(('127.0.0.1', port), node.identifier))
+loop.run_until_complete(asyncio.gather(*[node.bootstrap(seeds) for node in nodes]))
 
 logger.info("Network is connected...")
 loop.run_forever()
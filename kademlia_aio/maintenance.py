@@ -0,0 +1,118 @@
+'''
+Background maintenance for a KademliaNode, run on the event loop alongside its foreground
+traffic.
+'''
+import asyncio
+import logging
+import random
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    '''A token bucket that refills at rate tokens per second, up to burst tokens.  Work is
+       paid for after the fact with consume(), which waits for the balance to recover when
+       it has gone negative, so the long-run rate holds even when costs are only known
+       once the work is done.'''
+
+    def __init__(self, rate, burst=None, loop=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.loop = loop
+        self.tokens = self.burst
+        self.updated = None
+        super(RateLimiter, self).__init__()
+
+    def refill(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        now = self.loop.time()
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @asyncio.coroutine
+    def consume(self, tokens):
+        '''Spends the given number of tokens, waiting for the bucket to refill if it is
+           overdrawn.'''
+        self.refill()
+        self.tokens -= tokens
+        if self.tokens < 0:
+            yield from asyncio.sleep(-self.tokens / self.rate)
+            self.refill()
+
+
+class MaintenanceScheduler(object):
+    '''Keeps a node's routing table warm by refreshing, with a lookup_node for a random
+       identifier in its range, every bucket that has seen no lookup within refresh_interval
+       seconds.  Buckets are checked every check_interval seconds, the refreshes of a pass are
+       spread across the next check_interval, all delays are randomized by +/- jitter, and the
+       RPCs spent are held under rpc_rate per second.  The running cost is kept in stats.'''
+
+    def __init__(self, node, refresh_interval=3600, check_interval=300, jitter=0.2, rpc_rate=20):
+        self.node = node
+        self.refresh_interval = refresh_interval
+        self.check_interval = check_interval
+        self.jitter = jitter
+        self.limiter = RateLimiter(rpc_rate, burst=rpc_rate * 2)
+        self.task = None
+        self.stats = {'passes': 0, 'refreshes': 0, 'failures': 0, 'rpcs': 0, 'lookup_seconds': 0.0}
+        super(MaintenanceScheduler, self).__init__()
+
+    def jittered(self, delay):
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def start(self):
+        '''Starts running maintenance in the background, the first pass after a
+           refresh_interval.'''
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def stop(self):
+        '''Stops running maintenance.'''
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @asyncio.coroutine
+    def run(self):
+        yield from asyncio.sleep(self.jittered(self.refresh_interval))
+        while True:
+            yield from self.refresh_buckets()
+            yield from asyncio.sleep(self.jittered(self.check_interval))
+
+    @asyncio.coroutine
+    def refresh_buckets(self):
+        '''Makes one pass over the routing table, refreshing the buckets that need it.'''
+        loop = asyncio.get_event_loop()
+        table = self.node.routing_table
+        stale = table.buckets_to_refresh(loop.time() - self.refresh_interval)
+        self.stats['passes'] += 1
+        for bucket_index in stale:
+            yield from asyncio.sleep(self.jittered(self.check_interval / (len(stale) + 1)))
+            yield from self.refresh_bucket(bucket_index)
+
+    @asyncio.coroutine
+    def refresh_bucket(self, bucket_index):
+        '''Refreshes one bucket with a lookup for a random identifier in its range.'''
+        loop = asyncio.get_event_loop()
+        table = self.node.routing_table
+        if bucket_index >= len(table.buckets):
+            return
+        lowest, highest = table.bucket_range(bucket_index)
+        if table.lookup_times.get(lowest, 0) >= loop.time() - self.refresh_interval:
+            return
+        stats = {}
+        started = loop.time()
+        try:
+            yield from self.node.lookup_node(random.randrange(lowest, highest), stats=stats)
+            self.stats['refreshes'] += 1
+        except KeyError:
+            logger.info('could not refresh bucket %r: no peers available', bucket_index)
+            self.stats['failures'] += 1
+        finally:
+            self.stats['lookup_seconds'] += loop.time() - started
+            self.stats['rpcs'] += stats.get('rpcs', 0)
+        yield from self.limiter.consume(stats.get('rpcs', 0))
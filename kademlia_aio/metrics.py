@@ -0,0 +1,154 @@
+'''
+Per-procedure RPC metrics for DatagramRPCProtocol, with hooks for exporting them.
+'''
+from bisect import bisect_left
+
+
+# Upper bounds, in seconds, of the buckets of a LatencyHistogram; slower replies are counted
+# past the last one.
+LATENCY_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+
+
+class LatencyHistogram(object):
+    '''Counts latencies into buckets with fixed upper bounds, keeping their count and sum.'''
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, fraction):
+        '''Returns the upper bound of the bucket holding the given fraction of the latencies
+           counted, None if there are none, or infinity if it is past the last bound.'''
+        if not self.count:
+            return None
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'buckets': dict(zip(self.bounds + ('inf',), self.counts))}
+
+
+class ProcedureMetrics(object):
+    '''The traffic of one procedure: requests and replies sent and received, retransmitted
+       requests, requests that timed out, requests this protocol shed with a busy reply and
+       requests refused by busy peers, the bytes in and out, and the latencies of replies.'''
+
+    __slots__ = ('requests_sent', 'requests_received', 'replies_sent', 'replies_received',
+                 'retransmits', 'timeouts', 'shed', 'busy', 'bytes_in', 'bytes_out', 'latency')
+
+    def __init__(self):
+        self.requests_sent = self.requests_received = self.replies_sent = self.replies_received = 0
+        self.retransmits = self.timeouts = self.shed = self.busy = self.bytes_in = self.bytes_out = 0
+        self.latency = LatencyHistogram()
+
+    def snapshot(self):
+        snapshot = {name: getattr(self, name) for name in self.__slots__ if name != 'latency'}
+        snapshot['latency'] = self.latency.snapshot()
+        return snapshot
+
+
+class RPCMetrics(object):
+    '''Counts a protocol's traffic per procedure, in a ProcedureMetrics for each, along with
+       the datagrams dropped as malformed and the replies that matched no outstanding request.
+
+       Hooks added with add_hook are called for every event as hook(event, procedure_name,
+       peer, size, latency), where event is one of 'request_sent', 'request_received',
+       'reply_sent', 'reply_received', 'busy_sent', 'busy_received' or 'timeout', size is the
+       datagram's bytes (or 0 for a timeout), and latency is the seconds a reply took (or
+       None).  With no hooks, an event costs a few counter updates.'''
+
+    def __init__(self):
+        self.procedures = {}
+        self.malformed = 0
+        self.unmatched_replies = 0
+        self.hooks = []
+        super(RPCMetrics, self).__init__()
+
+    def procedure(self, procedure_name):
+        '''Returns the ProcedureMetrics for the given procedure.'''
+        metrics = self.procedures.get(procedure_name)
+        if metrics is None:
+            metrics = self.procedures[procedure_name] = ProcedureMetrics()
+        return metrics
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def request_sent(self, procedure_name, peer, size, attempt):
+        metrics = self.procedure(procedure_name)
+        if attempt:
+            metrics.retransmits += 1
+        else:
+            metrics.requests_sent += 1
+        metrics.bytes_out += size
+        if self.hooks:
+            self.call_hooks('request_sent', procedure_name, peer, size, None)
+
+    def request_received(self, procedure_name, peer, size):
+        metrics = self.procedure(procedure_name)
+        metrics.requests_received += 1
+        metrics.bytes_in += size
+        if self.hooks:
+            self.call_hooks('request_received', procedure_name, peer, size, None)
+
+    def reply_sent(self, procedure_name, peer, size):
+        metrics = self.procedure(procedure_name)
+        metrics.replies_sent += 1
+        metrics.bytes_out += size
+        if self.hooks:
+            self.call_hooks('reply_sent', procedure_name, peer, size, None)
+
+    def reply_received(self, procedure_name, peer, size, latency):
+        metrics = self.procedure(procedure_name)
+        metrics.replies_received += 1
+        metrics.bytes_in += size
+        metrics.latency.observe(latency)
+        if self.hooks:
+            self.call_hooks('reply_received', procedure_name, peer, size, latency)
+
+    def busy_sent(self, procedure_name, peer, size):
+        metrics = self.procedure(procedure_name)
+        metrics.shed += 1
+        metrics.bytes_out += size
+        if self.hooks:
+            self.call_hooks('busy_sent', procedure_name, peer, size, None)
+
+    def busy_received(self, procedure_name, peer, size):
+        metrics = self.procedure(procedure_name)
+        metrics.busy += 1
+        metrics.bytes_in += size
+        if self.hooks:
+            self.call_hooks('busy_received', procedure_name, peer, size, None)
+
+    def timed_out(self, procedure_name, peer):
+        self.procedure(procedure_name).timeouts += 1
+        if self.hooks:
+            self.call_hooks('timeout', procedure_name, peer, 0, None)
+
+    def call_hooks(self, event, procedure_name, peer, size, latency):
+        for hook in self.hooks:
+            hook(event, procedure_name, peer, size, latency)
+
+    def snapshot(self):
+        '''Returns the metrics as a dictionary of plain values, for exporting.'''
+        return {
+            'procedures': {name: metrics.snapshot() for name, metrics in self.procedures.items()},
+            'malformed': self.malformed,
+            'unmatched_replies': self.unmatched_replies,
+        }
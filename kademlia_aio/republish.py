@@ -0,0 +1,166 @@
+'''
+Republishing and replication of stored values for a KademliaNode, so that values survive the
+churn of the nodes responsible for them.
+'''
+import asyncio
+import logging
+import random
+
+from kademlia_aio.maintenance import RateLimiter
+from kademlia_aio.storage import sizeof
+
+
+logger = logging.getLogger(__name__)
+
+
+class Republisher(object):
+    '''Keeps a node's values alive on the network, as described in the Kademlia paper.  Every
+       value the node put() while republishing is republished to the k closest peers each
+       republish_interval seconds, until it expires or is unpublished, and every value the node
+       holds in its storage is replicated to the k closest peers each replicate_interval seconds,
+       unless it was stored again (by a peer doing the same) within that interval.  Replicas are
+       sent with the lifetime the value has left, so replication never extends it, and are
+       replicated again in turn until then.  Values stored for no longer than the node's
+       cache_ttl (such as the copies cached along lookup paths) are left to expire rather than
+       replicated.  Keys are checked every check_interval seconds.
+
+       Keys sharing their first prefix_bits bits are served by a single lookup, and the bytes
+       sent are held under bandwidth bytes per second, charging rpc_bytes for each RPC plus the
+       size of the value for each STORE.  The running cost is kept in stats.'''
+
+    def __init__(self, node, republish_interval=86400, replicate_interval=3600, check_interval=300,
+                 jitter=0.2, prefix_bits=16, bandwidth=65536, rpc_bytes=600):
+        self.node = node
+        self.republish_interval = republish_interval
+        self.replicate_interval = replicate_interval
+        self.check_interval = check_interval
+        self.jitter = jitter
+        self.prefix_bits = prefix_bits
+        self.rpc_bytes = rpc_bytes
+        self.limiter = RateLimiter(bandwidth, burst=bandwidth * 2)
+        self.replicated = {}
+        self.task = None
+        self.stats = {'passes': 0, 'lookups': 0, 'republished': 0, 'replicated': 0, 'skipped': 0,
+                      'failures': 0, 'rpcs': 0, 'bytes': 0}
+        super(Republisher, self).__init__()
+
+    def jittered(self, delay):
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def start(self):
+        '''Starts republishing in the background, the first pass after a check_interval.'''
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def stop(self):
+        '''Stops republishing.'''
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @asyncio.coroutine
+    def run(self):
+        while True:
+            yield from asyncio.sleep(self.jittered(self.check_interval))
+            yield from self.republish()
+
+    def due_keys(self):
+        '''Returns a dictionary of the keys that need to be sent out now to their values, and
+           marks them as sent.'''
+        storage = self.node.storage
+        now = storage.clock()
+        storage.purge_expired(now)
+        due = {}
+        for key, (value, published_at, expires) in list(self.node.published.items()):
+            if expires is not None and expires <= now:
+                del self.node.published[key]
+            elif published_at <= now - self.republish_interval:
+                due[key] = value
+                self.node.published[key] = (value, now, expires)
+                self.stats['republished'] += 1
+
+        for key in list(self.replicated):
+            if key not in storage.entries:
+                del self.replicated[key]
+        for key in storage:
+            if key in due or self.cached(key):
+                continue
+            last_sent = max(storage.stored_at(key), self.replicated.get(key, 0))
+            if last_sent > now - self.replicate_interval:
+                self.stats['skipped'] += 1
+                continue
+            due[key] = storage.peek(key)
+            self.replicated[key] = now
+            self.stats['replicated'] += 1
+        return due
+
+    def cached(self, key):
+        '''Returns True if a stored key is a copy cached along a lookup path: one stored with a
+           ttl of its own no longer than the node's cache_ttl.'''
+        storage = self.node.storage
+        if not storage.explicit_ttl(key):
+            return False
+        return storage.expires_at(key) - storage.stored_at(key) <= self.node.cache_ttl
+
+    def group_keys(self, keys):
+        '''Groups keys by their first prefix_bits bits, in key order.'''
+        groups = {}
+        for key in sorted(keys):
+            groups.setdefault(key >> (160 - self.prefix_bits), []).append(key)
+        return [groups[prefix] for prefix in sorted(groups)]
+
+    @asyncio.coroutine
+    def republish(self):
+        '''Makes one pass over the stored and published values, sending out those that are due.'''
+        due = self.due_keys()
+        self.stats['passes'] += 1
+        for keys in self.group_keys(due):
+            yield from self.republish_group(keys, due)
+
+    def remaining_ttl(self, key):
+        '''Returns the ttl to send a key with: the seconds its published or stored value has left,
+           or None for one that never expires, which is sent afresh.'''
+        storage = self.node.storage
+        if key in self.node.published:
+            expires = self.node.published[key][2]
+        elif key in storage.entries:
+            expires = storage.expires_at(key)
+        else:
+            return None
+        return expires - storage.clock() if expires is not None else None
+
+    @asyncio.coroutine
+    def republish_group(self, keys, values):
+        '''Stores each of the given keys, which share a prefix, at its k closest peers, finding
+           them with one lookup for the middle key.'''
+        node = self.node
+        stats = {}
+        try:
+            found = yield from node.lookup_node(keys[len(keys) // 2], stats=stats)
+        except KeyError:
+            logger.info('could not republish %r keys: no peers available', len(keys))
+            self.stats['failures'] += len(keys)
+            return
+        finally:
+            self.stats['lookups'] += 1
+            self.stats['rpcs'] += stats.get('rpcs', 0)
+            self.stats['bytes'] += stats.get('rpcs', 0) * self.rpc_bytes
+        yield from self.limiter.consume(stats.get('rpcs', 0) * self.rpc_bytes)
+
+        for key in keys:
+            value = values[key]
+            ttl = self.remaining_ttl(key)
+            if ttl is not None and ttl <= 0:
+                continue
+            kwargs = {'ttl': ttl} if ttl is not None else {}
+            candidates = set(found) | set(node.routing_table.find_closest_peers(key))
+            closest = sorted(candidates, key=lambda peer: peer[0] ^ key)[:node.k]
+            results = yield from asyncio.gather(*[node.store_value(peer, key, value, **kwargs)
+                                                  for _, peer in closest], return_exceptions=True)
+            if not [r for r in results if r is True]:
+                self.stats['failures'] += 1
+            sent = len(closest) * (sizeof(value) + self.rpc_bytes)
+            self.stats['rpcs'] += len(closest)
+            self.stats['bytes'] += sent
+            yield from self.limiter.consume(sent)
@@ -1,19 +1,22 @@
 import asyncio
 import logging
+import os
 import signal
 
 from kademlia_aio import KademliaNode
+from kademlia_aio.snapshot import load_snapshot
+from kademlia_aio.storage import LogBackend, Storage
 
 
 logger = logging.getLogger(__name__)
 
 
-def logging_to_console():
-    '''Sends all kademlia_aio logs to standard out.'''
+def logging_to_console(level=logging.INFO):
+    '''Sends kademlia_aio logs of the given level and above to standard out.'''
     kademlia_logger = logging.getLogger('kademlia_aio')
-    kademlia_logger.setLevel(logging.DEBUG)
+    kademlia_logger.setLevel(level)
     stream_handler = logging.StreamHandler()
-    stream_handler.setLevel(logging.DEBUG)
+    stream_handler.setLevel(level)
     stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
     kademlia_logger.addHandler(stream_handler)
 
@@ -23,11 +26,50 @@ def setup_event_loop():
     loop = asyncio.get_event_loop()
     loop.add_signal_handler(signal.SIGINT, loop.stop)
 
-def start_node(local_address, port):
+def start_node(local_address, port, data_directory=None):
     '''Starts a KademliaNode listening on the given address and port, waits for it to
-       initialize on the global asyncio event loop, then returns it.'''
+       initialize on the global asyncio event loop, starts its background maintenance and
+       republishing, then returns it.  If a data_directory is given, the node's values are
+       kept in a log there, and its identifier and routing table are snapshotted there; a
+       node restarted with the same data_directory keeps its identifier, and rejoins the
+       network through the contacts it had, revalidating them in the background.'''
     loop = asyncio.get_event_loop()
+    storage, snapshot = None, None
+    if data_directory is not None:
+        backend = LogBackend(os.path.join(data_directory, 'values'))
+        storage = Storage(default_ttl=86400, backend=backend)
+        backend.start()
+        snapshot = load_snapshot(os.path.join(data_directory, 'routing'))
+    identifier = snapshot[0] if snapshot is not None else None
     logger.info('Starting node on %s:%s...', local_address, port)
-    _, node = loop.run_until_complete(loop.create_datagram_endpoint(KademliaNode, local_addr=(local_address, int(port))))
+    _, node = loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: KademliaNode(identifier=identifier, storage=storage), local_addr=(local_address, int(port))))
+    if snapshot is not None:
+        asyncio.ensure_future(node.warm_start(*snapshot[1:]))
+    if data_directory is not None:
+        node.start_snapshots(os.path.join(data_directory, 'routing'))
+    node.start_maintenance()
+    node.start_republishing()
     logger.info('Listening as node %s...', node.identifier)
     return node
+
+def trace_on_signal(node, signum=signal.SIGUSR1, **kwargs):
+    '''Starts a sampled trace of the node's traffic, written to the log whenever the process
+       receives the given signal.  Keyword arguments configure the MessageTrace.'''
+    trace = node.start_tracing(**kwargs)
+    asyncio.get_event_loop().add_signal_handler(signum, trace.log)
+    return trace
+
+def stop_node(node):
+    '''Stops the background work start_node started for a node, saving a final snapshot of its
+       routing table and closing its storage.'''
+    node.stop_maintenance()
+    node.stop_republishing()
+    node.stop_snapshots()
+    node.storage.close()
+
+def parse_address(address):
+    '''Parses an "ip:port" string (IPv6 addresses may be given as "[ip]:port") into an
+       (ip, port) tuple.'''
+    host, _, port = address.rpartition(':')
+    return host.strip('[]'), int(port)
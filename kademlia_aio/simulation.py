@@ -0,0 +1,154 @@
+'''
+An in-process, simulated datagram network for running thousands of KademliaNodes in a single
+process, such as for benchmarks.  Nodes are attached to a SimulatedNetwork in place of real UDP
+endpoints, and run on a SimulatedEventLoop, whose clock skips ahead over idle time, so that a
+simulation runs as fast as the CPU allows rather than in real time.
+
+    loop = SimulatedEventLoop()
+    asyncio.set_event_loop(loop)
+    network = SimulatedNetwork(latency=0.05, jitter=0.01, loss=0.01, seed=1)
+    nodes = [network.create_endpoint(lambda: KademliaNode(clock=loop.time), network.address(i))[1]
+             for i in range(1000)]
+
+Nodes should keep time by the loop's clock, so that their storage and caches expire values on
+the virtual clock too.  Seeding the network makes its latencies and losses reproducible; seed the random module too
+for reproducible node identifiers and lookups.
+'''
+import asyncio
+import logging
+import random
+import selectors
+
+from kademlia_aio.codec import MAX_DATAGRAM_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    '''A selector that polls instead of waiting, and advances its SimulatedEventLoop's clock by
+       the time it would have waited.'''
+
+    def __init__(self, loop):
+        self.loop = loop
+        super(VirtualSelector, self).__init__()
+
+    def select(self, timeout=None):
+        if timeout is None:
+            return super(VirtualSelector, self).select(None)
+        events = super(VirtualSelector, self).select(0)
+        if not events and timeout > 0:
+            self.loop.now += timeout
+        return events
+
+
+class SimulatedEventLoop(asyncio.SelectorEventLoop):
+    '''An event loop on a virtual clock, starting at start seconds.  Whenever the loop would
+       wait for its next timer, the clock jumps straight to it instead.  Real I/O still works,
+       but is only polled.'''
+
+    def __init__(self, start=0.0):
+        self.now = start
+        super(SimulatedEventLoop, self).__init__(VirtualSelector(self))
+
+    def time(self):
+        return self.now
+
+
+class SimulatedTransport(asyncio.DatagramTransport):
+    '''The transport of an endpoint on a SimulatedNetwork, standing in for a UDP transport.'''
+
+    def __init__(self, network, address, protocol):
+        self.network = network
+        self.address = address
+        self.protocol = protocol
+        self.closing = False
+        super(SimulatedTransport, self).__init__(extra={'sockname': address})
+
+    def sendto(self, data, address=None):
+        if not self.closing:
+            self.network.send(self.address, data, address)
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        '''Detaches the endpoint from the network; datagrams to it are dropped from then on.'''
+        if not self.closing:
+            self.closing = True
+            self.network.endpoints.pop(self.address, None)
+            self.network.loop.call_soon(self.protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+
+class SimulatedNetwork(object):
+    '''Delivers datagrams between endpoints in the same process after latency seconds, +/-
+       up to jitter seconds, dropping a fraction loss of them at random, as well as any sent
+       to an address with no endpoint, across a partition, or larger than a UDP datagram can
+       be.  Delivery is scheduled on the given event loop (the current one by default).  The
+       traffic carried is counted in stats.'''
+
+    def __init__(self, latency=0.05, jitter=0.0, loss=0.0, seed=None, loop=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.endpoints = {}
+        self.groups = {}
+        self.stats = {'sent': 0, 'delivered': 0, 'lost': 0, 'unreachable': 0, 'oversized': 0, 'bytes': 0}
+        super(SimulatedNetwork, self).__init__()
+
+    @staticmethod
+    def address(index, port=9000):
+        '''Returns a distinct (ip, port) address for each index.'''
+        return ('10.{}.{}.{}'.format(index >> 16 & 255, index >> 8 & 255, index & 255), port)
+
+    def create_endpoint(self, protocol_factory, address):
+        '''Attaches a new protocol, made by protocol_factory, to the network at address,
+           returning its (transport, protocol), like loop.create_datagram_endpoint.'''
+        if address in self.endpoints:
+            raise ValueError('Address {!r} is already in use.'.format(address))
+        protocol = protocol_factory()
+        transport = SimulatedTransport(self, address, protocol)
+        self.endpoints[address] = transport
+        protocol.connection_made(transport)
+        return transport, protocol
+
+    def partition(self, *groups):
+        '''Splits the network, so that datagrams are only delivered between addresses in the
+           same one of the given groups of addresses.  Addresses in no group are unaffected.'''
+        self.groups = {address: index for index, group in enumerate(groups) for address in group}
+
+    def heal(self):
+        '''Removes any partition.'''
+        self.groups = {}
+
+    def reachable(self, source, destination):
+        group = self.groups.get(source)
+        return group is None or self.groups.get(destination, group) == group
+
+    def delay(self):
+        return max(0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def send(self, source, data, destination):
+        self.stats['sent'] += 1
+        self.stats['bytes'] += len(data)
+        if len(data) > MAX_DATAGRAM_SIZE:
+            self.stats['oversized'] += 1
+        elif self.loss and self.random.random() < self.loss:
+            self.stats['lost'] += 1
+        elif destination not in self.endpoints or not self.reachable(source, destination):
+            self.stats['unreachable'] += 1
+        else:
+            self.loop.call_later(self.delay(), self.deliver, source, bytes(data), destination)
+
+    def deliver(self, source, data, destination):
+        transport = self.endpoints.get(destination)
+        if transport is None:
+            self.stats['unreachable'] += 1
+            return
+        self.stats['delivered'] += 1
+        transport.protocol.datagram_received(data, source)
@@ -0,0 +1,92 @@
+'''
+Snapshots of a KademliaNode's identifier and routing table, so that a restarted node can
+rejoin the network where it left off instead of bootstrapping from scratch.
+'''
+import asyncio
+import logging
+import os
+
+from kademlia_aio.codec import BinaryCodec, CodecError
+
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+codec = BinaryCodec()
+
+
+def save_snapshot(path, node):
+    '''Writes the node's identifier and the contacts in its routing table's buckets and
+       replacement caches to the file at path, replacing it atomically.  Contacts are encoded
+       with the BinaryCodec, in 27 bytes each for IPv4 peers.'''
+    contacts, replacements = node.routing_table.contacts()
+    data = codec.pack_value((SNAPSHOT_VERSION, node.identifier, contacts, replacements))
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+    return len(data)
+
+
+def load_snapshot(path):
+    '''Reads a snapshot written by save_snapshot, returning the node identifier, a list of the
+       contacts in the buckets, and a list of those in the replacement caches.  Returns None if
+       there is no snapshot at path, or it cannot be read.'''
+    try:
+        with open(path, 'rb') as f:
+            version, identifier, contacts, replacements = codec.unpack_value(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, CodecError, TypeError, ValueError) as e:
+        logger.warning('ignoring unreadable snapshot %s: %s', path, e)
+        return None
+    if version != SNAPSHOT_VERSION:
+        logger.warning('ignoring snapshot %s of unknown version %r', path, version)
+        return None
+    return identifier, [tuple(contact) for contact in contacts], [tuple(contact) for contact in replacements]
+
+
+class Snapshotter(object):
+    '''Saves a snapshot of a node's routing table to path every interval seconds, and once more
+       when stopped.'''
+
+    def __init__(self, node, path, interval=300):
+        self.node = node
+        self.path = path
+        self.interval = interval
+        self.task = None
+        self.stats = {'snapshots': 0, 'failures': 0, 'bytes': 0}
+        super(Snapshotter, self).__init__()
+
+    def start(self):
+        '''Starts saving snapshots in the background, the first after an interval.'''
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def stop(self):
+        '''Stops saving snapshots, saving a final one.'''
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+            self.save()
+
+    @asyncio.coroutine
+    def run(self):
+        while True:
+            yield from asyncio.sleep(self.interval)
+            self.save()
+
+    def save(self):
+        '''Saves a snapshot now, returning True if it was written.'''
+        try:
+            self.stats['bytes'] = save_snapshot(self.path, self.node)
+        except OSError as e:
+            logger.warning('could not save snapshot %s: %s', self.path, e)
+            self.stats['failures'] += 1
+            return False
+        self.stats['snapshots'] += 1
+        return True
@@ -0,0 +1,478 @@
+'''
+The storage a KademliaNode keeps the values it has been asked to hold in, and the backends
+that hold the values for it: in memory, or in a log on disk that survives restarts.
+'''
+import asyncio
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import heapq
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+
+from kademlia_aio.codec import BinaryCodec, CodecError
+
+
+logger = logging.getLogger(__name__)
+
+CHECKSUM = struct.Struct('!I')
+RECORD = struct.Struct('!BIIIdd')
+RECORD_HEADER_SIZE = CHECKSUM.size + RECORD.size
+RAW, TOMBSTONE = 0x01, 0x02
+NEVER = 0.0
+
+codec = BinaryCodec()
+
+
+class Storage(MutableMapping):
+    '''The storage associated with a node: a mapping of keys to values, where each entry may
+       expire, and the total size of the values may be held under a byte budget by evicting
+       the least-recently used entries.
+
+       Expiry times are indexed in buckets of granularity seconds, so purging expired entries
+       costs amortized O(1) per entry.  Expired entries are purged lazily as the storage is
+       written to or measured, and are never returned by reads.
+
+       The values themselves are held by a backend, a MemoryBackend unless another is given;
+       the storage keeps whatever handle the backend returns for each value in its entry.'''
+
+    def __init__(self, default_ttl=None, max_bytes=None, granularity=1, clock=time.monotonic, backend=None):
+        '''Initializes a Storage, optionally specifying the time to live (in seconds) for entries
+           stored without one, the byte budget for all values, the granularity of the expiry
+           index, the clock to measure time with, and the backend to hold values in.  Any
+           values the backend already holds are loaded.'''
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.granularity = granularity
+        self.clock = clock
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.entries = OrderedDict()
+        self.expiry_buckets = {}
+        self.expiry_heap = []
+        self.bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'expirations': 0, 'evictions': 0}
+        super(Storage, self).__init__()
+
+        now = self.clock()
+        for key, handle, size, ttl, age in self.backend.load():
+            if ttl is not None and ttl <= 0:
+                self.backend.delete(key, handle, durable=False)
+                continue
+            self.add_entry(key, handle, now + ttl if ttl is not None else None, size, now - age)
+        self.evict()
+
+    def __len__(self):
+        self.purge_expired()
+        return len(self.entries)
+
+    def __iter__(self):
+        now = self.clock()
+        return iter([key for key, (_, expires, _, _, _) in self.entries.items()
+                     if expires is None or expires > now])
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        expires = entry[1]
+        if expires is not None and expires <= self.clock():
+            self.expire(key)
+            return False
+        return True
+
+    def __getitem__(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            handle, expires, _, _, _ = entry
+            if expires is None or expires > self.clock():
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.backend.read(key, handle)
+            self.expire(key)
+        self.stats['misses'] += 1
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.discard(key)
+
+    def set(self, key, value, ttl=None):
+        '''Stores a value, expiring it after ttl seconds (or the default_ttl), then evicts the
+           least-recently used entries if the byte budget has been exceeded.'''
+        now = self.clock()
+        self.purge_expired(now)
+        explicit_ttl = ttl is not None
+        if ttl is None:
+            ttl = self.default_ttl
+        expires = now + ttl if ttl is not None else None
+
+        handle = self.backend.write(key, value, ttl)
+        if key in self.entries:
+            self.remove_entry(key)
+        self.add_entry(key, handle, expires, sizeof(key) + sizeof(value), now, explicit_ttl)
+        self.evict()
+
+    def add_entry(self, key, handle, expires, size, stored_at, explicit_ttl=False):
+        self.entries[key] = (handle, expires, size, stored_at, explicit_ttl)
+        self.bytes += size
+        if expires is not None:
+            bucket = int(expires // self.granularity)
+            if bucket not in self.expiry_buckets:
+                self.expiry_buckets[bucket] = set()
+                heapq.heappush(self.expiry_heap, bucket)
+            self.expiry_buckets[bucket].add(key)
+
+    def remove_entry(self, key):
+        handle, expires, size, _, _ = self.entries.pop(key)
+        self.bytes -= size
+        if expires is not None:
+            bucket = self.expiry_buckets.get(int(expires // self.granularity))
+            if bucket is not None:
+                bucket.discard(key)
+        return handle
+
+    def evict(self):
+        if self.max_bytes is not None:
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                oldest = next(iter(self.entries))
+                self.discard(oldest)
+                self.stats['evictions'] += 1
+
+    def peek(self, key):
+        '''Returns the value of the given key without counting a hit or refreshing its recency,
+           raising KeyError if it is not stored.'''
+        return self.backend.read(key, self.entries[key][0])
+
+    def expires_at(self, key):
+        '''Returns the clock time the given key expires at, or None if it never expires.'''
+        return self.entries[key][1]
+
+    def stored_at(self, key):
+        '''Returns the clock time the given key was last stored at.'''
+        return self.entries[key][3]
+
+    def explicit_ttl(self, key):
+        '''Returns True if the given key was stored with a ttl of its own, rather than the
+           default_ttl.  This is not kept across reloads.'''
+        return self.entries[key][4]
+
+    def discard(self, key, durable=True):
+        '''Removes the given key, raising KeyError if it is not stored.  Unless durable is false,
+           the removal is also recorded by the backend, so that the value does not return when
+           the storage is reloaded.'''
+        self.backend.delete(key, self.remove_entry(key), durable=durable)
+
+    def expire(self, key):
+        self.discard(key, durable=False)
+        self.stats['expirations'] += 1
+
+    def purge_expired(self, now=None):
+        '''Removes every entry that has expired, returning how many were removed.'''
+        if now is None:
+            now = self.clock()
+        purged = 0
+        current = int(now // self.granularity)
+        while self.expiry_heap and self.expiry_heap[0] <= current:
+            bucket = self.expiry_heap[0]
+            keys = self.expiry_buckets[bucket]
+            for key in list(keys):
+                if self.entries[key][1] <= now:
+                    keys.discard(key)
+                    self.expire(key)
+                    purged += 1
+            if keys and bucket == current:
+                break
+            heapq.heappop(self.expiry_heap)
+            del self.expiry_buckets[bucket]
+        return purged
+
+    def usage(self):
+        '''Returns counters describing the storage's contents and activity.'''
+        usage = dict(self.stats)
+        usage['entries'] = len(self.entries)
+        usage['bytes'] = self.bytes
+        return usage
+
+    def close(self):
+        '''Closes the backend.'''
+        self.backend.close()
+
+
+def sizeof(value):
+    '''Estimates the bytes a key or value occupies: by length for strings and bytes, and by
+       encoded size for containers, so that their contents are counted too.'''
+    if isinstance(value, (bytes, bytearray, memoryview, str)):
+        return len(value)
+    if isinstance(value, (tuple, list, dict, set, frozenset)):
+        try:
+            return len(codec.pack_value(value))
+        except CodecError:
+            items = value.items() if isinstance(value, dict) else ((item,) for item in value)
+            return sys.getsizeof(value) + sum(sizeof(part) for item in items for part in item)
+    return sys.getsizeof(value)
+
+
+class MemoryBackend(object):
+    '''The default Storage backend, which holds values in memory only.
+
+       A backend is asked to write(key, value, ttl) each value stored, replacing any value it
+       holds for the key, and returns a handle that the storage keeps in the key's entry; to
+       read(key, handle) a value back; to delete(key, handle, durable) a value removed from the
+       storage, where a durable deletion must not be undone by a reload; and to load() the
+       (key, handle, size, ttl, age) of every value it already holds, with ttl the seconds the
+       value has left (or None) and age the seconds since it was stored.  Here, the handle is
+       the value itself.'''
+
+    def write(self, key, value, ttl):
+        return value
+
+    def read(self, key, handle):
+        return handle
+
+    def delete(self, key, handle, durable=True):
+        pass
+
+    def load(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class Segment(object):
+    '''One file of a LogBackend, of a fixed size, mapped into memory once for appending records
+       and once, read-only, for serving reads.'''
+
+    def __init__(self, identifier, path, size):
+        self.identifier = identifier
+        self.path = path
+        with open(path, 'a+b') as f:
+            if os.fstat(f.fileno()).st_size < size:
+                f.truncate(size)
+            self.size = os.fstat(f.fileno()).st_size
+            self.writable = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_WRITE)
+            self.readable = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.readable)
+        self.end = 0
+        self.dead = 0
+        super(Segment, self).__init__()
+
+    def records(self, verify=False):
+        '''Returns the (start, end, flags, key_length, size, expires, stored) of each record in the
+           segment, up to the first empty (or, if verify is true, corrupt) one, and moves the
+           end of the segment past the last record.'''
+        records = []
+        offset = 0
+        view = self.view
+        while offset + RECORD_HEADER_SIZE <= self.size:
+            checksum, = CHECKSUM.unpack_from(view, offset)
+            flags, key_length, value_length, size, expires, stored = RECORD.unpack_from(view, offset + CHECKSUM.size)
+            end = offset + RECORD_HEADER_SIZE + key_length + value_length
+            if not key_length or end > self.size:
+                break
+            if verify and zlib.crc32(view[offset + CHECKSUM.size:end]) != checksum:
+                logger.warning('ignoring corrupt record at %r in %s', offset, self.path)
+                break
+            records.append((offset, end, flags, key_length, size, expires, stored))
+            offset = end
+        self.end = offset
+        return records
+
+    def append(self, flags, key_data, value_data, size, expires, stored):
+        '''Writes a record at the end of the segment, returning its start.  There must be room.'''
+        start = self.end
+        header = RECORD.pack(flags, len(key_data), len(value_data), size, expires, stored)
+        checksum = zlib.crc32(value_data, zlib.crc32(key_data, zlib.crc32(header)))
+        key_start = start + RECORD_HEADER_SIZE
+        value_start = key_start + len(key_data)
+        self.end = value_start + len(value_data)
+        self.writable[start:key_start] = CHECKSUM.pack(checksum) + header
+        self.writable[key_start:value_start] = key_data
+        self.writable[value_start:self.end] = value_data
+        if self.end + RECORD_HEADER_SIZE <= self.size:
+            self.writable[self.end:self.end + RECORD_HEADER_SIZE] = bytes(RECORD_HEADER_SIZE)
+        return start
+
+    def flush(self):
+        self.writable.flush()
+
+    def close(self):
+        self.writable.flush()
+        self.writable.close()
+        try:
+            self.view.release()
+            self.readable.close()
+        except BufferError:
+            pass  # values read from the segment are still in use, and keep the mapping open
+
+
+class LogBackend(object):
+    '''A Storage backend that appends every write and durable deletion as a record to a log of
+       memory-mapped segment files in the given directory, so that the storage survives
+       restarts.  An in-memory index maps each key to its latest record, and is rebuilt on
+       reload from the record headers alone, checksumming only the last segment, where a crash
+       may have left a torn write.  Values are read straight from the map: bytes values are
+       returned as read-only memoryviews without being copied, and other values are decoded
+       with a BinaryCodec.  Expiry and storage times are recorded by wall_clock, so that they
+       carry over a restart.
+
+       Segments hold segment_bytes each.  Records made obsolete by later writes, deletions
+       and expiry are reclaimed by compact(), which rewrites the live records of a segment at
+       least compact_ratio dead onto the end of the log, and runs every check_interval
+       seconds in the background once start() is called.  The running cost is kept in stats.'''
+
+    def __init__(self, directory, segment_bytes=64 * 2**20, compact_ratio=0.5, check_interval=60,
+                 wall_clock=time.time):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.compact_ratio = compact_ratio
+        self.check_interval = check_interval
+        self.wall_clock = wall_clock
+        self.codec = BinaryCodec()
+        self.segments = OrderedDict()
+        self.active = None
+        self.index = {}
+        self.task = None
+        self.stats = {'writes': 0, 'deletes': 0, 'compactions': 0, 'reclaimed': 0}
+        super(LogBackend, self).__init__()
+
+        os.makedirs(directory, exist_ok=True)
+        identifiers = sorted(int(name[:-len('.log')]) for name in os.listdir(directory)
+                             if name.endswith('.log') and name[:-len('.log')].isdigit()
+                             and os.path.getsize(os.path.join(directory, name)))
+        for identifier in identifiers:
+            self.active = self.segments[identifier] = Segment(identifier, self.segment_path(identifier), 0)
+            records = self.active.records(verify=identifier == identifiers[-1])
+            for start, end, flags, key_length, size, expires, stored in records:
+                key_start = start + RECORD_HEADER_SIZE
+                key = self.codec.unpack_value(self.active.view[key_start:key_start + key_length])
+                self.forget(key)
+                if flags & TOMBSTONE:
+                    self.active.dead += end - start
+                else:
+                    self.index[key] = (self.active, start, end, key_start + key_length, flags, size, expires, stored)
+
+    def segment_path(self, identifier):
+        return os.path.join(self.directory, '{:08d}.log'.format(identifier))
+
+    def load(self):
+        now = self.wall_clock()
+        records = sorted(self.index.items(), key=lambda item: item[1][7])
+        return [(key, None, size, expires - now if expires != NEVER else None, now - stored)
+                for key, (_, _, _, _, _, size, expires, stored) in records]
+
+    def write(self, key, value, ttl):
+        now = self.wall_clock()
+        raw = isinstance(value, (bytes, bytearray, memoryview))
+        key_data = self.codec.pack_value(key)
+        value_data = value if raw else self.codec.pack_value(value)
+        self.forget(key)
+        self.index[key] = self.append(RAW if raw else 0, key_data, value_data, sizeof(key) + sizeof(value),
+                                      now + ttl if ttl is not None else NEVER, now)
+        self.stats['writes'] += 1
+
+    def read(self, key, handle):
+        segment, _, end, value_start, flags = self.index[key][:5]
+        data = segment.view[value_start:end]
+        return data if flags & RAW else self.codec.unpack_value(data)
+
+    def delete(self, key, handle, durable=True):
+        if self.forget(key) and durable:
+            _, start, end = self.append(TOMBSTONE, self.codec.pack_value(key), b'', 0, NEVER, self.wall_clock())[:3]
+            self.active.dead += end - start
+            self.stats['deletes'] += 1
+
+    def forget(self, key):
+        '''Drops the key from the index, counting its record as dead.  Returns whether it was
+           indexed.'''
+        location = self.index.pop(key, None)
+        if location is None:
+            return False
+        segment, start, end = location[:3]
+        segment.dead += end - start
+        return True
+
+    def append(self, flags, key_data, value_data, size, expires, stored):
+        '''Appends a record to the active segment, starting a new one if it is full, and returns
+           the record's location for the index.'''
+        length = RECORD_HEADER_SIZE + len(key_data) + len(value_data)
+        if self.active is None or self.active.end + length > self.active.size:
+            if self.active is not None:
+                self.active.flush()
+            identifier = next(reversed(self.segments), 0) + 1
+            size = max(self.segment_bytes, length + RECORD_HEADER_SIZE)
+            self.active = self.segments[identifier] = Segment(identifier, self.segment_path(identifier), size)
+        start = self.active.append(flags, key_data, value_data, size, expires, stored)
+        return (self.active, start, start + length, start + length - len(value_data), flags, size, expires, stored)
+
+    def compact(self):
+        '''Rewrites the live records of the sealed segment with the most dead bytes, if at least
+           compact_ratio of it is dead, onto the end of the log, then removes the segment.
+           Returns the number of bytes reclaimed.'''
+        sealed = [segment for segment in self.segments.values()
+                  if segment is not self.active and segment.dead >= segment.end * self.compact_ratio]
+        if not sealed:
+            return 0
+        segment = max(sealed, key=lambda segment: segment.dead / max(segment.end, 1))
+        oldest = segment is next(iter(self.segments.values()))
+        for start, end, flags, key_length, size, expires, stored in segment.records():
+            key_start = start + RECORD_HEADER_SIZE
+            key_data = segment.view[key_start:key_start + key_length]
+            key = self.codec.unpack_value(key_data)
+            if flags & TOMBSTONE:
+                # Only needed while an older segment may still hold a value for the key.
+                if not oldest and key not in self.index:
+                    self.append(flags, key_data, b'', size, expires, stored)
+                    self.active.dead += end - start
+                continue
+            location = self.index.get(key)
+            if location is not None and location[0] is segment and location[1] == start:
+                self.index[key] = self.append(flags, key_data, segment.view[key_start + key_length:end],
+                                              size, expires, stored)
+        reclaimed = segment.size
+        del self.segments[segment.identifier]
+        segment.close()
+        os.remove(segment.path)
+        self.stats['compactions'] += 1
+        self.stats['reclaimed'] += reclaimed
+        return reclaimed
+
+    def start(self):
+        '''Starts flushing and compacting the log in the background, every check_interval.'''
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def stop(self):
+        '''Stops flushing and compacting the log.'''
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @asyncio.coroutine
+    def run(self):
+        while True:
+            yield from asyncio.sleep(self.check_interval)
+            self.flush()
+            while self.compact():
+                yield from asyncio.sleep(0)
+
+    def flush(self):
+        '''Flushes the records written to the active segment to disk.'''
+        if self.active is not None:
+            self.active.flush()
+
+    def close(self):
+        '''Stops compacting, then flushes and closes every segment.'''
+        self.stop()
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
+        self.index.clear()
+        self.active = None
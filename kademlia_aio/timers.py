@@ -0,0 +1,171 @@
+'''
+Timeout management for DatagramRPCProtocol: a timer wheel for pending RPCs, and per-peer
+round trip time estimates to size their timeouts.
+'''
+import asyncio
+from collections import OrderedDict
+import math
+
+
+class TimerWheel(object):
+    '''A hashed timer wheel.  Timeouts are kept in one of a fixed number of slots, keyed
+       by an identifier, so scheduling and cancelling are O(1) dictionary operations.
+       Slots are only allocated while they hold timeouts.
+       A single event loop callback ticks the wheel every resolution seconds (and only
+       while timeouts are pending), firing each expired slot's timeouts in a batch.
+       Timeouts never fire early, and fire up to one resolution late.'''
+
+    def __init__(self, resolution=0.05, slots=512, loop=None):
+        '''Initializes a TimerWheel, optionally specifying the tick resolution (in seconds),
+           the number of slots, and the event loop to run on (the current event loop by
+           default, resolved when the first timeout is scheduled).'''
+        self.resolution = resolution
+        self.slot_count = slots
+        self.slots = {}
+        self.locations = {}
+        self.loop = loop
+        self.origin = None
+        self.current_tick = 0
+        self.handle = None
+        self.fired = 0
+        self.cancelled = 0
+        super(TimerWheel, self).__init__()
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, key):
+        return key in self.locations
+
+    def now_tick(self):
+        return int((self.loop.time() - self.origin) / self.resolution)
+
+    def schedule(self, key, delay, callback, *args):
+        '''Arranges for callback(*args) to be called after delay seconds, unless the key
+           is cancelled first.  Rescheduling an existing key replaces its timeout.'''
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        if self.origin is None:
+            self.origin = self.loop.time()
+        if key in self.locations:
+            self.cancel(key)
+        if self.handle is None:
+            self.current_tick = self.now_tick()
+            self.handle = self.loop.call_later(self.resolution, self.tick)
+
+        deadline = max(self.current_tick + 1,
+                       math.ceil((self.loop.time() - self.origin + delay) / self.resolution))
+        slot = deadline % self.slot_count
+        if slot not in self.slots:
+            self.slots[slot] = {}
+        self.slots[slot][key] = (deadline, callback, args)
+        self.locations[key] = slot
+
+    def cancel(self, key):
+        '''Cancels the timeout for the given key, returning True if one was pending.'''
+        slot = self.locations.pop(key, None)
+        if slot is None:
+            return False
+        entries = self.slots[slot]
+        del entries[key]
+        if not entries:
+            del self.slots[slot]
+        self.cancelled += 1
+        return True
+
+    def tick(self):
+        '''Fires every timeout that has come due since the last tick.'''
+        now = self.now_tick()
+        expired = []
+        first = self.current_tick + 1
+        last = min(now, self.current_tick + self.slot_count)
+        for tick in range(first, last + 1):
+            slot = tick % self.slot_count
+            entries = self.slots.get(slot)
+            if not entries:
+                continue
+            for key, (deadline, callback, args) in list(entries.items()):
+                if deadline <= now:
+                    del entries[key]
+                    del self.locations[key]
+                    expired.append((callback, args))
+            if not entries:
+                del self.slots[slot]
+        self.current_tick = max(self.current_tick, now)
+
+        self.handle = None
+        if self.locations:
+            self.handle = self.loop.call_later(self.resolution, self.tick)
+
+        self.fired += len(expired)
+        for callback, args in expired:
+            callback(*args)
+
+    def close(self):
+        '''Stops ticking and discards any pending timeouts without firing them.'''
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.slots.clear()
+        self.locations.clear()
+
+
+class RoundTripEstimator(object):
+    '''Tracks a smoothed round trip time and its variance for each peer, in the manner of
+       TCP's SRTT and RTTVAR (RFC 6298), to derive an adaptive timeout per peer.  Only the
+       most recently active max_peers are remembered.'''
+
+    def __init__(self, min_timeout=0.5, granularity=0.01, max_peers=10000):
+        '''Initializes a RoundTripEstimator, optionally specifying the smallest timeout it
+           will suggest, the clock granularity (in seconds), and how many peers to track.'''
+        self.min_timeout = min_timeout
+        self.granularity = granularity
+        self.max_peers = max_peers
+        self.peers = OrderedDict()
+        super(RoundTripEstimator, self).__init__()
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __contains__(self, peer):
+        return peer in self.peers
+
+    def observe(self, peer, round_trip_time):
+        '''Records a round trip time sample (in seconds) for the given peer.'''
+        estimate = self.peers.pop(peer, None)
+        if estimate is None:
+            smoothed, variance = round_trip_time, round_trip_time / 2
+        else:
+            smoothed, variance, _ = estimate
+            variance = 0.75 * variance + 0.25 * abs(smoothed - round_trip_time)
+            smoothed = 0.875 * smoothed + 0.125 * round_trip_time
+        self.peers[peer] = (smoothed, variance, 1)
+        if len(self.peers) > self.max_peers:
+            self.peers.popitem(last=False)
+
+    def backoff(self, peer):
+        '''Doubles the given peer's timeout after it failed to reply, until the next sample.'''
+        if peer in self.peers:
+            smoothed, variance, backoff = self.peers[peer]
+            self.peers[peer] = (smoothed, variance, min(backoff * 2, 64))
+
+    def estimate(self, peer):
+        '''Returns the (smoothed round trip time, variance) of the given peer, or None if
+           it has never replied.'''
+        if peer not in self.peers:
+            return None
+        smoothed, variance, _ = self.peers[peer]
+        return smoothed, variance
+
+    def expected(self, peer, default):
+        '''Returns how long a reply from the given peer can be expected to take, or default
+           if nothing is known about the peer.'''
+        if peer not in self.peers:
+            return default
+        smoothed, variance, backoff = self.peers[peer]
+        return (smoothed + max(self.granularity, 4 * variance)) * backoff
+
+    def timeout(self, peer, maximum):
+        '''Returns the retransmission timeout for the given peer, never more than maximum,
+           which is also used for peers that have never replied.'''
+        return min(maximum, max(self.min_timeout, self.expected(peer, maximum)))
@@ -0,0 +1,45 @@
+'''
+A sampled trace of the datagrams a DatagramRPCProtocol sends and receives, kept in a ring buffer
+to be dumped on demand, in place of logging every datagram.
+'''
+from collections import deque
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageTrace(object):
+    '''Keeps summaries of the last max_entries traced events, tracing one in every sample_every
+       events.  A trace is called as a hook of a protocol's RPCMetrics (see
+       DatagramRPCProtocol.start_tracing), so it costs nothing until it is started, and while it
+       runs, never formats a payload: each summary is a (time, event, procedure_name, peer,
+       size, latency) tuple, timed by clock.'''
+
+    def __init__(self, max_entries=1024, sample_every=1, clock=time.time):
+        self.entries = deque(maxlen=max_entries)
+        self.sample_every = sample_every
+        self.clock = clock
+        self.seen = 0
+        super(MessageTrace, self).__init__()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __call__(self, event, procedure_name, peer, size, latency):
+        self.seen += 1
+        if self.seen % self.sample_every == 0:
+            self.entries.append((self.clock(), event, procedure_name, peer, size, latency))
+
+    def dump(self):
+        '''Returns the traced summaries, oldest first, as dictionaries.'''
+        return [{'time': at, 'event': event, 'procedure': procedure_name, 'peer': peer, 'size': size,
+                 'latency': latency}
+                for at, event, procedure_name, peer, size, latency in self.entries]
+
+    def log(self, target=logger, level=logging.INFO):
+        '''Writes the traced summaries, oldest first, to the given logger.'''
+        for at, event, procedure_name, peer, size, latency in self.entries:
+            target.log(level, '%.6f %s %s %r %d bytes%s', at, event, procedure_name, peer, size,
+                       ' in {:.1f}ms'.format(latency * 1e3) if latency is not None else '')
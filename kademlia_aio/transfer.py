@@ -0,0 +1,87 @@
+'''
+Reassembly of values too large to travel in a single datagram, which KademliaNode sends
+as a series of chunks.
+'''
+from bisect import bisect_left, bisect_right
+import time
+
+
+class IncomingTransfers(object):
+    '''Assembles chunked values as their chunks arrive, in any order and possibly more than
+       once, or overlapping one another.  Each value is written in place into a single buffer of its full size, so a
+       transfer never holds more than one copy of the value.  Transfers that go timeout
+       seconds without a new chunk are abandoned, and no more than max_bytes are buffered
+       across all transfers at once.'''
+
+    def __init__(self, max_bytes=64 * 2**20, timeout=60, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.clock = clock
+        self.transfers = {}
+        self.bytes = 0
+        self.stats = {'completed': 0, 'abandoned': 0, 'rejected': 0}
+        super(IncomingTransfers, self).__init__()
+
+    def __len__(self):
+        return len(self.transfers)
+
+    def receive(self, transfer_key, size, offset, data):
+        '''Writes a chunk of the transfer identified by transfer_key, which will total size
+           bytes.  Returns the completed buffer once every byte has arrived, and None until
+           then.  Raises a ValueError for a chunk that does not fit the transfer, or a
+           transfer that would exceed max_bytes.'''
+        now = self.clock()
+        self.abandon_idle(now)
+        if offset < 0 or offset + len(data) > size:
+            self.stats['rejected'] += 1
+            raise ValueError('Chunk does not fit the transfer.')
+
+        transfer = self.transfers.get(transfer_key)
+        if transfer is None or len(transfer[0]) != size:
+            if transfer is not None:
+                self.discard(transfer_key)
+            if self.bytes + size > self.max_bytes:
+                self.stats['rejected'] += 1
+                raise ValueError('Too many bytes in transfer.')
+            transfer = self.transfers[transfer_key] = [bytearray(size), [], 0, now]
+            self.bytes += size
+
+        buffer, ranges, received, _ = transfer
+        buffer[offset:offset + len(data)] = data
+        received += cover(ranges, offset, offset + len(data))
+        transfer[2:] = [received, now]
+        if received < size:
+            return None
+        self.discard(transfer_key)
+        self.stats['completed'] += 1
+        return buffer
+
+    def discard(self, transfer_key):
+        '''Forgets a transfer, whether or not it has completed.'''
+        buffer = self.transfers.pop(transfer_key)[0]
+        self.bytes -= len(buffer)
+
+    def abandon_idle(self, now):
+        for transfer_key, (_, _, _, updated) in list(self.transfers.items()):
+            if updated <= now - self.timeout:
+                self.discard(transfer_key)
+                self.stats['abandoned'] += 1
+
+
+def cover(ranges, start, end):
+    '''Adds the range from start to end to ranges, a sorted flat list of the starts and ends of
+       the disjoint ranges received so far, and returns how many bytes it newly covers.'''
+    if start >= end:
+        return 0
+    first = bisect_left(ranges, start)
+    last = bisect_right(ranges, end)
+    covered = 0
+    inside = first % 2 == 1
+    position = start
+    for boundary in ranges[first:last] + [end]:
+        if not inside:
+            covered += boundary - position
+        inside = not inside
+        position = boundary
+    ranges[first:last] = ([] if first % 2 else [start]) + ([] if last % 2 else [end])
+    return covered
@@ -0,0 +1,27 @@
+# coding: utf-8
+import asyncio
+import socket
+
+
+class Clock(object):
+    '''A clock for tests, standing still until its now is moved on.'''
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def returning(value):
+    '''Returns a future already resolved to value, for mocking an RPC.'''
+    future = asyncio.Future()
+    future.set_result(value)
+    return future
+
+
+def timing_out():
+    '''Returns a future already failed with socket.timeout, for mocking an RPC.'''
+    future = asyncio.Future()
+    future.set_exception(socket.timeout())
+    return future
@@ -0,0 +1,53 @@
+# coding: utf-8
+import unittest
+
+from kademlia_aio.cache import ValueCache
+from tests.helpers import Clock
+
+
+class ValueCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_found_and_not_found(self):
+        cache = ValueCache(ttl=60, negative_ttl=5, clock=self.clock)
+        self.assertIsNone(cache.lookup('a'))
+        cache.found('a', 'value')
+        cache.not_found('b')
+        self.assertEqual((True, 'value'), cache.lookup('a'))
+        self.assertEqual((False, None), cache.lookup('b'))
+        self.assertEqual({'hits': 1, 'negative_hits': 1, 'misses': 1, 'evictions': 0}, cache.stats)
+
+        self.clock.now += 5
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.clock.now += 55
+        self.assertIsNone(cache.lookup('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_found_replaces_not_found(self):
+        cache = ValueCache(clock=self.clock)
+        cache.not_found('a')
+        cache.found('a', 'value')
+        self.assertEqual((True, 'value'), cache.lookup('a'))
+        cache.discard('a')
+        self.assertNotIn('a', cache)
+
+    def test_lru_eviction(self):
+        cache = ValueCache(max_entries=2, clock=self.clock)
+        cache.found('a', 1)
+        cache.found('b', 2)
+        cache.lookup('a')
+        cache.found('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(1, cache.stats['evictions'])
+
+    def test_disabled(self):
+        cache = ValueCache(negative_ttl=0, clock=self.clock)
+        cache.not_found('a')
+        self.assertNotIn('a', cache)
+        cache = ValueCache(max_entries=0, clock=self.clock)
+        cache.found('a', 1)
+        self.assertNotIn('a', cache)
@@ -0,0 +1,101 @@
+# coding: utf-8
+import pickle
+import unittest
+
+from kademlia_aio.codec import BinaryCodec, CodecError, MessageTooLarge
+
+
+class BinaryCodecTests(unittest.TestCase):
+    def setUp(self):
+        self.codec = BinaryCodec(['ping', 'store', 'find_node', 'find_value'])
+
+    def round_trip(self, message):
+        return self.codec.decode(self.codec.encode(message))
+
+    def test_opcodes(self):
+        self.assertEqual(['find_node', 'find_value', 'ping', 'store'], self.codec.procedure_names)
+        self.assertEqual(2, self.codec.opcodes['ping'])
+
+    def test_extensions(self):
+        codec = BinaryCodec(['store_many', 'ping', 'store', 'find_node', 'find_value'], extensions=['store_many'])
+        self.assertEqual(['find_node', 'find_value', 'ping', 'store', 'store_many'], codec.procedure_names)
+        message = ('request', 1, 'ping', (), {})
+        self.assertEqual(message, self.codec.decode(codec.encode(message)))
+        self.assertRaises(CodecError, self.codec.decode, codec.encode(('request', 1, 'store_many', ([],), {})))
+
+    def test_request(self):
+        message = ('request', 2**160-1, 'store', (2**159, 12345, 'hello', b'world'), {})
+        self.assertEqual(message, self.round_trip(message))
+
+    def test_request_kwargs(self):
+        message = ('request', 1, 'ping', (), {'peer_identifier': 2**100})
+        self.assertEqual(message, self.round_trip(message))
+
+    def test_reply_values(self):
+        for answer in [None, True, False, 0, -1, 2**63, -2**200, 1.5, '', 'ünïcödé', b'\x00\xff',
+                       (), [], {}, [1, (2, [3])], {'a': [None]}, (1, ('found', 'world'))]:
+            message = ('reply', 7, answer)
+            decoded = self.round_trip(message)
+            self.assertEqual(message, decoded)
+            self.assertEqual(type(answer), type(decoded[2]))
+
+    def test_busy(self):
+        message = ('busy', 2**160-1)
+        self.assertEqual(message, self.round_trip(message))
+        self.assertEqual(21, len(self.codec.encode(message)))
+
+    def test_contacts(self):
+        contacts = [(2**160-1, ('10.0.0.1', 9000)),
+                    (1234, ('::1', 9001)),
+                    (5678, ('localhost', 9002)),
+                    (9012, ('::0001', 9003))]
+        message = ('reply', 7, (1, contacts))
+        self.assertEqual(message, self.round_trip(message))
+
+    def test_k_contacts_fit_in_one_datagram(self):
+        contacts = [(2**160-1-i, ('10.0.0.{}'.format(i), 9000 + i)) for i in range(20)]
+        message = ('reply', 2**160-1, (2**160-1, ('notfound', contacts)))
+        data = self.codec.encode(message)
+        self.assertLess(len(data), 1024)
+        self.assertLess(len(data), len(pickle.dumps(message)))
+
+    def test_encode_into(self):
+        buffer = bytearray(100)
+        end = self.codec.encode_into(('reply', 7, 'hello'), memoryview(buffer), offset=10)
+        self.assertEqual(('reply', 7, 'hello'), self.codec.decode(buffer[10:end]))
+
+    def test_encode_into_too_small(self):
+        self.assertRaises(MessageTooLarge, self.codec.encode_into, ('reply', 7, 'x' * 100), bytearray(50))
+
+    def test_encode_large(self):
+        message = ('reply', 7, ['x' * 1000] * 200)
+        self.assertRaises(MessageTooLarge, self.codec.encode, message)
+        data = self.codec.encode_large(message)
+        self.assertGreater(len(data), 200000)
+        self.assertEqual(message, self.codec.decode(data))
+        self.assertRaises(MessageTooLarge, self.codec.encode_large, message, limit=100000)
+
+    def test_too_many_items(self):
+        for value in [list(range(70000)), dict.fromkeys(range(70000))]:
+            with self.assertRaises(CodecError) as raised:
+                self.codec.encode_large(('reply', 1, value))
+            self.assertNotIsInstance(raised.exception, MessageTooLarge)
+        self.assertRaises(CodecError, self.codec.encode, ('reply', 2**160, None))
+
+    def test_unencodable(self):
+        self.assertRaises(CodecError, self.codec.encode, ('request', 1, 'unknown', (), {}))
+        self.assertRaises(CodecError, self.codec.encode, ('reply', 1, object()))
+        self.assertRaises(CodecError, self.codec.encode, ('bogus', 1, None))
+
+    def test_malformed(self):
+        data = self.codec.encode(('request', 1, 'store', (1, 2, 'three'), {}))
+        for bad in [b'', data[:-1], data + b'\x00', b'\x03' + data[1:],
+                    data[:21] + b'\xff' + data[22:], data[:22] + b'\xff' + data[23:],
+                    pickle.dumps(('reply', 1, None))]:
+            self.assertRaises(CodecError, self.codec.decode, bad)
+
+    def test_nested_too_deeply(self):
+        answer = []
+        for _ in range(100):
+            answer = [answer]
+        self.assertRaises(CodecError, self.codec.encode, ('reply', 1, answer))
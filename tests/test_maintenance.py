@@ -0,0 +1,79 @@
+# coding: utf-8
+import asyncio
+import unittest
+
+import mock
+
+from kademlia_aio import KademliaNode
+from kademlia_aio.maintenance import MaintenanceScheduler, RateLimiter
+from tests.test_node import async_unit
+
+
+class RateLimiterTests(unittest.TestCase):
+    @async_unit
+    def test_within_burst(self):
+        limiter = RateLimiter(10, burst=5)
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        yield from limiter.consume(5)
+        self.assertLess(loop.time() - started, 0.05)
+
+    @async_unit
+    def test_overdrawn(self):
+        limiter = RateLimiter(100, burst=1)
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        yield from limiter.consume(6)
+        self.assertGreaterEqual(loop.time() - started, 0.04)
+
+
+class MaintenanceSchedulerTests(unittest.TestCase):
+    def lookup_node(self, stats):
+        def lookup_node(hashed_key, stats=None):
+            stats['rpcs'] = stats.get('rpcs', 0) + 3
+            future = asyncio.Future()
+            future.set_result([])
+            return future
+        return lookup_node
+
+    @async_unit
+    def test_refresh_buckets(self):
+        node = KademliaNode(k=2, identifier=0)
+        node.routing_table.update_peer(2**159, ('10.0.0.1', 1))
+        node.routing_table.update_peer(2**158, ('10.0.0.2', 2))
+        node.routing_table.touch_bucket(2**159 + 5, asyncio.get_event_loop().time())
+        self.assertEqual([1], node.routing_table.buckets_to_refresh(asyncio.get_event_loop().time() - 60))
+
+        scheduler = MaintenanceScheduler(node, refresh_interval=60, check_interval=0.01, rpc_rate=1000)
+        with mock.patch.object(node, 'lookup_node') as lookup_node:
+            lookup_node.side_effect = self.lookup_node({})
+            yield from scheduler.refresh_buckets()
+
+            self.assertEqual(1, lookup_node.call_count)
+            key = lookup_node.call_args[0][0]
+            self.assertEqual(1, node.routing_table.bucket_index(key))
+        self.assertEqual(1, scheduler.stats['refreshes'])
+        self.assertEqual(3, scheduler.stats['rpcs'])
+
+    @async_unit
+    def test_refresh_without_peers(self):
+        node = KademliaNode(k=2, identifier=0)
+        node.routing_table.update_peer(2**159, ('10.0.0.1', 1))
+        node.routing_table.forget_peer(2**159)
+        scheduler = MaintenanceScheduler(node, refresh_interval=60, check_interval=0.01)
+        yield from scheduler.refresh_bucket(0)
+        self.assertEqual(1, scheduler.stats['failures'])
+
+    @async_unit
+    def test_start_and_stop(self):
+        node = KademliaNode(k=2, identifier=0)
+        node.routing_table.update_peer(2**159, ('10.0.0.1', 1))
+        with mock.patch.object(node, 'lookup_node') as lookup_node:
+            lookup_node.side_effect = self.lookup_node({})
+            scheduler = node.start_maintenance(refresh_interval=0.01, check_interval=0.01, jitter=0)
+            self.assertIs(scheduler, node.start_maintenance())
+            yield from asyncio.sleep(0.1)
+            node.stop_maintenance()
+            self.assertIsNone(node.maintenance)
+            self.assertTrue(lookup_node.called)
+            self.assertGreaterEqual(scheduler.stats['passes'], 1)
@@ -0,0 +1,54 @@
+# coding: utf-8
+import unittest
+
+from kademlia_aio.metrics import LatencyHistogram, RPCMetrics
+
+
+class LatencyHistogramTests(unittest.TestCase):
+    def test_observe(self):
+        histogram = LatencyHistogram(bounds=(0.01, 0.1, 1))
+        for seconds in [0.005, 0.01, 0.05, 0.05, 2]:
+            histogram.observe(seconds)
+        self.assertEqual([2, 2, 0, 1], histogram.counts)
+        self.assertEqual(5, histogram.count)
+        self.assertAlmostEqual(2.115, histogram.sum)
+        self.assertEqual(0.01, histogram.percentile(0.4))
+        self.assertEqual(0.1, histogram.percentile(0.5))
+        self.assertEqual(float('inf'), histogram.percentile(0.99))
+        self.assertEqual({0.01: 2, 0.1: 2, 1: 0, 'inf': 1}, histogram.snapshot()['buckets'])
+
+    def test_empty(self):
+        self.assertIsNone(LatencyHistogram().percentile(0.5))
+
+
+class RPCMetricsTests(unittest.TestCase):
+    def test_counts(self):
+        metrics = RPCMetrics()
+        peer = ('10.0.0.1', 9000)
+        metrics.request_sent('ping', peer, 30, 0)
+        metrics.request_sent('ping', peer, 30, 1)
+        metrics.reply_received('ping', peer, 40, 0.02)
+        metrics.request_received('store', peer, 100)
+        metrics.reply_sent('store', peer, 42)
+        metrics.timed_out('ping', peer)
+
+        ping = metrics.snapshot()['procedures']['ping']
+        self.assertEqual((1, 1, 1, 1, 60, 40), (ping['requests_sent'], ping['retransmits'], ping['replies_received'],
+                                                ping['timeouts'], ping['bytes_out'], ping['bytes_in']))
+        self.assertEqual(1, ping['latency']['count'])
+        store = metrics.procedure('store')
+        self.assertEqual((1, 1, 100, 42), (store.requests_received, store.replies_sent, store.bytes_in, store.bytes_out))
+
+    def test_hooks(self):
+        metrics = RPCMetrics()
+        events = []
+        hook = lambda *event: events.append(event)
+        metrics.add_hook(hook)
+        metrics.request_sent('ping', ('10.0.0.1', 9000), 30, 0)
+        metrics.reply_received('ping', ('10.0.0.1', 9000), 40, 0.02)
+        metrics.timed_out('find_node', ('10.0.0.2', 9000))
+        metrics.remove_hook(hook)
+        metrics.request_received('ping', ('10.0.0.1', 9000), 30)
+        self.assertEqual([('request_sent', 'ping', ('10.0.0.1', 9000), 30, None),
+                          ('reply_received', 'ping', ('10.0.0.1', 9000), 40, 0.02),
+                          ('timeout', 'find_node', ('10.0.0.2', 9000), 0, None)], events)
@@ -6,7 +6,11 @@ import unittest
 
 import mock
 
-from kademlia_aio import KademliaNode, get_identifier
+from kademlia_aio import KademliaNode, PeerBusy, get_identifier, remote
+from kademlia_aio.codec import CodecError
+from kademlia_aio.simulation import SimulatedEventLoop, SimulatedNetwork
+from kademlia_aio.storage import Storage
+from tests.helpers import Clock, returning, timing_out
 
 
 def async_unit(func):
@@ -56,6 +60,120 @@ class KademliaNodeTests(unittest.TestCase):
        reply = yield from self.node1.ping(self.node2_address, self.node1.identifier)
        self.assertEqual(reply, self.node2.identifier)
 
+    @async_unit
+    def test_metrics(self):
+        sent = self.node1.metrics.procedure('ping').snapshot()
+        received = self.node2.metrics.procedure('ping').snapshot()
+        yield from self.node1.ping(self.node2_address, self.node1.identifier)
+
+        ping = self.node1.metrics.procedure('ping')
+        self.assertEqual(sent['requests_sent'] + 1, ping.requests_sent)
+        self.assertEqual(sent['replies_received'] + 1, ping.replies_received)
+        self.assertEqual(sent['latency']['count'] + 1, ping.latency.count)
+        self.assertGreater(ping.bytes_out, sent['bytes_out'])
+        ping = self.node2.metrics.procedure('ping')
+        self.assertEqual(received['requests_received'] + 1, ping.requests_received)
+        self.assertEqual(received['replies_sent'] + 1, ping.replies_sent)
+
+        gauges = self.node1.gauges()
+        self.assertEqual(0, gauges['outstanding_requests'])
+        self.assertEqual(gauges['peers'], sum(gauges['bucket_fill'].values()))
+
+    @async_unit
+    def test_timeout_metrics(self):
+        timeouts = self.node1.metrics.procedure('ping').timeouts
+        self.node1.reply_timeout = 0.01
+        try:
+            yield from self.node1.ping(('127.0.0.1', 32003), self.node1.identifier)
+        except socket.timeout:
+            pass
+        self.assertEqual(timeouts + 1, self.node1.metrics.procedure('ping').timeouts)
+
+    @async_unit
+    def test_malformed_datagram(self):
+        self.transport2.sendto(b'not a kademlia message', self.node1_address)
+        reply = yield from self.node2.ping(self.node1_address, self.node2.identifier)
+        self.assertEqual(reply, self.node1.identifier)
+
+    def test_malformed_messages(self):
+        node = KademliaNode()
+        node.transport = mock.Mock()
+        for message in [('request', 1, 'ping', (), {}),
+                        ('request', 1, 'ping', ('not an identifier',), {}),
+                        ('request', 1, 'ping', (1, 2, 3), {}),
+                        ('request', 1, 'find_node', (1,), {'bogus': 2}),
+                        ('reply', 1, 'not a tuple')]:
+            node.datagram_received(node.codec.encode(message), ('127.0.0.1', 32003))
+        self.assertEqual(5, node.metrics.malformed)
+        self.assertFalse(node.transport.sendto.called)
+        self.assertFalse(node.routing_table.index)
+
+    @async_unit
+    def test_unencodable_request(self):
+        node = KademliaNode()
+        node.transport = mock.Mock()
+        with self.assertRaises(CodecError):
+            yield from node.store(('127.0.0.1', 32003), node.identifier, 1, {1, 2})
+        self.assertFalse(node.outstanding_requests)
+        self.assertFalse(node.transmissions)
+
+    @async_unit
+    def test_round_trip_times(self):
+        yield from self.node1.ping(self.node2_address, self.node1.identifier)
+        self.assertIn(self.node2_address, self.node1.round_trip_times)
+        self.assertFalse(self.node1.transmissions)
+        self.assertLessEqual(self.node1.round_trip_times.timeout(self.node2_address, 1), 1)
+
+    @async_unit
+    def test_retransmit(self):
+        dropped = []
+        original_request_received = self.node2.request_received
+        def drop_first(*args):
+            if not dropped:
+                dropped.append(args)
+                return
+            original_request_received(*args)
+
+        with mock.patch.object(self.node2, 'request_received', side_effect=drop_first):
+            self.node1.reply_timeout = 0.1
+            self.node1.retransmits = 1
+            try:
+                reply = yield from self.node1.ping(self.node2_address, self.node1.identifier)
+            finally:
+                self.node1.retransmits = 0
+        self.assertEqual(reply, self.node2.identifier)
+        self.assertEqual(1, len(dropped))
+        self.assertFalse(self.node1.transmissions)
+
+    @async_unit
+    def test_bootstrap(self):
+        summary = yield from self.node1.bootstrap([self.node2_address, ('127.0.0.1', 32003)], timeout=5)
+        self.assertEqual(1, summary['seeds'])
+        self.assertGreaterEqual(summary['peers'], 1)
+        self.assertTrue(self.node1.routing_table.has_peer(self.node2.identifier))
+
+    @async_unit
+    def test_bootstrap_without_seeds(self):
+        self.node1.reply_timeout = 0.01
+        try:
+            yield from self.node1.bootstrap([('127.0.0.1', 32003)])
+            self.assertFalse(True, 'should have failed') # pragma: no cover
+        except KeyError as e:
+            self.assertIn('No seeds answered', str(e))
+
+    @async_unit
+    def test_warm_start(self):
+        dead = (self.node2.identifier ^ 1, ('127.0.0.1', 32003))
+        self.node1.reply_timeout = 0.05
+        try:
+            summary = yield from self.node1.warm_start([(self.node2.identifier, self.node2_address), dead])
+        finally:
+            self.node1.reply_timeout = 5
+        self.assertGreaterEqual(summary['alive'], 1)
+        self.assertEqual(summary['contacts'] - 1, summary['alive'])
+        self.assertTrue(self.node1.routing_table.has_peer(self.node2.identifier))
+        self.assertFalse(self.node1.routing_table.has_peer(dead[0]))
+
     @async_unit
     def test_store_and_find(self):
         key = get_identifier('hello')
@@ -64,6 +182,67 @@ class KademliaNodeTests(unittest.TestCase):
         stored = yield from self.node1.find_value(self.node2_address, self.node1.identifier, key)
         self.assertEqual(('found', 'world'), stored)
 
+    @async_unit
+    def test_store_many_and_find_values(self):
+        keys = [get_identifier('many-{}'.format(i)) for i in range(3)]
+        reply = yield from self.node1.store_many(self.node2_address, self.node1.identifier,
+                                                 [(key, i) for i, key in enumerate(keys[:2])])
+        self.assertEqual([True, True], reply)
+        found = yield from self.node1.find_values(self.node2_address, self.node1.identifier, keys)
+        self.assertEqual([('found', 0), ('found', 1), ('notfound', None)], found)
+        found = yield from self.node1.find_at(self.node2_address, keys)
+        self.assertEqual({keys[0]: 0, keys[1]: 1}, found)
+
+    @async_unit
+    def test_large_values(self):
+        for value in [bytes(range(256)) * 800, ['ünïcödé value {}'.format(i) for i in range(10000)]]:
+            key = get_identifier(repr(type(value)))
+            stored = yield from self.node1.store_value(self.node2_address, key, value, ttl=60)
+            self.assertTrue(stored)
+            self.assertEqual(value, self.node2.storage[key])
+
+            result, (size, raw) = yield from self.node1.find_value(self.node2_address, self.node1.identifier, key)
+            self.assertEqual('chunked', result)
+            self.assertEqual(isinstance(value, bytes), raw)
+            fetched = yield from self.node1.fetch_value(self.node2_address, key, size, raw)
+            self.assertEqual(value, fetched)
+            self.assertIs(type(value), type(fetched))
+            self.assertIs(type(value), type(self.node2.storage[key]))
+        self.assertEqual(0, len(self.node2.incoming))
+
+    @async_unit
+    def test_large_value_for_peer_without_chunks(self):
+        key = get_identifier('large')
+        self.node2.storage[key] = b'x' * 5000
+        self.node2.extended_peers.clear()
+        result, value = yield from self.node1.find_value(self.node2_address, self.node1.identifier, key)
+        self.assertEqual(('found', b'x' * 5000), (result, value))
+        yield from self.node1.find_chunk(self.node2_address, self.node1.identifier, key, 0, 10)
+        result, _ = yield from self.node1.find_value(self.node2_address, self.node1.identifier, key)
+        self.assertEqual('chunked', result)
+
+    @async_unit
+    def test_fetch_missing_large_value(self):
+        fetched = yield from self.node1.fetch_value(self.node2_address, get_identifier('nothing'), 5000, True)
+        self.assertIsNone(fetched)
+
+    @async_unit
+    def test_store_with_ttl(self):
+        key = get_identifier('cached')
+        yield from self.node1.store(self.node2_address, self.node1.identifier, key, 'world', ttl=60)
+        self.assertLessEqual(self.node2.storage.expires_at(key), self.node2.storage.clock() + 60)
+        yield from self.node1.store(self.node2_address, self.node1.identifier, key, 'world', ttl=10**9)
+        self.assertLessEqual(self.node2.storage.expires_at(key), self.node2.storage.clock() + 86400)
+
+    @async_unit
+    def test_store_never_shortens_same_value(self):
+        key = get_identifier('replicated')
+        yield from self.node1.store(self.node2_address, self.node1.identifier, key, 'world')
+        yield from self.node1.store(self.node2_address, self.node1.identifier, key, 'world', ttl=60)
+        self.assertGreater(self.node2.storage.expires_at(key), self.node2.storage.clock() + 86000)
+        yield from self.node1.store(self.node2_address, self.node1.identifier, key, 'changed', ttl=60)
+        self.assertLessEqual(self.node2.storage.expires_at(key), self.node2.storage.clock() + 60)
+
     @async_unit
     def test_find_node(self):
         with mock.patch.object(self.node2.routing_table, 'find_closest_peers') as find_closest_peers:
@@ -82,6 +261,12 @@ class KademliaNodeTests(unittest.TestCase):
             self.assertEqual(('notfound', find_closest_peers.return_value), reply)
             find_closest_peers.assert_called_once_with(key, excluding=self.node1.identifier)
 
+    def test_subclass_inherits_rpcs(self):
+        class Subclass(KademliaNode):
+            pass
+        self.assertEqual(self.node1.reply_functions, Subclass().reply_functions)
+        self.assertIs(self.node1.codec, Subclass().codec)
+
 
 class IterativeProceduresTests(unittest.TestCase):
     @async_unit
@@ -108,6 +293,26 @@ class IterativeProceduresTests(unittest.TestCase):
                 mock.call(('10.0.0.2', 1002), 1234, get_identifier('hello'), 'world'),
             ])
 
+    @async_unit
+    def test_put_publishes_while_republishing(self):
+        node = KademliaNode(identifier=1234, storage=Storage(clock=Clock()))
+        with mock.patch.object(node, 'lookup_node') as lookup_node, \
+             mock.patch.object(node, 'store') as store:
+            lookup_node.side_effect = lambda key, find_value: returning([(1001, ('10.0.0.1', 1001))])
+            store.side_effect = lambda *args, **kwargs: returning(True)
+
+            yield from node.put('unpublished', 'value')
+            self.assertEqual({}, node.published)
+
+            node.start_republishing()
+            yield from node.put('hello', 'world', ttl=60)
+            store.assert_called_with(('10.0.0.1', 1001), 1234, get_identifier('hello'), 'world', ttl=60)
+            self.assertEqual({get_identifier('hello'): ('world', 1000.0, 1060.0)}, node.published)
+            self.assertTrue(node.unpublish('hello'))
+            self.assertFalse(node.unpublish('hello'))
+            self.assertEqual({}, node.published)
+            node.stop_republishing()
+
     @async_unit
     def test_get(self):
         node = KademliaNode(identifier=1234)
@@ -118,7 +323,72 @@ class IterativeProceduresTests(unittest.TestCase):
             answer = yield from node.get('hello')
             self.assertEqual('world', answer)
 
-            lookup_node.assert_called_once_with(get_identifier('hello'), find_value=True)
+            lookup_node.assert_called_once_with(get_identifier('hello'), find_value=True, stats={})
+
+    @async_unit
+    def test_get_caches_value(self):
+        node = KademliaNode(identifier=1234, cache_ttl=3600)
+        with mock.patch.object(node, 'lookup_node') as lookup_node, \
+             mock.patch.object(node, 'store') as store:
+            def local_lookup_node(hashed_key, find_value, stats):
+                stats['nearest_without_value'] = (2001, ('10.2.0.1', 2001))
+                stats['closer_peers'] = 2
+                future = asyncio.Future()
+                future.set_result('world')
+                return future
+            lookup_node.side_effect = local_lookup_node
+            store.return_value = asyncio.Future()
+            store.return_value.set_result(True)
+
+            answer = yield from node.get('hello')
+            self.assertEqual('world', answer)
+            yield from asyncio.sleep(0)
+            store.assert_called_once_with(('10.2.0.1', 2001), 1234, get_identifier('hello'), 'world', ttl=900)
+
+    @async_unit
+    def test_get_from_value_cache(self):
+        node = KademliaNode(identifier=1234)
+        with mock.patch.object(node, 'lookup_node') as lookup_node:
+            lookup_node.return_value = asyncio.Future()
+            lookup_node.return_value.set_result('world')
+
+            yield from node.get('hello')
+            answer = yield from node.get('hello')
+            self.assertEqual('world', answer)
+            self.assertEqual(1, lookup_node.call_count)
+
+    @async_unit
+    def test_get_caches_misses(self):
+        node = KademliaNode(identifier=1234)
+        with mock.patch.object(node, 'lookup_node') as lookup_node:
+            lookup_node.side_effect = KeyError(get_identifier('hello'), 'Not found among any available peers.')
+            for _ in range(2):
+                with self.assertRaises(KeyError):
+                    yield from node.get('hello')
+            self.assertEqual(1, lookup_node.call_count)
+
+            lookup_node.side_effect = None
+            lookup_node.return_value = asyncio.Future()
+            lookup_node.return_value.set_result([])
+            yield from node.put('hello', 'world')
+            answer = yield from node.get('hello')
+            self.assertEqual('world', answer)
+
+    @async_unit
+    def test_get_coalesces_lookups(self):
+        node = KademliaNode(identifier=1234)
+        with mock.patch.object(node, 'lookup_node') as lookup_node:
+            lookup_node.return_value = asyncio.Future()
+            gets = [asyncio.ensure_future(node.get('hello')) for _ in range(3)]
+            yield from asyncio.sleep(0.01)
+            self.assertEqual(1, lookup_node.call_count)
+            self.assertEqual(1, len(node.pending_gets))
+
+            gets[0].cancel()
+            lookup_node.return_value.set_result('world')
+            answers = yield from asyncio.gather(*gets[1:])
+            self.assertEqual(['world', 'world'], answers)
+            self.assertEqual({}, node.pending_gets)
 
     @async_unit
     def test_get_shortcircuit(self):
@@ -186,7 +456,9 @@ class IterativeProceduresTests(unittest.TestCase):
                 return future
             find_node.side_effect = local_find_node
 
-            other_contacts = yield from node.lookup_node(1500, find_value=False)
+            stats = {}
+            other_contacts = yield from node.lookup_node(1500, find_value=False, stats=stats)
+            self.assertEqual({'rpcs': 4, 'hops': 2}, stats)
             self.assertEqual([
                 (2001, ('10.2.0.1', 2001)),
                 (2002, ('10.2.0.2', 2002)),
@@ -194,14 +466,12 @@ class IterativeProceduresTests(unittest.TestCase):
                 (1001, ('10.1.0.1', 1001))
             ], other_contacts)
 
-            self.assertEqual(6, find_node.call_count)
+            self.assertEqual(4, find_node.call_count)
             find_node.assert_has_calls([
                 mock.call(('10.2.0.1', 2001), 123, 1500),
                 mock.call(('10.1.0.1', 1001), 123, 1500),
                 mock.call(('10.2.0.2', 2002), 123, 1500),
-                mock.call(('10.2.0.3', 2003), 123, 1500),
-                mock.call(('10.1.0.2', 1002), 123, 1500),
-                mock.call(('10.1.0.3', 1003), 123, 1500)
+                mock.call(('10.2.0.3', 2003), 123, 1500)
             ])
 
     @async_unit
@@ -242,16 +512,39 @@ class IterativeProceduresTests(unittest.TestCase):
                 return future
             find_value.side_effect = local_find_value
 
-            other_contacts = yield from node.lookup_node(1500, find_value=True)
+            stats = {}
+            other_contacts = yield from node.lookup_node(1500, find_value=True, stats=stats)
             self.assertEqual('world', other_contacts)
+            self.assertEqual(2, stats['hops'])
+            nearest = stats['nearest_without_value']
+            self.assertIn(nearest, {(2001, ('10.2.0.1', 2001)), (2003, ('10.2.0.3', 2003))})
+            between = [p for p in (1001, 2001, 2002, 2003) if 2002 ^ 1500 < p ^ 1500 < nearest[0] ^ 1500]
+            self.assertEqual(len(between), stats['closer_peers'])
 
-            self.assertEqual(3, find_value.call_count)
+            self.assertEqual(4, find_value.call_count)
             find_value.assert_has_calls([
                 mock.call(('10.2.0.1', 2001), 123, 1500),
                 mock.call(('10.1.0.1', 1001), 123, 1500),
-                mock.call(('10.2.0.2', 2002), 123, 1500)
+                mock.call(('10.2.0.2', 2002), 123, 1500),
+                mock.call(('10.2.0.3', 2003), 123, 1500)
             ])
 
+    @async_unit
+    def test_lookup_node_with_large_value(self):
+        node = KademliaNode(k=4, identifier=123)
+        with mock.patch.object(node.routing_table, 'find_closest_peers') as find_closest_peers, \
+             mock.patch.object(node, 'find_value') as find_value, \
+             mock.patch.object(node, 'fetch_value') as fetch_value:
+            find_closest_peers.return_value = [(1001, ('10.1.0.1', 1001))]
+            find_value.return_value = asyncio.Future()
+            find_value.return_value.set_result(('chunked', (5000, True)))
+            fetch_value.return_value = asyncio.Future()
+            fetch_value.return_value.set_result(b'x' * 5000)
+
+            value = yield from node.lookup_node(1500, find_value=True)
+            self.assertEqual(b'x' * 5000, value)
+            fetch_value.assert_called_once_with(('10.1.0.1', 1001), 1500, 5000, True)
+
     @async_unit
     def test_lookup_value_not_found(self):
         node = KademliaNode(k=4, identifier=123)
@@ -303,12 +596,464 @@ class IterativeProceduresTests(unittest.TestCase):
             except KeyError as e:
                 self.assertIn('Not found among any available peers.', str(e))
 
-            self.assertEqual(6, find_value.call_count)
+            self.assertEqual(4, find_value.call_count)
             find_value.assert_has_calls([
                 mock.call(('10.2.0.1', 2001), 123, 1500),
                 mock.call(('10.1.0.1', 1001), 123, 1500),
                 mock.call(('10.2.0.2', 2002), 123, 1500),
-                mock.call(('10.2.0.3', 2003), 123, 1500),
-                mock.call(('10.1.0.2', 1002), 123, 1500),
-                mock.call(('10.1.0.3', 1003), 123, 1500)
+                mock.call(('10.2.0.3', 2003), 123, 1500)
             ])
+
+    @async_unit
+    def test_lookup_node_in_parallel(self):
+        node = KademliaNode(k=2, alpha=3, identifier=123)
+        with mock.patch.object(node.routing_table, 'find_closest_peers') as find_closest_peers, \
+             mock.patch.object(node, 'find_node') as find_node:
+
+            find_closest_peers.return_value = [
+                (1001, ('10.0.0.1', 1001)),
+                (1002, ('10.0.0.2', 1002)),
+                (1003, ('10.0.0.3', 1003)),
+                (1004, ('10.0.0.4', 1004)),
+            ]
+
+            replies = {}
+            def local_find_node(peer, peer_identifier, key):
+                replies[peer] = asyncio.Future()
+                return replies[peer]
+            find_node.side_effect = local_find_node
+
+            lookup = asyncio.ensure_future(node.lookup_node(1000, find_value=False))
+            yield from asyncio.sleep(0.01)
+            self.assertEqual({('10.0.0.1', 1001), ('10.0.0.2', 1002)}, set(replies))
+
+            replies[('10.0.0.2', 1002)].set_exception(socket.timeout())
+            yield from asyncio.sleep(0)
+            yield from asyncio.sleep(0)
+            self.assertIn(('10.0.0.3', 1003), replies)
+            self.assertFalse(replies[('10.0.0.1', 1001)].done())
+
+            replies[('10.0.0.1', 1001)].set_result([])
+            replies[('10.0.0.3', 1003)].set_result([])
+            other_contacts = yield from lookup
+            self.assertEqual([
+                (1001, ('10.0.0.1', 1001)),
+                (1003, ('10.0.0.3', 1003)),
+            ], other_contacts)
+            self.assertEqual(3, find_node.call_count)
+
+    @async_unit
+    def test_lookup_node_single_flight(self):
+        node = KademliaNode(k=2, identifier=123)
+        with mock.patch.object(node.routing_table, 'find_closest_peers') as find_closest_peers, \
+             mock.patch.object(node, 'find_node') as find_node:
+            find_closest_peers.return_value = [(1001, ('10.0.0.1', 1001)), (1002, ('10.0.0.2', 1002))]
+            replies = []
+            def local_find_node(peer, peer_identifier, key):
+                replies.append(asyncio.Future())
+                return replies[-1]
+            find_node.side_effect = local_find_node
+
+            stats = [{}, {}, {}]
+            lookups = [asyncio.ensure_future(node.lookup_node(1000, stats=s)) for s in stats]
+            yield from asyncio.sleep(0.01)
+            self.assertEqual(2, find_node.call_count)
+            lookups[0].cancel()
+            for reply in replies:
+                reply.set_result([])
+            results = yield from asyncio.gather(*lookups[1:])
+            self.assertEqual(results[0], results[1])
+            self.assertEqual([{'rpcs': 2, 'hops': 1}, {'hops': 1}, {'hops': 1}], stats)
+            self.assertEqual({'lookups': 1, 'coalesced': 2, 'reused': 0, 'seeded': 0}, node.lookup_stats)
+            self.assertEqual({}, node.lookups_in_flight)
+
+            again = yield from node.lookup_node(1000)
+            self.assertEqual(results[0], again)
+            self.assertEqual(2, find_node.call_count)
+            self.assertEqual(1, node.lookup_stats['reused'])
+
+    @async_unit
+    def test_lookup_node_cancelled(self):
+        node = KademliaNode(k=2, identifier=123)
+        with mock.patch.object(node.routing_table, 'find_closest_peers') as find_closest_peers, \
+             mock.patch.object(node, 'find_node') as find_node:
+            find_closest_peers.return_value = [(1001, ('10.0.0.1', 1001))]
+            reply = asyncio.Future()
+            find_node.return_value = reply
+            lookup = asyncio.ensure_future(node.lookup_node(1000))
+            yield from asyncio.sleep(0.01)
+            lookup.cancel()
+            yield from asyncio.sleep(0.01)
+            self.assertTrue(reply.cancelled())
+            self.assertEqual({}, node.lookups_in_flight)
+
+    @async_unit
+    def test_lookup_node_seeded_by_recent_lookup(self):
+        node = KademliaNode(k=2, identifier=0, lookup_reuse=10)
+        loop = asyncio.get_event_loop()
+        node.remember_lookup(2**159, [(2**159 + 1, ('10.0.0.1', 1)), (2**159 + 2**100, ('10.0.0.2', 2))], loop.time())
+        self.assertEqual(2, len(node.recent_contacts(2**159 + 5, loop.time())))
+        self.assertEqual([], node.recent_contacts(2**159 + 2**101, loop.time()))
+        self.assertEqual([], node.recent_contacts(2**159 + 5, loop.time() + 10))
+
+        node.routing_table.update_peer(2**158, ('10.0.0.3', 3))
+        with mock.patch.object(node, 'find_node') as find_node:
+            def local_find_node(peer, peer_identifier, key):
+                future = asyncio.Future()
+                future.set_result([])
+                return future
+            find_node.side_effect = local_find_node
+            result = yield from node.lookup_node(2**159 + 5)
+        self.assertEqual([2**159 + 1, 2**159 + 2**100], [peer_identifier for peer_identifier, _ in result])
+        self.assertEqual(1, node.lookup_stats['seeded'])
+
+    @async_unit
+    def test_lookup_node_moves_past_stale_peers(self):
+        node = KademliaNode(k=2, alpha=1, identifier=123, stale_timeout=0.05)
+        with mock.patch.object(node.routing_table, 'find_closest_peers') as find_closest_peers, \
+             mock.patch.object(node.routing_table, 'forget_peer') as forget_peer, \
+             mock.patch.object(node, 'find_node') as find_node:
+
+            find_closest_peers.return_value = [
+                (1001, ('10.0.0.1', 1001)),
+                (1002, ('10.0.0.2', 1002)),
+            ]
+
+            replies = {}
+            def local_find_node(peer, peer_identifier, key):
+                replies[peer] = asyncio.Future()
+                if peer == ('10.0.0.2', 1002):
+                    replies[peer].set_result([])
+                return replies[peer]
+            find_node.side_effect = local_find_node
+
+            other_contacts = yield from node.lookup_node(1000, find_value=False)
+            self.assertEqual([(1002, ('10.0.0.2', 1002))], other_contacts)
+            self.assertEqual(2, find_node.call_count)
+            self.assertTrue(replies[('10.0.0.1', 1001)].cancelled())
+            self.assertFalse(forget_peer.called)
+
+
+class BatchTests(unittest.TestCase):
+    peers = [(2**159 + 1, ('10.0.0.1', 1)), (2**159 + 2, ('10.0.0.2', 2))]
+
+    def test_request_batches(self):
+        node = KademliaNode(datagram_size=200)
+        items = [(get_identifier(str(i)), 'x' * 40) for i in range(10)] + [(1, 'x' * 500)]
+        batches = node.request_batches('store_many', items, node.identifier)
+        self.assertEqual(items, [item for batch in batches for item in batch])
+        self.assertEqual([[(1, 'x' * 500)]], batches[-1:])
+        for batch in batches[:-1]:
+            self.assertGreater(len(batch), 1)
+            message = ('request', 2**160 - 1, 'store_many', (node.identifier, batch), {})
+            self.assertLessEqual(len(node.codec.encode(message)), 200)
+
+    def test_find_values_fits_reply(self):
+        node = KademliaNode(datagram_size=200)
+        keys = [get_identifier(str(i)) for i in range(10)]
+        for key in keys:
+            node.storage[key] = 'x' * 40
+        _, results = KademliaNode.find_values.reply_function(node, ('10.0.0.1', 1), 1, keys)
+        self.assertLess(0, len(results))
+        self.assertLess(len(results), len(keys))
+        self.assertEqual([('found', 'x' * 40)] * len(results), results)
+
+    @async_unit
+    def test_store_at_falls_back(self):
+        node = KademliaNode(identifier=0)
+        peer = ('10.0.0.1', 1)
+        with mock.patch.object(node, 'store_many') as store_many, \
+             mock.patch.object(node, 'store') as store, \
+             mock.patch.object(node, 'ping') as ping:
+            store_many.side_effect = lambda *args: timing_out()
+            store.side_effect = lambda *args: returning(True)
+            ping.side_effect = lambda *args: returning(1)
+
+            stored = yield from node.store_at(peer, [(1, 'a'), (2, 'b')])
+            self.assertEqual([True, True], stored)
+            self.assertIn(peer, node.legacy_peers)
+            self.assertEqual(2, store.call_count)
+
+            stored = yield from node.store_at(peer, [(3, 'c')])
+            self.assertEqual([True], stored)
+            self.assertEqual(2, store_many.call_count)
+
+            node.legacy_peers[peer] -= node.legacy_ttl
+            self.assertFalse(node.is_legacy(peer))
+            self.assertNotIn(peer, node.legacy_peers)
+
+    @async_unit
+    def test_store_at_retries_lost_batch(self):
+        node = KademliaNode(identifier=0)
+        peer = ('10.0.0.1', 1)
+        answers = [timing_out(), returning([True, True])]
+        with mock.patch.object(node, 'store_many') as store_many, \
+             mock.patch.object(node, 'ping') as ping:
+            store_many.side_effect = lambda *args: answers.pop(0)
+            stored = yield from node.store_at(peer, [(1, 'a'), (2, 'b')])
+            self.assertEqual([True, True], stored)
+            self.assertFalse(ping.called)
+            self.assertFalse(node.legacy_peers)
+
+    def test_legacy_peers_are_capped(self):
+        node = KademliaNode(identifier=0)
+        node.max_legacy_peers = 2
+        with mock.patch.object(node, 'ping') as ping:
+            ping.side_effect = lambda *args: returning(1)
+            for i in range(3):
+                asyncio.get_event_loop().run_until_complete(node.lacks_batching(('10.0.0.1', i)))
+        self.assertEqual([('10.0.0.1', 1), ('10.0.0.1', 2)], list(node.legacy_peers))
+
+    @async_unit
+    def test_find_at_asks_again(self):
+        node = KademliaNode(identifier=0)
+        with mock.patch.object(node, 'find_values') as find_values:
+            find_values.side_effect = lambda peer, peer_identifier, keys: returning(
+                [('found', key * 10) if key % 2 else ('notfound', None) for key in keys[:2]])
+            found = yield from node.find_at(('10.0.0.1', 1), [1, 2, 3, 4, 5])
+            self.assertEqual({1: 10, 3: 30, 5: 50}, found)
+            self.assertEqual(3, find_values.call_count)
+
+    @async_unit
+    def test_store_at_sends_large_values_alone(self):
+        node = KademliaNode(identifier=0)
+        large = b'x' * 5000
+        with mock.patch.object(node, 'store_many') as store_many, \
+             mock.patch.object(node, 'store_value') as store_value:
+            store_many.side_effect = lambda peer, peer_identifier, items: returning([True] * len(items))
+            store_value.side_effect = lambda *args: returning(True)
+            stored = yield from node.store_at(('10.0.0.1', 1), [(1, 'a'), (2, large), (3, 'c')])
+            self.assertEqual([True, True, True], stored)
+            store_many.assert_called_once_with(('10.0.0.1', 1), 0, [(1, 'a'), (3, 'c')])
+            store_value.assert_called_once_with(('10.0.0.1', 1), 2, large)
+
+    @async_unit
+    def test_store_value_falls_back(self):
+        node = KademliaNode(identifier=0)
+        with mock.patch.object(node, 'store_chunk') as store_chunk, \
+             mock.patch.object(node, 'store') as store, \
+             mock.patch.object(node, 'ping') as ping:
+            store_chunk.side_effect = lambda *args, **kwargs: timing_out()
+            store.side_effect = lambda *args, **kwargs: returning(True)
+            ping.side_effect = lambda *args: returning(1)
+            stored = yield from node.store_value(('10.0.0.1', 1), 1, b'x' * 5000)
+            self.assertTrue(stored)
+            self.assertEqual(4 * (node.chunk_retries + 1), store_chunk.call_count)
+            store.assert_called_once_with(('10.0.0.1', 1), 0, 1, b'x' * 5000)
+
+    @async_unit
+    def test_find_at_fetches_large_values(self):
+        node = KademliaNode(identifier=0)
+        with mock.patch.object(node, 'find_values') as find_values, \
+             mock.patch.object(node, 'fetch_value') as fetch_value:
+            find_values.side_effect = lambda *args: returning([('chunked', (5000, True)), ('found', 'b')])
+            fetch_value.side_effect = lambda *args: returning(b'x' * 5000)
+            found = yield from node.find_at(('10.0.0.1', 1), [1, 2])
+            self.assertEqual({1: b'x' * 5000, 2: 'b'}, found)
+            fetch_value.assert_called_once_with(('10.0.0.1', 1), 1, 5000, True)
+
+    @async_unit
+    def test_find_at_falls_back(self):
+        node = KademliaNode(identifier=0)
+        with mock.patch.object(node, 'find_values') as find_values, \
+             mock.patch.object(node, 'find_value') as find_value, \
+             mock.patch.object(node, 'ping') as ping:
+            find_values.side_effect = lambda *args: timing_out()
+            find_value.side_effect = lambda peer, peer_identifier, key: returning(
+                ('found', 'value') if key == 1 else ('notfound', []))
+            ping.side_effect = lambda *args: returning(1)
+            found = yield from node.find_at(('10.0.0.1', 1), [1, 2])
+            self.assertEqual({1: 'value'}, found)
+
+    @async_unit
+    def test_locate_many(self):
+        node = KademliaNode(k=2, identifier=0)
+        node.routing_table.update_peer(2**158, ('10.0.0.3', 3))
+        with mock.patch.object(node, 'lookup_node') as lookup_node:
+            lookup_node.side_effect = lambda key: returning(self.peers)
+            located = yield from node.locate_many([2**159 + 7, 2**159 + 5, 2**159 + 6, 5], prefix_bits=16)
+            self.assertEqual([mock.call(5), mock.call(2**159 + 6)], sorted(lookup_node.call_args_list))
+        self.assertEqual(self.peers, located[2**159 + 5])
+        self.assertEqual([(2**158, ('10.0.0.3', 3)), self.peers[0]], located[5])
+
+    @async_unit
+    def test_locate_many_estimates_prefix(self):
+        node = KademliaNode(k=2, identifier=0)
+        with mock.patch.object(node, 'lookup_node') as lookup_node:
+            lookup_node.side_effect = lambda key: returning(self.peers)
+            keys = [2**159 + 5, 2**159 + 6, 2**159 + 7, 2**159 + 8]
+            located = yield from node.locate_many(keys)
+            calls = lookup_node.call_args_list
+            self.assertEqual(mock.call(2**159 + 7), calls[0])
+            self.assertEqual([mock.call(2**159 + 6), mock.call(2**159 + 8)], sorted(calls[1:]))
+        self.assertEqual(set(keys), set(located))
+
+    @async_unit
+    def test_locate_many_without_peers(self):
+        node = KademliaNode(k=2, identifier=0)
+        located = yield from node.locate_many([1, 2])
+        self.assertEqual({}, located)
+
+    @async_unit
+    def test_put_many(self):
+        node = KademliaNode(k=2, identifier=0)
+        node.start_republishing()
+        with mock.patch.object(node, 'lookup_node') as lookup_node, \
+             mock.patch.object(node, 'store_many') as store_many, \
+             mock.patch.object(node, 'ping') as ping:
+            lookup_node.side_effect = lambda key: returning(self.peers)
+            def local_store_many(peer, peer_identifier, items):
+                if peer == ('10.0.0.2', 2):
+                    return timing_out()
+                return returning([True] * len(items))
+            store_many.side_effect = local_store_many
+            ping.side_effect = lambda peer, peer_identifier: timing_out()
+
+            accepted = yield from node.put_many({'a': 1, 'b': 2, 'c': 3})
+            self.assertEqual({'a': 1, 'b': 1, 'c': 1}, accepted)
+            self.assertEqual(3, store_many.call_count)
+            stored = sorted(item for args, _ in store_many.call_args_list for item in args[2])
+            self.assertEqual(sorted(3 * [(get_identifier('a'), 1), (get_identifier('b'), 2),
+                                         (get_identifier('c'), 3)]), stored)
+        self.assertEqual(3, len(node.published))
+        node.stop_republishing()
+
+    @async_unit
+    def test_get_many(self):
+        node = KademliaNode(k=2, identifier=0)
+        node.storage[get_identifier('stored')] = 'here'
+        node.value_cache.found(get_identifier('cached'), 'recently')
+        node.value_cache.not_found(get_identifier('missing'))
+        with mock.patch.object(node, 'lookup_node') as lookup_node, \
+             mock.patch.object(node, 'find_values') as find_values, \
+             mock.patch.object(node, 'get') as get:
+            lookup_node.side_effect = lambda key: returning(self.peers)
+            find_values.side_effect = lambda peer, peer_identifier, keys: returning(
+                [('found', 'found') if key == get_identifier('remote') else ('notfound', None) for key in keys])
+            def local_get(raw_key):
+                if raw_key == 'elsewhere':
+                    return returning('fallen back')
+                future = asyncio.Future()
+                future.set_exception(KeyError(raw_key))
+                return future
+            get.side_effect = local_get
+
+            values = yield from node.get_many(['stored', 'cached', 'missing', 'remote', 'elsewhere', 'gone'])
+            self.assertEqual({'stored': 'here', 'cached': 'recently', 'remote': 'found',
+                              'elsewhere': 'fallen back'}, values)
+            self.assertEqual(2, find_values.call_count)
+            self.assertEqual([mock.call('elsewhere'), mock.call('gone')], sorted(get.call_args_list))
+        self.assertEqual((True, 'found'), node.value_cache.lookup(get_identifier('remote')))
+
+
+class LivenessTests(unittest.TestCase):
+    def fill_bucket(self, node):
+        for peer_identifier in (2**159 + 1, 2**159 + 2):
+            self.assertIsNone(node.routing_table.update_peer(peer_identifier, ('10.0.0.1', peer_identifier % 2**16)))
+
+    @async_unit
+    def test_evicts_dead_peer(self):
+        node = KademliaNode(k=2, identifier=1)
+        self.fill_bucket(node)
+        with mock.patch.object(node, 'ping') as ping:
+            ping.return_value = asyncio.Future()
+            ping.return_value.set_exception(socket.timeout())
+
+            node.update_peer(2**159 + 3, ('10.0.0.3', 3))
+            node.update_peer(2**159 + 4, ('10.0.0.4', 4))
+            self.assertEqual([2**159 + 1], list(node.liveness_checks))
+            alive = yield from node.liveness_checks[2**159 + 1]
+
+            self.assertFalse(alive)
+            ping.assert_called_once_with(('10.0.0.1', 1), 1)
+            self.assertFalse(node.liveness_checks)
+            bucket = node.routing_table.buckets[0]
+            self.assertEqual([2**159 + 2, 2**159 + 4], list(bucket))
+            self.assertEqual([2**159 + 3], list(node.routing_table.replacement_caches[0]))
+
+    @async_unit
+    def test_keeps_live_peer(self):
+        node = KademliaNode(k=2, identifier=1)
+        self.fill_bucket(node)
+        with mock.patch.object(node, 'ping') as ping:
+            ping.return_value = asyncio.Future()
+            ping.return_value.set_result(2**159 + 1)
+
+            node.update_peer(2**159 + 3, ('10.0.0.3', 3))
+            alive = yield from node.liveness_checks[2**159 + 1]
+
+            self.assertTrue(alive)
+            self.assertEqual([2**159 + 1, 2**159 + 2], sorted(node.routing_table.buckets[0]))
+            self.assertEqual([2**159 + 3], list(node.routing_table.replacement_caches[0]))
+
+    @async_unit
+    def test_keeps_busy_peer(self):
+        node = KademliaNode(k=2, identifier=1)
+        self.fill_bucket(node)
+        with mock.patch.object(node, 'ping') as ping:
+            ping.return_value = asyncio.Future()
+            ping.return_value.set_exception(PeerBusy())
+
+            node.update_peer(2**159 + 3, ('10.0.0.3', 3))
+            alive = yield from node.liveness_checks[2**159 + 1]
+
+            self.assertTrue(alive)
+            self.assertEqual([2**159 + 1, 2**159 + 2], sorted(node.routing_table.buckets[0]))
+
+
+class SlowNode(KademliaNode):
+    @remote
+    @asyncio.coroutine
+    def slow_ping(self, peer, peer_identifier, delay):
+        yield from asyncio.sleep(delay)
+        return (self.identifier, self.identifier)
+
+
+class AsyncReplyTests(unittest.TestCase):
+    def setUp(self):
+        self.original_loop = asyncio.get_event_loop()
+        self.loop = SimulatedEventLoop()
+        asyncio.set_event_loop(self.loop)
+        self.network = SimulatedNetwork(latency=0.05)
+        self.client = self.network.create_endpoint(SlowNode, self.network.address(0))[1]
+        self.server = self.network.create_endpoint(lambda: SlowNode(max_concurrent_replies=2, max_reply_backlog=1),
+                                                   self.network.address(1))[1]
+
+    def tearDown(self):
+        self.loop.run_until_complete(asyncio.sleep(60))
+        self.loop.close()
+        asyncio.set_event_loop(self.original_loop)
+
+    def slow_pings(self, count, delay=1):
+        return [asyncio.ensure_future(self.client.slow_ping(self.network.address(1), self.client.identifier, delay))
+                for _ in range(count)]
+
+    def test_replies_concurrently(self):
+        started = self.loop.time()
+        replies = self.loop.run_until_complete(asyncio.gather(*self.slow_pings(2)))
+        self.assertEqual([self.server.identifier] * 2, replies)
+        self.assertAlmostEqual(1.1, self.loop.time() - started, places=3)
+        self.assertEqual(0, self.server.gauges()['running_replies'])
+
+    def test_answers_other_requests_while_replying(self):
+        pending = self.slow_pings(1, delay=3)
+        reply = self.loop.run_until_complete(self.client.ping(self.network.address(1), self.client.identifier))
+        self.assertEqual(self.server.identifier, reply)
+        self.assertFalse(pending[0].done())
+        self.loop.run_until_complete(pending[0])
+
+    def test_sheds_load_when_busy(self):
+        started = self.loop.time()
+        results = self.loop.run_until_complete(asyncio.gather(*self.slow_pings(4), return_exceptions=True))
+        busy = [result for result in results if isinstance(result, PeerBusy)]
+        self.assertEqual(1, len(busy))
+        self.assertEqual([self.server.identifier] * 3, [result for result in results if result not in busy])
+        self.assertAlmostEqual(2.1, self.loop.time() - started, places=3)
+
+        self.assertEqual(1, self.server.metrics.procedure('slow_ping').shed)
+        self.assertEqual(3, self.server.metrics.procedure('slow_ping').replies_sent)
+        self.assertEqual(1, self.client.metrics.procedure('slow_ping').busy)
+        self.assertEqual(0, self.client.metrics.procedure('slow_ping').timeouts)
+        self.assertFalse(self.client.outstanding_requests)
+        self.assertFalse(self.client.transmissions)
+        self.assertIn(self.server.identifier, self.client.routing_table.index)
@@ -0,0 +1,140 @@
+# coding: utf-8
+import asyncio
+import unittest
+
+import mock
+
+from kademlia_aio import KademliaNode
+from kademlia_aio.republish import Republisher
+from kademlia_aio.storage import Storage
+from tests.helpers import Clock, returning
+from tests.test_node import async_unit
+
+
+class RepublisherTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock(100000.0)
+        self.node = KademliaNode(k=2, identifier=0, storage=Storage(clock=self.clock))
+        self.peers = [(2**159 + i * 2**100, ('10.0.0.{}'.format(i), 9000 + i)) for i in range(4)]
+        for peer_identifier, peer in self.peers:
+            self.node.routing_table.update_peer(peer_identifier, peer)
+        self.republisher = Republisher(self.node, republish_interval=100, replicate_interval=10,
+                                       prefix_bits=8, bandwidth=10**9)
+
+    def lookup_node(self, hashed_key, stats=None):
+        stats['rpcs'] = stats.get('rpcs', 0) + 3
+        return returning(sorted(self.peers, key=lambda peer: peer[0] ^ hashed_key)[:2])
+
+    def test_due_keys(self):
+        self.node.storage[1] = 'fresh'
+        self.node.published[2] = ('mine', self.clock.now, None)
+        self.assertEqual({}, self.republisher.due_keys())
+        self.assertEqual(1, self.republisher.stats['skipped'])
+
+        self.clock.now += 10
+        self.assertEqual({1: 'fresh'}, self.republisher.due_keys())
+        self.assertEqual({}, self.republisher.due_keys())
+
+        self.clock.now += 5
+        self.node.storage[1] = 'stored by a peer'
+        self.clock.now += 5
+        self.assertEqual({}, self.republisher.due_keys())
+
+        self.clock.now += 100
+        self.assertEqual({1: 'stored by a peer', 2: 'mine'}, self.republisher.due_keys())
+        self.assertEqual(1, self.republisher.stats['republished'])
+        self.assertEqual(2, self.republisher.stats['replicated'])
+
+    def test_forgets_expired_keys(self):
+        self.node.storage.default_ttl = 15
+        self.node.storage[1] = 'value'
+        self.clock.now += 10
+        self.republisher.due_keys()
+        self.assertIn(1, self.republisher.replicated)
+        self.clock.now += 10
+        self.assertEqual({}, self.republisher.due_keys())
+        self.assertNotIn(1, self.republisher.replicated)
+
+    def test_forgets_expired_published_keys(self):
+        self.node.published[2] = ('short', self.clock.now - 100, self.clock.now + 50)
+        self.node.published[3] = ('shorter', self.clock.now - 100, self.clock.now)
+        self.assertEqual({2: 'short'}, self.republisher.due_keys())
+        self.assertEqual(50, self.republisher.remaining_ttl(2))
+        self.assertNotIn(3, self.node.published)
+
+    def test_skips_cached_copies(self):
+        self.node.storage.set(1, 'cached', ttl=50)
+        self.clock.now += 10
+        self.assertEqual({}, self.republisher.due_keys())
+
+    def test_replicates_replicas(self):
+        self.node.storage.set(1, 'replica', ttl=self.node.cache_ttl + 50)
+        self.clock.now += 10
+        self.assertEqual({1: 'replica'}, self.republisher.due_keys())
+        self.assertEqual(self.node.cache_ttl + 40, self.republisher.remaining_ttl(1))
+
+    @async_unit
+    def test_replicates_remaining_ttl(self):
+        self.node.storage.default_ttl = 100
+        self.node.storage[2**159 + 1] = 'replica'
+        self.clock.now += 30
+
+        with mock.patch.object(self.node, 'lookup_node') as lookup_node, \
+             mock.patch.object(self.node, 'store') as store:
+            lookup_node.side_effect = self.lookup_node
+            store.side_effect = lambda *args, **kwargs: returning(True)
+            yield from self.republisher.republish()
+
+            self.assertEqual(2, store.call_count)
+            for args, kwargs in store.call_args_list:
+                self.assertEqual({'ttl': 70.0}, kwargs)
+
+    def test_group_keys(self):
+        keys = [2**159 + 1, 5, 2**159 + 2**152, 2**159]
+        self.assertEqual([[5], [2**159, 2**159 + 1], [2**159 + 2**152]], self.republisher.group_keys(keys))
+
+    @async_unit
+    def test_republish(self):
+        self.node.published[2**159 + 1] = ('a', self.clock.now - 100, None)
+        self.node.published[2**159 + 2] = ('b', self.clock.now - 100, None)
+        self.node.published[3] = ('c', self.clock.now, None)
+
+        with mock.patch.object(self.node, 'lookup_node') as lookup_node, \
+             mock.patch.object(self.node, 'store') as store:
+            lookup_node.side_effect = self.lookup_node
+            store.side_effect = lambda *args: returning(True)
+            yield from self.republisher.republish()
+
+            lookup_node.assert_called_once_with(2**159 + 2, stats=mock.ANY)
+            self.assertEqual(4, store.call_count)
+            stored = sorted((args[0], args[2], args[3]) for args, _ in store.call_args_list)
+            self.assertEqual([(('10.0.0.0', 9000), 2**159 + 1, 'a'),
+                              (('10.0.0.0', 9000), 2**159 + 2, 'b'),
+                              (('10.0.0.1', 9001), 2**159 + 1, 'a'),
+                              (('10.0.0.1', 9001), 2**159 + 2, 'b')], stored)
+
+        stats = self.republisher.stats
+        self.assertEqual(1, stats['passes'])
+        self.assertEqual(2, stats['republished'])
+        self.assertEqual(0, stats['failures'])
+        self.assertEqual(7, stats['rpcs'])
+        self.assertEqual(3 * 600 + 4 * 601, stats['bytes'])
+
+    @async_unit
+    def test_republish_failures(self):
+        self.node.storage[2**159] = 'value'
+        self.clock.now += 10
+
+        with mock.patch.object(self.node, 'lookup_node') as lookup_node:
+            lookup_node.side_effect = KeyError(2**159, 'No peers available.')
+            yield from self.republisher.republish()
+        self.assertEqual(1, self.republisher.stats['failures'])
+
+    @async_unit
+    def test_start_and_stop(self):
+        republisher = self.node.start_republishing(check_interval=0.01, jitter=0)
+        self.assertIs(republisher, self.node.start_republishing())
+        yield from asyncio.sleep(0.05)
+        self.node.stop_republishing()
+        self.assertIsNone(self.node.republisher)
+        self.assertGreaterEqual(republisher.stats['passes'], 1)
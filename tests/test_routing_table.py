@@ -1,7 +1,8 @@
 # coding: utf-8
 import unittest
 
-from kademlia_aio import RoutingTable, get_identifier
+from kademlia_aio import (KademliaNode, RoutingTable, SplittingRoutingTable, find_closest_identifiers,
+                          get_identifier, get_random_identifier)
 
 
 class RoutingTableTests(unittest.TestCase):
@@ -12,6 +13,19 @@ class RoutingTableTests(unittest.TestCase):
         self.assertEqual(160, len(table.buckets))
         self.assertEqual(160, len(table.replacement_caches))
 
+    def test_lazy_buckets(self):
+        table = RoutingTable(0b0001)
+        self.assertEqual({}, table.buckets.allocated)
+        self.assertEqual({}, table.replacement_caches.allocated)
+        self.assertEqual(160, len(list(table.buckets)))
+
+        table.update_peer(0b0000, ('10.0.0.1', 12345))
+        self.assertEqual([159], list(table.buckets.allocated))
+        table.forget_peer(0b0000)
+        table.forget_peer(0b0010)
+        self.assertEqual({}, table.buckets.allocated)
+        self.assertRaises(IndexError, lambda: table.buckets[160])
+
     def test_distance(self):
         table = RoutingTable(0b0001)
         self.assertEqual(0b0000, table.distance(0b0001))
@@ -36,6 +50,16 @@ class RoutingTableTests(unittest.TestCase):
         self.assertRaises(ValueError, table.bucket_index, -1)
         self.assertRaises(ValueError, table.bucket_index, 2**160)
 
+    def test_bucket_range(self):
+        table = RoutingTable(0b0001)
+        self.assertEqual((0b0000, 0b0001), table.bucket_range(159))
+        self.assertEqual((0b0010, 0b0100), table.bucket_range(158))
+        self.assertEqual((2**159, 2**160), table.bucket_range(0))
+        for i in (0, 1, 80, 158, 159):
+            lowest, highest = table.bucket_range(i)
+            self.assertEqual(i, table.bucket_index(lowest))
+            self.assertEqual(i, table.bucket_index(highest - 1))
+
     def test_update_peer_self(self):
         table = RoutingTable(0b0001)
         table.update_peer(0b0001, ('10.0.0.1', 12345))
@@ -117,7 +141,7 @@ class RoutingTableTests(unittest.TestCase):
         self.assertEqual(5, len(bucket))
         self.assertEqual([one, two, three, four, five], list(bucket.keys()))
 
-        table.update_peer(six, 'six')
+        self.assertEqual((one, 'one'), table.update_peer(six, 'six'))
         self.assertEqual(5, len(bucket))
         self.assertEqual(1, len(replacement_cache))
         self.assertEqual('six', replacement_cache[six])
@@ -168,9 +192,9 @@ class RoutingTableTests(unittest.TestCase):
         table.update_peer(0b0011, 'three')
 
         self.assertEqual([
+            (0b0001, 'one'),
             (0b0011, 'three'),
-            (0b0010, 'two'),
-            (0b0001, 'one')
+            (0b0010, 'two')
         ], table.find_closest_peers(0b0101))
 
         self.assertEqual([
@@ -198,11 +222,11 @@ class RoutingTableTests(unittest.TestCase):
         table.update_peer(0b1001, 'nine')
 
         self.assertEqual([
+            (0b0100, 'four'),
             (0b0111, 'seven'),
             (0b0110, 'six'),
-            (0b0100, 'four'),
+            (0b0001, 'one'),
             (0b0011, 'three'),
-            (0b0010, 'two'),
         ], table.find_closest_peers(0b0101))
 
         self.assertEqual([
@@ -220,3 +244,114 @@ class RoutingTableTests(unittest.TestCase):
             (0b0100, 'four'),
             (0b0011, 'three'),
         ], table.find_closest_peers(2**160-1, excluding=0b1000))
+
+    def test_finding_peers_after_forgetting(self):
+        table = RoutingTable(0b0000, k=1)
+        table.update_peer(0b0100, 'four')
+        table.update_peer(0b0101, 'five')
+        table.update_peer(0b0011, 'three')
+        self.assertEqual([(0b0100, 'four'), (0b0011, 'three')], table.find_closest_peers(0b0101, k=2))
+
+        table.forget_peer(0b0100)
+        self.assertEqual([(0b0101, 'five'), (0b0011, 'three')], table.find_closest_peers(0b0101, k=2))
+        self.assertEqual([0b0011, 0b0101], table.index)
+
+    def test_find_closest_identifiers(self):
+        identifiers = sorted(get_random_identifier() for _ in range(500))
+        for _ in range(50):
+            key = get_random_identifier()
+            for count in (0, 1, 7, 20, 499, 500, 501):
+                expected = sorted(identifiers, key=lambda i: i ^ key)[:count]
+                self.assertEqual(expected, find_closest_identifiers(identifiers, key, count))
+        self.assertEqual([identifiers[3]], find_closest_identifiers(identifiers, identifiers[3], 1))
+        self.assertEqual([], find_closest_identifiers([], 1234, 20))
+
+
+class SplittingRoutingTableTests(unittest.TestCase):
+    def test_construction(self):
+        table = SplittingRoutingTable(0b0001, k=2)
+        self.assertEqual(1, len(table.buckets))
+        self.assertEqual((0, 2**160), table.bucket_range(0))
+        self.assertEqual(0, table.bucket_index(2**160-1))
+
+    def test_split_own_bucket(self):
+        table = SplittingRoutingTable(0, k=2)
+        table.update_peer(2**159 + 1, 'one')
+        table.update_peer(2**159 + 2, 'two')
+        self.assertEqual(1, len(table.buckets))
+
+        table.update_peer(1, 'near')
+        self.assertEqual(2, len(table.buckets))
+        self.assertEqual([(0, 2**159), (2**159, 2**160)], [table.bucket_range(i) for i in range(2)])
+        self.assertEqual({1: 'near'}, dict(table.buckets[0]))
+        self.assertEqual({2**159 + 1: 'one', 2**159 + 2: 'two'}, dict(table.buckets[1]))
+
+    def test_far_bucket_does_not_split(self):
+        table = SplittingRoutingTable(0, k=2)
+        for i in range(1, 4):
+            table.update_peer(i, 'near')
+        table.update_peer(2**159 + 1, 'one')
+        table.update_peer(2**159 + 2, 'two')
+        self.assertEqual((2**159 + 1, 'one'), table.update_peer(2**159 + 3, 'three'))
+
+        far = table.bucket_index(2**159)
+        self.assertEqual((2**159, 2**160), table.bucket_range(far))
+        self.assertEqual([2**159 + 1, 2**159 + 2], list(table.buckets[far]))
+        self.assertEqual({2**159 + 3: 'three'}, dict(table.replacement_caches[far]))
+
+        table.forget_peer(2**159 + 1)
+        self.assertEqual([2**159 + 2, 2**159 + 3], list(table.buckets[far]))
+        self.assertIn(2**159 + 3, table.index)
+
+    def test_relaxed_split(self):
+        table = SplittingRoutingTable(0, k=2)
+        table.update_peer(2**159 + 1, 'one')
+        table.update_peer(2**159 + 2, 'two')
+        table.update_peer(1, 'near')
+        table.update_peer(2**159, 'closer')
+        for peer_identifier in (1, 2**159, 2**159 + 1, 2**159 + 2):
+            self.assertTrue(table.has_peer(peer_identifier))
+        self.assertEqual([(2**159, 'closer'), (2**159 + 1, 'one')],
+                         table.find_closest_peers(2**159, k=2))
+
+    def test_strict_split(self):
+        table = SplittingRoutingTable(0, k=2, relaxed=False)
+        table.update_peer(2**159 + 1, 'one')
+        table.update_peer(2**159 + 2, 'two')
+        table.update_peer(1, 'near')
+        table.update_peer(2**159, 'closer')
+        self.assertFalse(table.has_peer(2**159))
+        self.assertEqual({2**159: 'closer'}, dict(table.replacement_caches[table.bucket_index(2**159)]))
+
+    def test_accelerated_split(self):
+        table = SplittingRoutingTable(0, k=2, relaxed=False, b=2)
+        table.update_peer(1, 'near')
+        table.update_peer(2**159 + 1, 'one')
+        table.update_peer(2**159 + 2, 'two')
+        table.update_peer(2**158 * 3, 'three')
+        self.assertTrue(table.has_peer(2**158 * 3))
+        self.assertEqual(4, len(table.index))
+
+    def test_split_promotes_replacements(self):
+        table = SplittingRoutingTable(0, k=2, relaxed=False)
+        table.update_peer(2**159 + 1, 'one')
+        table.update_peer(2**159 + 2, 'two')
+        table.replacement_caches[0][3] = 'three'
+        table.update_peer(1, 'near')
+        self.assertEqual({1: 'near', 3: 'three'}, dict(table.buckets[0]))
+        self.assertEqual([1, 3, 2**159 + 1, 2**159 + 2], table.index)
+
+    def test_many_peers(self):
+        table = SplittingRoutingTable(get_random_identifier(), k=4)
+        identifiers = [get_random_identifier() for _ in range(1000)]
+        for peer_identifier in identifiers:
+            table.update_peer(peer_identifier, 'peer')
+        self.assertEqual(sorted(table.index), table.index)
+        self.assertEqual(sum(len(bucket) for bucket in table.buckets), len(table.index))
+        closest = sorted(identifiers, key=table.distance)[:4]
+        self.assertEqual(closest, [i for i, _ in table.find_closest_peers(table.node_identifier)])
+
+    def test_node(self):
+        node = KademliaNode(k=4, routing_table_class=SplittingRoutingTable)
+        self.assertIsInstance(node.routing_table, SplittingRoutingTable)
+        self.assertEqual(4, node.routing_table.k)
@@ -0,0 +1,103 @@
+# coding: utf-8
+import asyncio
+import random
+import socket
+import time
+import unittest
+
+from kademlia_aio import KademliaNode, get_identifier
+from kademlia_aio.simulation import SimulatedEventLoop, SimulatedNetwork
+
+
+class SimulationTests(unittest.TestCase):
+    def setUp(self):
+        self.original_loop = asyncio.get_event_loop()
+        self.loop = SimulatedEventLoop(start=1000.0)
+        asyncio.set_event_loop(self.loop)
+        self.network = SimulatedNetwork(latency=0.05, jitter=0.01, seed=1)
+        random.seed(1)
+
+    def tearDown(self):
+        self.loop.run_until_complete(asyncio.sleep(60))
+        self.loop.close()
+        asyncio.set_event_loop(self.original_loop)
+
+    def run_until_complete(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def create_nodes(self, count, **kwargs):
+        kwargs.setdefault('clock', self.loop.time)
+        return [self.network.create_endpoint(lambda: KademliaNode(**kwargs), self.network.address(i))[1]
+                for i in range(count)]
+
+    def test_virtual_clock(self):
+        started = time.monotonic()
+        self.run_until_complete(asyncio.sleep(3600))
+        self.assertGreaterEqual(self.loop.time(), 4600.0)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_latency(self):
+        node1, node2 = self.create_nodes(2)
+        started = self.loop.time()
+        reply = self.run_until_complete(node1.ping(self.network.address(1), node1.identifier))
+        self.assertEqual(node2.identifier, reply)
+        self.assertAlmostEqual(0.1, self.loop.time() - started, delta=0.03)
+        self.assertEqual(2, self.network.stats['delivered'])
+
+    def test_put_and_get(self):
+        nodes = self.create_nodes(50, k=8)
+        seeds = [self.network.address(0)]
+        self.run_until_complete(asyncio.gather(*[node.bootstrap(seeds) for node in nodes[1:]]))
+        self.assertEqual(8, self.run_until_complete(nodes[10].put('hello', 'world')))
+        self.assertEqual('world', self.run_until_complete(nodes[40].get('hello')))
+
+    def test_get_caches_along_path(self):
+        nodes = self.create_nodes(100, k=8, alpha=1)
+        seeds = [self.network.address(0)]
+        for node in nodes[1:]:
+            self.run_until_complete(node.bootstrap(seeds))
+        self.assertEqual(8, self.run_until_complete(nodes[10].put('hello', 'world')))
+        hashed_key = get_identifier('hello')
+        holders = [node for node in nodes if hashed_key in node.storage]
+        getters = [node for node in nodes if node not in holders]
+        for node in getters:
+            self.assertEqual('world', self.run_until_complete(node.get('hello')))
+        self.run_until_complete(asyncio.sleep(1))
+
+        cached = [node for node in getters if hashed_key in node.storage]
+        self.assertTrue(cached)
+        for node in cached:
+            self.assertTrue(node.storage.explicit_ttl(hashed_key))
+            self.assertGreater(node.storage.expires_at(hashed_key), self.loop.time() + 60)
+
+    def test_storage_on_virtual_clock(self):
+        node, = self.create_nodes(1)
+        node.store_locally(1, 'value', ttl=10)
+        self.assertEqual(1010.0, node.storage.expires_at(1))
+        self.run_until_complete(asyncio.sleep(10))
+        self.assertNotIn(1, node.storage)
+
+    def test_loss(self):
+        self.network.loss = 1
+        node1, _ = self.create_nodes(2, reply_timeout=1)
+        self.assertRaises(socket.timeout, self.run_until_complete,
+                          node1.ping(self.network.address(1), node1.identifier))
+        self.assertEqual(1, self.network.stats['lost'])
+
+    def test_partition(self):
+        node1, node2, node3 = self.create_nodes(3, reply_timeout=1)
+        addresses = [self.network.address(i) for i in range(3)]
+        self.network.partition(addresses[:1], addresses[1:])
+        self.assertRaises(socket.timeout, self.run_until_complete, node1.ping(addresses[1], node1.identifier))
+        self.assertEqual(node3.identifier, self.run_until_complete(node2.ping(addresses[2], node2.identifier)))
+
+        self.network.heal()
+        self.assertEqual(node2.identifier, self.run_until_complete(node1.ping(addresses[1], node1.identifier)))
+
+    def test_churn(self):
+        node1, node2 = self.create_nodes(2, reply_timeout=1)
+        node2.transport.close()
+        self.assertRaises(socket.timeout, self.run_until_complete,
+                          node1.ping(self.network.address(1), node1.identifier))
+        self.assertEqual(1, self.network.stats['unreachable'])
+        self.assertRaises(ValueError, self.network.create_endpoint, KademliaNode, self.network.address(0))
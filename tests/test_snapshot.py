@@ -0,0 +1,59 @@
+# coding: utf-8
+import asyncio
+import os
+import tempfile
+import unittest
+
+from kademlia_aio import KademliaNode, SplittingRoutingTable
+from kademlia_aio.snapshot import load_snapshot, save_snapshot
+from tests.test_node import async_unit
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'routing')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def filled_node(self, **kwargs):
+        node = KademliaNode(k=2, identifier=0, **kwargs)
+        for i in range(8):
+            node.routing_table.update_peer(2**159 + i, ('10.0.0.{}'.format(i), 9000 + i))
+        node.routing_table.update_peer(1, ('::1', 9100))
+        return node
+
+    def test_round_trip(self):
+        for routing_table_class in [None, SplittingRoutingTable]:
+            node = self.filled_node(routing_table_class=routing_table_class)
+            size = save_snapshot(self.path, node)
+            self.assertLess(size, 400)
+
+            identifier, contacts, replacements = load_snapshot(self.path)
+            self.assertEqual(0, identifier)
+            self.assertEqual(node.routing_table.contacts(), (contacts, replacements))
+
+            restarted = KademliaNode(k=2, identifier=identifier, routing_table_class=routing_table_class)
+            for peer_identifier, peer in contacts + replacements:
+                restarted.routing_table.update_peer(peer_identifier, peer)
+            self.assertEqual(node.routing_table.contacts(), restarted.routing_table.contacts())
+
+    def test_missing_or_corrupt(self):
+        self.assertIsNone(load_snapshot(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot')
+        self.assertIsNone(load_snapshot(self.path))
+
+    @async_unit
+    def test_snapshotter(self):
+        node = self.filled_node()
+        snapshotter = node.start_snapshots(self.path, interval=0.01)
+        yield from asyncio.sleep(0.05)
+        self.assertGreaterEqual(snapshotter.stats['snapshots'], 1)
+
+        node.routing_table.update_peer(2, ('10.0.1.2', 9000))
+        node.stop_snapshots()
+        self.assertIsNone(node.snapshotter)
+        self.assertIn((2, ('10.0.1.2', 9000)), load_snapshot(self.path)[1])
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
@@ -0,0 +1,241 @@
+# coding: utf-8
+import os
+import tempfile
+import unittest
+
+import mock
+
+from kademlia_aio import KademliaNode
+from kademlia_aio.storage import LogBackend, Storage
+from tests.helpers import Clock
+
+
+class StorageTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_mapping(self):
+        storage = Storage(clock=self.clock)
+        storage['hello'] = 'world'
+        self.assertIn('hello', storage)
+        self.assertEqual('world', storage['hello'])
+        self.assertEqual('world', storage.get('hello'))
+        self.assertIsNone(storage.get('missing'))
+        self.assertEqual(['hello'], list(storage))
+        self.assertEqual(1, len(storage))
+        del storage['hello']
+        self.assertNotIn('hello', storage)
+        self.assertRaises(KeyError, lambda: storage['hello'])
+        self.assertEqual(0, storage.usage()['bytes'])
+
+    def test_ttl(self):
+        storage = Storage(default_ttl=10, clock=self.clock)
+        storage['default'] = 'a'
+        storage.set('short', 'b', ttl=5)
+        storage.set('long', 'c', ttl=100)
+        self.assertEqual(1010.0, storage.expires_at('default'))
+
+        self.clock.now += 5
+        self.assertNotIn('short', storage)
+        self.assertEqual('a', storage['default'])
+
+        self.clock.now += 5
+        self.assertRaises(KeyError, lambda: storage['default'])
+        self.assertEqual(['long'], list(storage))
+        self.assertEqual(1, len(storage))
+        self.assertEqual(2, storage.usage()['expirations'])
+
+    def test_purge_expired(self):
+        storage = Storage(granularity=10, clock=self.clock)
+        for i in range(100):
+            storage.set(i, 'value', ttl=i + 1)
+        storage.set(0, 'renewed', ttl=1000)
+
+        self.clock.now += 50.5
+        self.assertEqual(49, storage.purge_expired())
+        self.assertEqual(51, len(storage.entries))
+        self.assertEqual('renewed', storage[0])
+        self.assertEqual(0, storage.purge_expired())
+
+        self.clock.now += 1000
+        self.assertEqual(51, storage.purge_expired())
+        self.assertEqual({}, storage.expiry_buckets)
+        self.assertEqual([], storage.expiry_heap)
+
+    def test_lru_eviction(self):
+        storage = Storage(max_bytes=30, clock=self.clock)
+        storage['a'] = 'x' * 9
+        storage['b'] = 'x' * 9
+        storage['c'] = 'x' * 9
+        self.assertEqual(30, storage.usage()['bytes'])
+
+        storage['a']
+        storage['d'] = 'x' * 9
+        self.assertEqual(['c', 'a', 'd'], list(storage))
+        self.assertEqual(1, storage.usage()['evictions'])
+
+        storage['e'] = 'x' * 100
+        self.assertEqual(['e'], list(storage))
+        self.assertEqual(4, storage.usage()['evictions'])
+
+    def test_container_size(self):
+        storage = Storage(max_bytes=100000, clock=self.clock)
+        for i in range(20):
+            storage[i] = ['x' * 1000] * 20
+        self.assertLessEqual(storage.usage()['bytes'], 100000)
+        self.assertEqual(4, len(storage))
+
+    def test_usage(self):
+        storage = Storage(clock=self.clock)
+        storage['a'] = b'12345'
+        storage['a']
+        storage.get('b')
+        self.assertEqual({'entries': 1, 'bytes': 6, 'hits': 1, 'misses': 1, 'expirations': 0, 'evictions': 0},
+                         storage.usage())
+
+    def test_node_default(self):
+        node = KademliaNode()
+        self.assertEqual(86400, node.storage.default_ttl)
+        storage = Storage()
+        self.assertIs(storage, KademliaNode(storage=storage).storage)
+
+
+class LogBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.wall_clock = Clock()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'values')
+        self.storages = []
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.close()
+        self.directory.cleanup()
+
+    def open_storage(self, **kwargs):
+        backend_kwargs = {'segment_bytes': kwargs.pop('segment_bytes', 4096), 'wall_clock': self.wall_clock}
+        storage = Storage(clock=self.clock, backend=LogBackend(self.path, **backend_kwargs), **kwargs)
+        self.storages.append(storage)
+        return storage
+
+    def reopen(self, storage, **kwargs):
+        storage.close()
+        return self.open_storage(**kwargs)
+
+    def test_mapping(self):
+        storage = self.open_storage()
+        storage[2**160 - 1] = b'world'
+        storage['list'] = [1, ('two', b'three')]
+        self.assertEqual(b'world', storage[2**160 - 1])
+        self.assertEqual([1, ('two', b'three')], storage['list'])
+        self.assertEqual(['list'], [key for key in storage if key == 'list'])
+        del storage['list']
+        self.assertNotIn('list', storage)
+        self.assertEqual(1, len(storage))
+
+    def test_zero_copy_reads(self):
+        storage = self.open_storage()
+        storage['hello'] = b'world'
+        value = storage['hello']
+        self.assertIsInstance(value, memoryview)
+        self.assertTrue(value.readonly)
+        self.assertEqual(b'world', value)
+
+    def test_reload(self):
+        storage = self.open_storage()
+        storage.set('kept', b'a', ttl=100)
+        storage['replaced'] = b'b'
+        storage['replaced'] = 'c'
+        storage['deleted'] = b'd'
+        storage.discard('deleted')
+        storage['forever'] = b'e'
+        storage.set('short', b'f', ttl=10)
+
+        self.wall_clock.now += 20
+        self.clock.now += 5000
+        storage = self.reopen(storage)
+        self.assertEqual(['kept', 'replaced', 'forever'], list(storage))
+        self.assertEqual(b'a', storage['kept'])
+        self.assertEqual('c', storage['replaced'])
+        self.assertEqual(self.clock.now + 80, storage.expires_at('kept'))
+        self.assertEqual(self.clock.now - 20, storage.stored_at('kept'))
+        self.assertIsNone(storage.expires_at('forever'))
+
+    def test_reload_ignores_torn_write(self):
+        storage = self.open_storage()
+        storage['a'] = b'1' * 100
+        storage['b'] = b'2' * 100
+        start, end = storage.backend.index['b'][1:3]
+        storage.backend.active.writable[end - 10:end] = b'x' * 10
+
+        storage = self.reopen(storage)
+        self.assertEqual(['a'], list(storage))
+        storage['c'] = b'3' * 100
+        storage = self.reopen(storage)
+        self.assertEqual(['a', 'c'], list(storage))
+
+    def test_compaction(self):
+        storage = self.open_storage(segment_bytes=1024)
+        for i in range(40):
+            storage[i] = bytes([i]) * 100
+        for i in range(30):
+            del storage[i]
+        storage[39] = b'renewed'
+        segments = len(storage.backend.segments)
+        while storage.backend.compact():
+            pass
+        self.assertLess(len(storage.backend.segments), segments)
+        self.assertEqual(len(storage.backend.segments), len(os.listdir(self.path)))
+        self.assertGreater(storage.backend.stats['reclaimed'], 0)
+
+        storage = self.reopen(storage, segment_bytes=1024)
+        self.assertEqual(list(range(30, 40)), sorted(storage))
+        self.assertEqual(bytes([35]) * 100, storage[35])
+        self.assertEqual(b'renewed', storage[39])
+
+    def test_large_value(self):
+        storage = self.open_storage(segment_bytes=1024)
+        storage['large'] = b'x' * 5000
+        storage['small'] = b'y'
+        storage = self.reopen(storage, segment_bytes=1024)
+        self.assertEqual(b'x' * 5000, storage['large'])
+        self.assertEqual(b'y', storage['small'])
+
+    def test_eviction_survives_reload(self):
+        storage = self.open_storage(max_bytes=30)
+        storage['a'] = 'x' * 10
+        storage['b'] = 'x' * 10
+        storage['c'] = 'x' * 10
+        self.assertEqual(['b', 'c'], list(storage))
+        storage = self.reopen(storage, max_bytes=30)
+        self.assertEqual(['b', 'c'], list(storage))
+
+    def test_node_serves_stored_bytes(self):
+        storage = self.open_storage()
+        node = KademliaNode(storage=storage)
+        node.store_locally(1234, b'world')
+        self.assertEqual(('found', b'world'), node.value_result(1234))
+        message = ('reply', 1, (node.identifier, node.value_result(1234)))
+        self.assertEqual(('reply', 1, (node.identifier, ('found', b'world'))),
+                         node.codec.decode(node.codec.encode(message)))
+
+    def test_node_serves_large_stored_values(self):
+        storage = self.open_storage(segment_bytes=2**20)
+        node = KademliaNode(storage=storage)
+        node.store_locally(1, b'x' * 100000)
+        node.store_locally(2, ['x' * 1000] * 100)
+        self.assertEqual(('chunked', (100000, True)), node.value_result(1))
+        size, raw = node.value_result(2)[1]
+        self.assertFalse(raw)
+
+        with mock.patch.object(node.codec, 'encode_large', wraps=node.codec.encode_large) as encode_large:
+            chunks = [node.find_chunk.reply_function(node, None, 0, 2, offset, node.chunk_size())[1]
+                      for offset in range(0, size, node.chunk_size())]
+        self.assertFalse(encode_large.called)
+        self.assertEqual(['x' * 1000] * 100, node.codec.decode(b''.join(chunks))[2])
+
+        node.store_locally(2, ['y' * 1000] * 100)
+        size, _ = node.value_result(2)[1]
+        data = node.find_chunk.reply_function(node, None, 0, 2, 0, size)[1]
+        self.assertEqual(b'y' * 10, data[-10:])
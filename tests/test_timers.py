@@ -0,0 +1,130 @@
+# coding: utf-8
+import asyncio
+import unittest
+
+from kademlia_aio.timers import RoundTripEstimator, TimerWheel
+
+
+class TimerWheelTests(unittest.TestCase):
+    def setUp(self):
+        self.original_loop = asyncio.get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.fired = []
+
+    def tearDown(self):
+        asyncio.set_event_loop(self.original_loop)
+        self.loop.close()
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_fires_in_order(self):
+        wheel = TimerWheel(resolution=0.01, slots=8, loop=self.loop)
+        wheel.schedule('b', 0.05, self.fired.append, 'b')
+        wheel.schedule('a', 0.02, self.fired.append, 'a')
+        wheel.schedule('c', 0.2, self.fired.append, 'c')
+        self.assertEqual(3, len(wheel))
+
+        self.run_for(0.1)
+        self.assertEqual(['a', 'b'], self.fired)
+        self.assertEqual(1, len(wheel))
+
+        self.run_for(0.15)
+        self.assertEqual(['a', 'b', 'c'], self.fired)
+        self.assertEqual(0, len(wheel))
+        self.assertIsNone(wheel.handle)
+
+    def test_never_early(self):
+        wheel = TimerWheel(resolution=0.05, loop=self.loop)
+        start = self.loop.time()
+        wheel.schedule('a', 0.12, lambda: self.fired.append(self.loop.time() - start))
+        self.run_for(0.3)
+        self.assertEqual(1, len(self.fired))
+        self.assertGreaterEqual(self.fired[0], 0.12)
+
+    def test_cancel(self):
+        wheel = TimerWheel(resolution=0.01, loop=self.loop)
+        wheel.schedule('a', 0.02, self.fired.append, 'a')
+        wheel.schedule('b', 0.02, self.fired.append, 'b')
+        self.assertTrue(wheel.cancel('a'))
+        self.assertFalse(wheel.cancel('a'))
+        self.assertNotIn('a', wheel)
+
+        self.run_for(0.05)
+        self.assertEqual(['b'], self.fired)
+        self.assertEqual(1, wheel.cancelled)
+        self.assertEqual(1, wheel.fired)
+
+    def test_reschedule(self):
+        wheel = TimerWheel(resolution=0.01, loop=self.loop)
+        wheel.schedule('a', 0.02, self.fired.append, 'first')
+        wheel.schedule('a', 0.04, self.fired.append, 'second')
+        self.assertEqual(1, len(wheel))
+        self.run_for(0.08)
+        self.assertEqual(['second'], self.fired)
+
+    def test_longer_than_one_revolution(self):
+        wheel = TimerWheel(resolution=0.01, slots=4, loop=self.loop)
+        wheel.schedule('a', 0.1, self.fired.append, 'a')
+        self.run_for(0.05)
+        self.assertEqual([], self.fired)
+        self.run_for(0.1)
+        self.assertEqual(['a'], self.fired)
+
+    def test_close(self):
+        wheel = TimerWheel(resolution=0.01, loop=self.loop)
+        wheel.schedule('a', 0.02, self.fired.append, 'a')
+        wheel.close()
+        self.run_for(0.05)
+        self.assertEqual([], self.fired)
+        self.assertEqual(0, len(wheel))
+
+
+class RoundTripEstimatorTests(unittest.TestCase):
+    def test_unknown_peer(self):
+        estimator = RoundTripEstimator()
+        self.assertIsNone(estimator.estimate('a'))
+        self.assertEqual(5, estimator.timeout('a', 5))
+        self.assertEqual(1, estimator.expected('a', 1))
+
+    def test_first_sample(self):
+        estimator = RoundTripEstimator(min_timeout=0.01)
+        estimator.observe('a', 0.1)
+        self.assertEqual((0.1, 0.05), estimator.estimate('a'))
+        self.assertAlmostEqual(0.3, estimator.timeout('a', 5))
+
+    def test_smoothing(self):
+        estimator = RoundTripEstimator(min_timeout=0.01)
+        estimator.observe('a', 0.1)
+        estimator.observe('a', 0.2)
+        smoothed, variance = estimator.estimate('a')
+        self.assertAlmostEqual(0.1125, smoothed)
+        self.assertAlmostEqual(0.0625, variance)
+
+    def test_bounds(self):
+        estimator = RoundTripEstimator(min_timeout=0.5)
+        estimator.observe('lan', 0.0001)
+        estimator.observe('slow', 10)
+        self.assertEqual(0.5, estimator.timeout('lan', 5))
+        self.assertEqual(5, estimator.timeout('slow', 5))
+        self.assertAlmostEqual(0.0101, estimator.expected('lan', 1))
+
+    def test_backoff(self):
+        estimator = RoundTripEstimator(min_timeout=0.01)
+        estimator.observe('a', 0.1)
+        estimator.backoff('a')
+        self.assertAlmostEqual(0.6, estimator.timeout('a', 5))
+        estimator.observe('a', 0.1)
+        self.assertLess(estimator.timeout('a', 5), 0.6)
+        estimator.backoff('unknown')
+        self.assertNotIn('unknown', estimator)
+
+    def test_max_peers(self):
+        estimator = RoundTripEstimator(max_peers=2)
+        estimator.observe('a', 0.1)
+        estimator.observe('b', 0.1)
+        estimator.observe('a', 0.1)
+        estimator.observe('c', 0.1)
+        self.assertEqual(2, len(estimator))
+        self.assertNotIn('b', estimator)
@@ -0,0 +1,42 @@
+# coding: utf-8
+import logging
+import unittest
+
+from kademlia_aio import KademliaNode
+from kademlia_aio.trace import MessageTrace
+
+
+class MessageTraceTests(unittest.TestCase):
+    def test_ring_buffer(self):
+        trace = MessageTrace(max_entries=3, clock=lambda: 1.5)
+        for size in range(5):
+            trace('request_sent', 'ping', ('10.0.0.1', 9000), size, None)
+        self.assertEqual([2, 3, 4], [entry['size'] for entry in trace.dump()])
+        self.assertEqual({'time': 1.5, 'event': 'request_sent', 'procedure': 'ping', 'peer': ('10.0.0.1', 9000),
+                          'size': 4, 'latency': None}, trace.dump()[-1])
+
+    def test_sampling(self):
+        trace = MessageTrace(sample_every=10)
+        for size in range(100):
+            trace('request_received', 'find_node', ('10.0.0.1', 9000), size, None)
+        self.assertEqual(10, len(trace))
+        self.assertEqual([9, 19], [entry['size'] for entry in trace.dump()[:2]])
+
+    def test_log(self):
+        trace = MessageTrace(clock=lambda: 1.5)
+        trace('reply_received', 'ping', ('10.0.0.1', 9000), 40, 0.0125)
+        with self.assertLogs('kademlia_aio.trace', logging.INFO) as logs:
+            trace.log()
+        self.assertEqual(["INFO:kademlia_aio.trace:1.500000 reply_received ping ('10.0.0.1', 9000) 40 bytes in 12.5ms"],
+                         logs.output)
+
+    def test_node_tracing(self):
+        node = KademliaNode()
+        self.assertIsNone(node.trace)
+        trace = node.start_tracing(max_entries=10)
+        self.assertIs(trace, node.start_tracing())
+        node.metrics.request_received('ping', ('10.0.0.1', 9000), 30)
+        self.assertEqual(1, len(trace))
+        node.stop_tracing()
+        self.assertIsNone(node.trace)
+        self.assertEqual([], node.metrics.hooks)
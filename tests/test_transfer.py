@@ -0,0 +1,51 @@
+# coding: utf-8
+import unittest
+
+from kademlia_aio.transfer import IncomingTransfers
+from tests.helpers import Clock
+
+
+class IncomingTransfersTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.transfers = IncomingTransfers(max_bytes=100, timeout=10, clock=self.clock)
+
+    def test_out_of_order_and_repeated(self):
+        self.assertIsNone(self.transfers.receive('a', 10, 6, b'6789'))
+        self.assertIsNone(self.transfers.receive('a', 10, 0, b'012'))
+        self.assertIsNone(self.transfers.receive('a', 10, 0, b'012'))
+        self.assertEqual(10, self.transfers.bytes)
+        buffer = self.transfers.receive('a', 10, 3, b'345')
+        self.assertEqual(b'0123456789', buffer)
+        self.assertEqual(0, len(self.transfers))
+        self.assertEqual(0, self.transfers.bytes)
+        self.assertEqual(1, self.transfers.stats['completed'])
+
+    def test_overlapping(self):
+        self.assertIsNone(self.transfers.receive('a', 10, 0, b'0123'))
+        self.assertIsNone(self.transfers.receive('a', 10, 2, b'2345'))
+        self.assertIsNone(self.transfers.receive('a', 10, 1, b'12'))
+        self.assertIsNone(self.transfers.receive('a', 10, 7, b'78'))
+        self.assertEqual(b'0123456789', self.transfers.receive('a', 10, 5, b'56789'))
+
+    def test_rejects(self):
+        self.assertRaises(ValueError, self.transfers.receive, 'a', 10, 8, b'890')
+        self.assertRaises(ValueError, self.transfers.receive, 'a', 101, 0, b'0')
+        self.transfers.receive('a', 60, 0, b'0')
+        self.assertRaises(ValueError, self.transfers.receive, 'b', 60, 0, b'0')
+        self.assertEqual(3, self.transfers.stats['rejected'])
+
+    def test_restarted_transfer(self):
+        self.transfers.receive('a', 10, 0, b'01234')
+        self.assertIsNone(self.transfers.receive('a', 5, 0, b'01'))
+        self.assertEqual(5, self.transfers.bytes)
+        self.assertEqual(b'01234', self.transfers.receive('a', 5, 2, b'234'))
+
+    def test_abandons_idle(self):
+        self.transfers.receive('a', 10, 0, b'01234')
+        self.clock.now += 5
+        self.transfers.receive('b', 10, 0, b'01234')
+        self.clock.now += 5
+        self.transfers.receive('b', 10, 5, b'5')
+        self.assertEqual(1, len(self.transfers))
+        self.assertEqual(1, self.transfers.stats['abandoned'])